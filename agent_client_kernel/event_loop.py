@@ -0,0 +1,100 @@
+"""
+Background event loop for agent traffic
+"""
+
+import asyncio
+import logging
+import threading
+
+
+class EventLoopThread:
+    """A long-lived asyncio event loop running on a daemon thread
+
+    The loop owns the agent connection, so the connection's reader task,
+    terminal output pumps and agent notifications keep being serviced while
+    the kernel is idle between cells. Other threads hand it work with
+    ``submit`` or ``run``.
+    """
+
+    def __init__(self, name='acp-event-loop'):
+        self._name = name
+        self._log = logging.getLogger(__name__)
+        self._loop = None
+        self._thread = None
+        self._started = threading.Event()
+
+    @property
+    def loop(self):
+        """The event loop, or None if the thread has not been started"""
+        return self._loop
+
+    def is_running(self):
+        """Return True if the loop thread is alive"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def in_loop_thread(self):
+        """Return True if called from the loop's own thread"""
+        return threading.current_thread() is self._thread
+
+    def start(self):
+        """Start the loop thread and wait until the loop is running"""
+        if self.is_running():
+            return
+
+        self._loop = asyncio.new_event_loop()
+        self._started.clear()
+        self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+    def _run(self):
+        """Thread body: run the loop until stop() is called"""
+        asyncio.set_event_loop(self._loop)
+        self._loop.call_soon(self._started.set)
+        try:
+            self._loop.run_forever()
+        finally:
+            try:
+                self._cancel_pending_tasks()
+                self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+            except Exception as e:
+                self._log.error("Error shutting down event loop: %s", e)
+            finally:
+                self._loop.close()
+
+    def _cancel_pending_tasks(self):
+        """Cancel tasks still pending when the loop stops"""
+        tasks = [task for task in asyncio.all_tasks(self._loop) if not task.done()]
+        if not tasks:
+            return
+        for task in tasks:
+            task.cancel()
+        self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+    def submit(self, coro):
+        """Schedule a coroutine on the loop and return a concurrent.futures.Future"""
+        if not self.is_running():
+            coro.close()
+            raise RuntimeError("Event loop thread is not running")
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the loop and block until it completes"""
+        if self.in_loop_thread():
+            coro.close()
+            raise RuntimeError("Cannot block on the event loop from its own thread")
+        return self.submit(coro).result(timeout)
+
+    def call_soon(self, callback, *args):
+        """Schedule a plain callback on the loop from any thread"""
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self, timeout=5.0):
+        """Stop the loop and wait for the thread to exit"""
+        if not self.is_running():
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self._log.warning("Event loop thread did not stop within %.1fs", timeout)
+        self._thread = None
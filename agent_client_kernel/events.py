@@ -0,0 +1,161 @@
+"""
+Compact log of session updates for per-turn timelines
+"""
+
+import collections
+import time
+
+
+def _field(obj, name, default=None):
+    """Read a field from a schema model or the equivalent dict"""
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+
+def _text_size(content):
+    """Length of the text in a content block, 0 for non-text content"""
+    if content is None:
+        return 0
+    text = _field(content, 'text')
+    return len(text) if isinstance(text, str) else 0
+
+
+class SessionEvent:
+    """One entry in the event log
+
+    Consecutive message or thought chunks in the same turn are folded into
+    a single event, with ``count`` chunks totalling ``size`` characters.
+    """
+
+    __slots__ = ('time', 'turn', 'kind', 'tool_call_id', 'status', 'title', 'size', 'count')
+
+    def __init__(self, time, turn, kind, tool_call_id=None, status=None, title=None, size=0):
+        self.time = time
+        self.turn = turn
+        self.kind = kind
+        self.tool_call_id = tool_call_id
+        self.status = status
+        self.title = title
+        self.size = size
+        self.count = 1
+
+
+class ToolCallSpan:
+    """Start and finish times of a tool call"""
+
+    __slots__ = ('tool_call_id', 'turn', 'title', 'kind', 'status', 'started', 'finished')
+
+    def __init__(self, tool_call_id, turn, started):
+        self.tool_call_id = tool_call_id
+        self.turn = turn
+        self.title = None
+        self.kind = None
+        self.status = None
+        self.started = started
+        self.finished = None
+
+    @property
+    def duration(self):
+        """Seconds from start to finish, or None while the call is running"""
+        if self.finished is None:
+            return None
+        return self.finished - self.started
+
+
+class EventLog:
+    """Bounded ring buffer of session events with tool-call timing
+
+    Only the newest ``max_events`` events and tool calls are kept, so the
+    log's memory use does not grow with the length of the session.
+    """
+
+    CHUNK_KINDS = ('agent_message_chunk', 'user_message_chunk', 'agent_thought_chunk')
+    FINAL_STATUSES = ('completed', 'failed')
+
+    def __init__(self, max_events=2000):
+        self._events = collections.deque(maxlen=max_events)
+        self._tool_calls = collections.OrderedDict()
+        self._max_events = max_events
+        self.total = 0
+
+    def __len__(self):
+        return len(self._events)
+
+    def clear(self):
+        """Drop all events and tool calls"""
+        self._events.clear()
+        self._tool_calls.clear()
+        self.total = 0
+
+    def mark(self, turn, kind, title=None):
+        """Record a kernel-side event such as the start or end of a turn"""
+        self._append(SessionEvent(time.time(), turn, kind, title=title))
+
+    def record(self, turn, update):
+        """Record a session update from the agent"""
+        kind = _field(update, 'sessionUpdate')
+        if kind is None:
+            return
+        now = time.time()
+
+        if kind in self.CHUNK_KINDS:
+            size = _text_size(_field(update, 'content'))
+            last = self._events[-1] if self._events else None
+            if last is not None and last.kind == kind and last.turn == turn:
+                last.size += size
+                last.count += 1
+                return
+            self._append(SessionEvent(now, turn, kind, size=size))
+        elif kind in ('tool_call', 'tool_call_update'):
+            self._record_tool_call(now, turn, kind, update)
+        elif kind == 'plan':
+            entries = _field(update, 'entries') or []
+            done = sum(1 for entry in entries if _field(entry, 'status') == 'completed')
+            self._append(SessionEvent(now, turn, kind, title=f"{done}/{len(entries)} completed"))
+        elif kind == 'current_mode_update':
+            self._append(SessionEvent(now, turn, kind, title=_field(update, 'currentModeId')))
+        elif kind == 'available_commands_update':
+            commands = _field(update, 'availableCommands') or []
+            self._append(SessionEvent(now, turn, kind, size=len(commands)))
+        else:
+            self._append(SessionEvent(now, turn, kind))
+
+    def _record_tool_call(self, now, turn, kind, update):
+        tool_call_id = _field(update, 'toolCallId')
+        status = _field(update, 'status')
+        title = _field(update, 'title')
+
+        span = self._tool_calls.get(tool_call_id)
+        if span is None:
+            span = ToolCallSpan(tool_call_id, turn, now)
+            self._tool_calls[tool_call_id] = span
+            if len(self._tool_calls) > self._max_events:
+                self._tool_calls.popitem(last=False)
+        if title:
+            span.title = title
+        tool_kind = _field(update, 'kind')
+        if tool_kind:
+            span.kind = str(tool_kind)
+        if status:
+            span.status = str(status)
+            if span.status in self.FINAL_STATUSES and span.finished is None:
+                span.finished = now
+
+        self._append(SessionEvent(now, turn, kind, tool_call_id, span.status, span.title))
+
+    def _append(self, event):
+        self._events.append(event)
+        self.total += 1
+
+    def last_turn(self):
+        """The newest turn number in the log, or None if it is empty"""
+        return self._events[-1].turn if self._events else None
+
+    def events(self, turn=None):
+        """Events in order, optionally limited to one turn"""
+        return [event for event in self._events if turn is None or event.turn == turn]
+
+    def tool_calls(self, turn=None):
+        """Tool-call spans in start order, optionally limited to one turn"""
+        return [span for span in self._tool_calls.values() if turn is None or span.turn == turn]
@@ -0,0 +1,390 @@
+"""
+File access for the agent's readTextFile/writeTextFile requests
+
+Filesystem calls block, so they run on a small thread pool instead of the
+event loop that carries the ACP connection. Writes are atomic: the content
+goes to a temporary file in the target directory which then replaces the
+target, so a concurrent reader sees either the old or the new file.
+
+Reads of a range of lines use positional reads and a sparse index of line
+offsets, so paging through a huge log touches only the requested bytes. A
+file truncated during a read (log rotation, say) yields a short result.
+Whole-file reads are served from a byte-bounded cache while the file's
+stat is unchanged.
+"""
+
+import array
+import asyncio
+import collections
+import errno
+import itertools
+import os
+import re
+import secrets
+import stat
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# When to fsync a write: never, the file before it replaces the target, or
+# also the directory afterwards so the rename itself survives a crash
+FSYNC_POLICIES = ('none', 'file', 'full')
+
+
+def _version(st):
+    """Identity of one version of a file, for cache validation"""
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_ctime_ns, st.st_size)
+
+
+def read_text(path, cache=None):
+    """Read a UTF-8 text file, from the cache if it has this version"""
+    with open(path, encoding='utf-8') as f:
+        if cache is None:
+            return f.read()
+        path = os.path.realpath(path)
+        st = os.fstat(f.fileno())
+        content = cache.get(path, st)
+        if content is None:
+            content = f.read()
+            cache.put(path, st, content)
+        return content
+
+
+class ContentCache:
+    """LRU cache of decoded file contents, bounded by total file size
+
+    An entry is only returned while the file's device, inode, modification
+    and change times and size match those it was read with. Files larger
+    than an eighth of ``max_bytes`` are not cached so that one large file
+    cannot flush everything else.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, path, st):
+        """Cached content of path if it is still the version described by st"""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                version, content = entry
+                if version == _version(st):
+                    self._entries.move_to_end(path)
+                    self.hits += 1
+                    self.bytes_saved += st.st_size
+                    return content
+                self._remove(path)
+                self.invalidations += 1
+            self.misses += 1
+            return None
+
+    def put(self, path, st, content):
+        """Cache content read from the version of path described by st"""
+        size = st.st_size
+        if size > self.max_bytes // 8:
+            return
+        with self._lock:
+            self._remove(path)
+            self._entries[path] = (_version(st), content)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (version, _) = self._entries.popitem(last=False)
+                self.bytes -= version[-1]
+
+    def discard(self, path):
+        """Drop path, e.g. because it is being written"""
+        with self._lock:
+            if self._remove(path):
+                self.invalidations += 1
+
+    def _remove(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is None:
+            return False
+        self.bytes -= entry[0][-1]
+        return True
+
+    def clear(self):
+        """Drop all entries (the counters are kept)"""
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes_saved': self.bytes_saved,
+            'invalidations': self.invalidations,
+        }
+
+
+def _translate_newlines(text):
+    """Apply the universal-newline translation that text-mode reads do"""
+    if '\r' not in text:
+        return text
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+# Line terminators as a text-mode read recognizes them
+_LINE_END = re.compile(rb'\r\n|\r|\n')
+
+
+def _read_block(fd, size, position, length):
+    """Read up to length bytes at position, not ending between a \\r and a \\n
+
+    A trailing \\r is left for the next read, which shows whether it starts
+    a \\r\\n pair, unless it is the last byte of the file.
+    """
+    block = os.pread(fd, min(length, size - position), position)
+    if len(block) > 1 and block.endswith(b'\r') and position + len(block) < size:
+        block = block[:-1]
+    return block
+
+
+class LineIndex:
+    """Sparse index of line start offsets in one version of a file
+
+    The offset of every ``STRIDE``-th line is recorded, so the index costs
+    a few bytes per hundred lines; the lines in between are found with a
+    short forward scan. The index is built lazily, only as far into the
+    file as requests have reached.
+    """
+
+    STRIDE = 64
+    BLOCK_SIZE = 1024 * 1024
+    SCAN_SIZE = 64 * 1024
+
+    def __init__(self, key):
+        self.key = key
+        self.lock = threading.Lock()
+        self._checkpoints = array.array('Q', [0])
+        self._scanned = 0
+        self._newlines = 0
+
+    def _scan_to(self, fd, size, checkpoint):
+        """Extend the index until it has the given checkpoint or reaches EOF"""
+        stride = self.STRIDE
+        while len(self._checkpoints) <= checkpoint and self._scanned < size:
+            base = self._scanned
+            block = _read_block(fd, size, base, self.BLOCK_SIZE)
+            if not block:
+                # The file shrank while it was being read
+                break
+            if b'\r' in block:
+                ends = [match.end() for match in _LINE_END.finditer(block)]
+                lengths = [end - start for start, end in zip([0] + ends, ends)]
+            else:
+                lengths = [len(piece) + 1 for piece in block.split(b'\n')[:-1]]
+            if lengths:
+                # Start offsets of the lines following each newline; keep
+                # those whose line number falls on a checkpoint
+                starts = itertools.accumulate(lengths, initial=base)
+                first = stride - self._newlines % stride
+                self._checkpoints.extend(itertools.islice(starts, first, None, stride))
+                self._newlines += len(lengths)
+            self._scanned = base + len(block)
+
+    def offset(self, fd, size, line):
+        """Byte offset at which 0-based line starts, or the file size"""
+        checkpoint, remainder = divmod(line, self.STRIDE)
+        self._scan_to(fd, size, checkpoint)
+        if checkpoint >= len(self._checkpoints):
+            return size
+        position = self._checkpoints[checkpoint]
+
+        # The line is fewer than STRIDE lines past the checkpoint
+        while remainder and position < size:
+            block = _read_block(fd, size, position, self.SCAN_SIZE)
+            if not block:
+                break
+            start = 0
+            if b'\r' in block:
+                for match in itertools.islice(_LINE_END.finditer(block), remainder):
+                    start = match.end()
+                    remainder -= 1
+            else:
+                while remainder:
+                    newline = block.find(b'\n', start)
+                    if newline < 0:
+                        break
+                    start = newline + 1
+                    remainder -= 1
+            position += start if not remainder else len(block)
+        return position if not remainder else size
+
+
+class LineIndexCache:
+    """Line indexes of recently read files, keyed by path
+
+    An index is valid for one version of its file, identified by device,
+    inode, modification time and size; any change rebuilds it.
+    """
+
+    def __init__(self, max_files=64):
+        self._max_files = max_files
+        self._indexes = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, st):
+        key = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            index = self._indexes.get(path)
+            if index is None or index.key != key:
+                index = LineIndex(key)
+                self._indexes[path] = index
+                if len(self._indexes) > self._max_files:
+                    self._indexes.popitem(last=False)
+            self._indexes.move_to_end(path)
+            return index
+
+    def discard(self, path):
+        with self._lock:
+            self._indexes.pop(path, None)
+
+    def __len__(self):
+        return len(self._indexes)
+
+
+def read_lines(path, line=1, limit=None, indexes=None):
+    """Read up to limit lines of a UTF-8 text file, starting at 1-based line
+
+    Lines end at ``\\n``, ``\\r\\n`` or ``\\r``, as in a whole-file read, and
+    the text is returned with the same newline translation.
+    """
+    path = os.path.realpath(path)
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if st.st_size == 0:
+            return ''
+        if indexes is None:
+            indexes = LineIndexCache()
+        index = indexes.get(path, st)
+        fd, size = f.fileno(), st.st_size
+        with index.lock:
+            start = index.offset(fd, size, line - 1)
+            end = size if limit is None else index.offset(fd, size, line - 1 + limit)
+        data = os.pread(fd, end - start, start) if end > start else b''
+        return _translate_newlines(data.decode('utf-8'))
+
+
+def _create_temp(directory, name):
+    """Create a new hidden temporary file next to name; returns (fd, path)
+
+    The file is created with mode 0o666, so it gets the permissions the
+    process umask gives new files without the umask having to be read
+    (which means setting it, racing with other threads).
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_CLOEXEC', 0)
+    for _ in range(tempfile.TMP_MAX):
+        temp_path = os.path.join(directory, f".{name}.{secrets.token_hex(4)}.tmp")
+        try:
+            return os.open(temp_path, flags, 0o666), temp_path
+        except FileExistsError:
+            continue
+    raise FileExistsError(errno.EEXIST, "No usable temporary file name found", directory)
+
+
+def atomic_write_text(path, content, fsync='file'):
+    """Write a UTF-8 text file by replacing it with a complete new file
+
+    A symlink is written through rather than replaced, and an existing
+    file's permission bits are kept.
+    """
+    path = os.path.realpath(path)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = None
+
+    fd, temp_path = _create_temp(directory, os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            if mode is not None:
+                os.fchmod(f.fileno(), mode)
+            f.write(content)
+            f.flush()
+            if fsync != 'none':
+                os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+    if fsync == 'full':
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class FileIO:
+    """Runs file reads and writes on a bounded thread pool
+
+    At most ``max_workers`` filesystem calls are in flight; further requests
+    wait for a worker without holding up the event loop.
+    """
+
+    def __init__(self, max_workers=4, fsync='file', cache_bytes=64 * 1024 * 1024):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {', '.join(FSYNC_POLICIES)}, not {fsync!r}")
+        self.max_workers = max_workers
+        self.fsync = fsync
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='acp-file')
+        self._line_indexes = LineIndexCache()
+        self.cache = ContentCache(cache_bytes) if cache_bytes > 0 else None
+        self.reads = 0
+        self.writes = 0
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def read_text(self, path):
+        """Read a UTF-8 text file"""
+        self.reads += 1
+        return await self._run(read_text, path, self.cache)
+
+    async def read_lines(self, path, line=1, limit=None):
+        """Read up to limit lines of a UTF-8 text file, starting at 1-based line"""
+        self.reads += 1
+        return await self._run(read_lines, path, line, limit, self._line_indexes)
+
+    async def write_text(self, path, content):
+        """Atomically write a UTF-8 text file, creating parent directories"""
+        self.writes += 1
+        await self._run(self._write_text, path, content)
+
+    def _write_text(self, path, content):
+        real_path = os.path.realpath(path)
+        try:
+            atomic_write_text(real_path, content, self.fsync)
+        finally:
+            if self.cache is not None:
+                self.cache.discard(real_path)
+            self._line_indexes.discard(real_path)
+
+    def close(self):
+        """Stop the worker threads once queued calls have finished"""
+        self._executor.shutdown(wait=False)
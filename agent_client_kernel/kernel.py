@@ -6,7 +6,10 @@ import asyncio
 import asyncio.subprocess as aio_subprocess
 import logging
 import os
+import queue
 import sys
+import threading
+import time
 from pathlib import Path
 
 # Configure logging to output to stderr
@@ -22,27 +25,48 @@ from acp import (
     Client,
     ClientSideConnection,
     InitializeRequest,
+    LoadSessionRequest,
     NewSessionRequest,
     PromptRequest,
     RequestError,
     SessionNotification,
     text_block,
+    CLIENT_METHODS,
     PROTOCOL_VERSION,
 )
 from acp.schema import (
+    CancelNotification,
     RequestPermissionResponse,
     AllowedOutcome,
     DeniedOutcome,
 )
 
-# Import nest_asyncio to allow nested event loops
-try:
-    import nest_asyncio
-    nest_asyncio.apply()
-except ImportError:
-    pass
-
 from . import __version__, KERNEL_NAME, DISPLAY_NAME
+from .event_loop import EventLoopThread
+from .events import EventLog
+from .files import FileIO, FSYNC_POLICIES
+from .mcp import McpProbe
+from .mcp_broker import McpBroker
+from .permissions import (
+    PermissionAuditLog,
+    PermissionPolicy,
+    PermissionPrompt,
+    PermissionRecord,
+    remember_key,
+)
+from .output import OutputBuffer, OutputStreamer, TerminalMirror
+from .response_cache import ResponseCache
+from .terminals import TerminalManager, TerminalScheduler, parse_rlimits
+from .spawn_server import SpawnServer
+from .sessions import SessionStore
+
+
+def _env_flag(name, default=False):
+    """Read a boolean flag from the environment"""
+    value = os.environ.get(name)
+    if value is None or not value.strip():
+        return default
+    return value.strip().lower() not in ('0', 'false', 'no', 'off')
 
 
 class ACPClient(Client):
@@ -51,48 +75,203 @@ class ACPClient(Client):
     def __init__(self, kernel) -> None:
         self._kernel = kernel
         self._log = logging.getLogger(__name__)
-        self._terminals = {}  # Track active terminals by ID
+        self._terminals = TerminalManager(  # Active terminals by ID
+            scheduler=kernel._terminal_scheduler,
+            nice=kernel._terminal_nice,
+            rlimits=kernel._terminal_rlimits,
+            use_pty=kernel._terminal_pty,
+            strip_ansi=kernel._terminal_strip_ansi,
+            spawner=kernel._spawn_server,
+        )
+        self._turn_terminals = set()  # Terminals created during the current prompt turn
+        self._turn_permissions = {}  # 'Always' answers given during the current turn
+        self._turn_cancelled = False  # Set once the user interrupts the turn
+        
+        # Session update watermarks: the connection observer counts updates
+        # as they are read off the wire, the connection handler numbers them
+        # in the same order as they are dispatched and counts them once
+        # handled, and drain_updates waits for the two to meet. Updates up to
+        # the watermark a timed-out drain gave up at are counted as skipped
+        # until they are handled, so that a late one is not counted twice
+        self._updates_received = 0
+        self._updates_dispatched = 0
+        self._updates_processed = 0
+        self._updates_skipped = 0
+        self._skipped_through = 0
+        self._drain_waiters = []
     
-    async def requestPermission(self, params):
-        """Handle permission requests from the agent"""
-        self._log.info("Permission requested: %s", params)
-        
-        # Get permission mode from kernel (default: auto)
-        mode = getattr(self._kernel, '_permission_mode', 'auto')
+    def _observe_message(self, event):
+        """Connection observer that counts incoming session updates"""
+        message = event.message
+        if (event.direction == 'incoming'
+                and message.get('method') == CLIENT_METHODS['session_update']):
+            self._updates_received += 1
+    
+    async def drain_updates(self, timeout):
+        """Wait until every session update read so far has been handled
         
-        # Record the permission request
-        if not hasattr(self._kernel, '_permission_history'):
-            self._kernel._permission_history = []
+        Returns False if the updates were not drained within the timeout.
+        """
+        target = self._updates_received
+        if self._updates_handled() >= target:
+            return True
         
-        if mode == 'deny':
-            approved = False
+        waiter = asyncio.get_running_loop().create_future()
+        self._drain_waiters.append((target, waiter))
+        try:
+            await asyncio.wait_for(waiter, timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            # An update stuck in dispatch must not hold up every later turn
+            handled = self._updates_handled()
+            self._log.warning(
+                "Timed out draining session updates (%d of %d handled)",
+                handled, target
+            )
+            self._updates_skipped += max(0, target - handled)
+            self._skipped_through = max(self._skipped_through, target)
+            self._release_drain_waiters()
+            return False
+    
+    def _updates_handled(self):
+        """The number of session updates handled or given up on"""
+        return self._updates_processed + self._updates_skipped
+    
+    def _update_dispatched(self):
+        """Number the next session update; returns its sequence number"""
+        self._updates_dispatched += 1
+        return self._updates_dispatched
+    
+    def _update_finished(self, seq):
+        """Count session update seq as handled, whether or not it succeeded"""
+        self._updates_processed += 1
+        if seq <= self._skipped_through and self._updates_skipped > 0:
+            # A drain gave up on this one; it is now counted as processed
+            self._updates_skipped -= 1
+        if self._drain_waiters:
+            self._release_drain_waiters()
+    
+    def _release_drain_waiters(self):
+        """Wake drain waiters whose watermark has been reached"""
+        pending = []
+        for target, waiter in self._drain_waiters:
+            if self._updates_handled() >= target:
+                if not waiter.done():
+                    waiter.set_result(None)
+            else:
+                pending.append((target, waiter))
+        self._drain_waiters = pending
+    
+    async def requestPermission(self, params):
+        """Handle permission requests from the agent"""
+        started = time.perf_counter()
+        tool_call = params.toolCall
+        self._log.info("Permission requested: %s (%s)", tool_call.title, tool_call.toolCallId)
+        
+        rule = None
+        if self._turn_cancelled:
+            # Requests in a turn the user has interrupted are cancelled
+            option_id, source = None, 'interrupted'
+        else:
+            # The policy, if any, decides first; requests it leaves open are
+            # handled according to the permission mode (default: auto)
+            action = None
+            policy = self._kernel._permission_policy
+            if policy is not None:
+                action, rule = policy.decide_request(params, self._kernel._session_cwd)
+                source = 'policy'
+            if action is None:
+                mode = getattr(self._kernel, '_permission_mode', 'auto')
+                action = {'deny': 'deny', 'manual': 'ask'}.get(mode, 'allow')
+                source = f'mode:{mode}'
+            
+            if action == 'deny':
+                # Reject through the agent's own option if it offers one
+                option_id = self._get_option_id(params.options, ('reject_once', 'reject_always'))
+            elif action == 'ask':
+                option_id, source = await self._ask_permission(params)
+            else:  # allow
+                # Select the first 'allow' option if available
+                option_id = self._get_allow_option_id(params.options)
+        
+        if option_id is None:
+            decision = 'cancelled'
             outcome = DeniedOutcome(outcome='cancelled')
-        elif mode == 'manual':
-            # TODO: Implement interactive prompting
-            # For now, fall back to auto-approve
-            approved = True
-            # Select the first 'allow' option if available
-            option_id = self._get_allow_option_id(params.options)
-            outcome = AllowedOutcome(outcome='selected', optionId=option_id)
-        else:  # auto mode
-            approved = True
-            # Select the first 'allow' option if available
-            option_id = self._get_allow_option_id(params.options)
+        else:
+            kind = self._get_option_kind(params.options, option_id)
+            decision = 'denied' if kind in ('reject_once', 'reject_always') else 'allowed'
             outcome = AllowedOutcome(outcome='selected', optionId=option_id)
         
-        self._kernel._permission_history.append({
-            'request': str(params),
-            'approved': approved
-        })
+        self._kernel._permission_audit.record(PermissionRecord(
+            time.time(),
+            params.sessionId,
+            self._kernel._turn_index,
+            tool_call.toolCallId,
+            str(tool_call.kind) if tool_call.kind else None,
+            tool_call.title,
+            decision,
+            source,
+            option_id,
+            rule.index + 1 if rule is not None else None,
+            time.perf_counter() - started,
+        ))
         
         return RequestPermissionResponse(outcome=outcome)
     
+    async def _ask_permission(self, params):
+        """Have the user choose an option
+        
+        Returns the option ID (None if the turn was cancelled) and how it was
+        chosen. An 'always' answer is remembered for similar requests (same
+        tool kind and program) until the end of the turn.
+        """
+        key = remember_key(params)
+        remembered = self._turn_permissions.get(key)
+        if remembered is not None:
+            option_id = self._get_option_id(params.options, remembered)
+            if option_id is not None:
+                return option_id, 'remembered'
+        
+        # Show the text streamed so far before the question
+        if self._kernel._output_streamer is not None:
+            self._kernel._output_streamer.flush()
+        
+        prompt = PermissionPrompt(params, asyncio.get_running_loop())
+        if self._kernel._post_permission_prompt(prompt):
+            option_id = await prompt.future
+            source = prompt.source
+        else:
+            self._log.info("No frontend input available; using the default permission answer")
+            option_id = self._kernel._default_permission_option(params.options)
+            source = 'no-input'
+        
+        kind = self._get_option_kind(params.options, option_id)
+        if kind == 'allow_always':
+            self._turn_permissions[key] = ('allow_always', 'allow_once')
+        elif kind == 'reject_always':
+            self._turn_permissions[key] = ('reject_always', 'reject_once')
+        return option_id, source
+    
+    def _get_option_kind(self, options, option_id):
+        """The kind of the option with the given ID, or None"""
+        for option in options:
+            if option.optionId == option_id:
+                return option.kind
+        return None
+    
+    def _get_option_id(self, options, kinds):
+        """The ID of the first option of one of the given kinds, or None"""
+        for option in options:
+            if option.kind in kinds:
+                return option.optionId
+        return None
+    
     def _get_allow_option_id(self, options):
         """Get the first allow option ID from the permission options"""
         # Look for allow_once or allow_always options
-        for option in options:
-            if option.kind in ('allow_once', 'allow_always'):
-                return option.optionId
+        option_id = self._get_option_id(options, ('allow_once', 'allow_always'))
+        if option_id is not None:
+            return option_id
         # Fallback to the first option if no allow option is found
         if options:
             return options[0].optionId
@@ -111,11 +290,9 @@ class ACPClient(Client):
             if not file_path.is_absolute():
                 file_path = Path(self._kernel._session_cwd) / file_path
             
-            # Create parent directories if they don't exist
-            file_path.parent.mkdir(parents=True, exist_ok=True)
-            
-            # Write the content to the file
-            file_path.write_text(params.content, encoding='utf-8')
+            # Write atomically on the file I/O pool, creating parent
+            # directories if they don't exist
+            await self._kernel._file_io.write_text(file_path, params.content)
             
             self._log.info("Successfully wrote file: %s", file_path)
             return WriteTextFileResponse()
@@ -135,24 +312,19 @@ class ACPClient(Client):
             if not file_path.is_absolute():
                 file_path = Path(self._kernel._session_cwd) / file_path
             
-            # Check if file exists
-            if not file_path.exists():
+            # Read the file content on the file I/O pool. 'line' is the
+            # 1-based line to start at and 'limit' the number of lines; a
+            # range is read through the file's line index
+            line = params.line if params.line is not None and params.line > 0 else 1
+            limit = params.limit if params.limit is not None and params.limit > 0 else None
+            try:
+                if line == 1 and limit is None:
+                    content = await self._kernel._file_io.read_text(file_path)
+                else:
+                    content = await self._kernel._file_io.read_lines(file_path, line, limit)
+            except FileNotFoundError:
                 raise RequestError.invalid_params(f"File not found: {params.path}")
             
-            # Read the file content
-            content = file_path.read_text(encoding='utf-8')
-            
-            # Handle line parameter (read from specific line)
-            if params.line is not None:
-                lines = content.splitlines(keepends=True)
-                if params.line > 0 and params.line <= len(lines):
-                    # Get lines starting from the specified line
-                    content = ''.join(lines[params.line - 1:])
-            
-            # Handle limit parameter (limit number of characters)
-            if params.limit is not None and params.limit > 0:
-                content = content[:params.limit]
-            
             self._log.info("Successfully read file: %s (%d chars)", file_path, len(content))
             return ReadTextFileResponse(content=content)
         except RequestError:
@@ -164,14 +336,10 @@ class ACPClient(Client):
     async def createTerminal(self, params):
         """Handle terminal creation requests"""
         from acp.schema import CreateTerminalResponse
-        import uuid
         
         self._log.info("Creating terminal: %s %s", params.command, params.args or [])
         
         try:
-            # Generate a unique terminal ID
-            terminal_id = str(uuid.uuid4())
-            
             # Determine working directory
             cwd = params.cwd
             if cwd is None:
@@ -185,63 +353,35 @@ class ACPClient(Client):
                 for env_var in params.env:
                     env[env_var.name] = env_var.value
             
-            # Create the terminal process
-            process = await asyncio.create_subprocess_exec(
+            # The buffer keeps the last outputByteLimit bytes of output
+            output_byte_limit = params.outputByteLimit
+            if output_byte_limit is None:
+                output_byte_limit = 1024 * 1024  # Default 1MB
+            
+            # Create the terminal process in its own process group
+            terminal = await self._terminals.create(
                 params.command,
-                *(params.args or []),
-                stdin=aio_subprocess.PIPE,
-                stdout=aio_subprocess.PIPE,
-                stderr=aio_subprocess.STDOUT,  # Merge stderr into stdout
+                params.args or [],
                 cwd=cwd,
                 env=env,
+                output_byte_limit=output_byte_limit,
+                session_id=params.sessionId,
             )
+            self._turn_terminals.add(terminal.id)
+            self._kernel._mirror_terminal(terminal)
             
-            # Store terminal state
-            self._terminals[terminal_id] = {
-                'process': process,
-                'output_buffer': [],
-                'output_byte_limit': params.outputByteLimit or 1024 * 1024,  # Default 1MB
-                'total_bytes': 0,
-            }
-            
-            # Start reading output in the background
-            asyncio.create_task(self._read_terminal_output(terminal_id))
-            
-            self._log.info("Created terminal %s with PID %s", terminal_id, process.pid)
-            return CreateTerminalResponse(terminalId=terminal_id)
+            self._log.info("Created terminal %s with PID %s", terminal.id, terminal.pid)
+            return CreateTerminalResponse(terminalId=terminal.id)
         except Exception as e:
             self._log.error("Error creating terminal: %s", e)
             raise RequestError.internal_error(f"Failed to create terminal: {str(e)}")
     
-    async def _read_terminal_output(self, terminal_id):
-        """Background task to read terminal output"""
+    def _get_terminal(self, terminal_id):
+        """Look up a terminal, raising an ACP error if it is unknown"""
         terminal = self._terminals.get(terminal_id)
         if not terminal:
-            return
-        
-        process = terminal['process']
-        try:
-            while True:
-                # Read available output
-                chunk = await process.stdout.read(4096)
-                if not chunk:
-                    # Process has ended
-                    break
-                
-                # Check byte limit
-                if terminal['total_bytes'] + len(chunk) > terminal['output_byte_limit']:
-                    # Truncate to limit
-                    remaining = terminal['output_byte_limit'] - terminal['total_bytes']
-                    if remaining > 0:
-                        chunk = chunk[:remaining]
-                        terminal['output_buffer'].append(chunk)
-                        terminal['total_bytes'] += len(chunk)
-                    break
-                
-                terminal['output_buffer'].append(chunk)
-                terminal['total_bytes'] += len(chunk)
-        except Exception as e:
-            self._log.error("Error reading terminal output for %s: %s", terminal_id, e)
+            raise RequestError.invalid_params(f"Terminal not found: {terminal_id}")
+        return terminal
     
     async def terminalOutput(self, params):
         """Handle terminal output requests"""
@@ -250,32 +390,22 @@ class ACPClient(Client):
         terminal_id = params.terminalId
         self._log.info("Getting output for terminal: %s", terminal_id)
         
-        terminal = self._terminals.get(terminal_id)
-        if not terminal:
-            raise RequestError.invalid_params(f"Terminal not found: {terminal_id}")
+        terminal = self._get_terminal(terminal_id)
         
-        process = terminal['process']
-        
-        # Get all buffered output
-        output_bytes = b''.join(terminal['output_buffer'])
-        output = output_bytes.decode('utf-8', errors='replace')
-        
-        # Clear the buffer after reading
-        terminal['output_buffer'] = []
+        # The output so far; reading does not consume it, and only bytes
+        # written since the last poll are decoded
+        output = terminal.output()
         
         # Check if process has exited
         exit_status = None
-        truncated = terminal['total_bytes'] >= terminal['output_byte_limit']
-        
-        if process.returncode is not None:
-            exit_status = TerminalExitStatus(
-                exitCode=process.returncode,
-                signal=None  # Unix signals not easily accessible in asyncio
-            )
+        status = terminal.exit_status()
+        if status is not None:
+            exit_code, signal_name = status
+            exit_status = TerminalExitStatus(exitCode=exit_code, signal=signal_name)
         
         return TerminalOutputResponse(
             output=output,
-            truncated=truncated,
+            truncated=terminal.output_buffer.truncated,
             exitStatus=exit_status
         )
     
@@ -286,17 +416,8 @@ class ACPClient(Client):
         terminal_id = params.terminalId
         self._log.info("Releasing terminal: %s", terminal_id)
         
-        terminal = self._terminals.get(terminal_id)
-        if terminal:
-            process = terminal['process']
-            
-            # Close stdin if still open
-            if process.stdin and not process.stdin.is_closing():
-                process.stdin.close()
-            
-            # Remove from tracking
-            del self._terminals[terminal_id]
-            
+        # Kill the command and its process group if still running, then forget it
+        if await self._terminals.release(terminal_id):
             self._log.info("Released terminal %s", terminal_id)
         
         return ReleaseTerminalResponse()
@@ -308,21 +429,15 @@ class ACPClient(Client):
         terminal_id = params.terminalId
         self._log.info("Waiting for terminal exit: %s", terminal_id)
         
-        terminal = self._terminals.get(terminal_id)
-        if not terminal:
-            raise RequestError.invalid_params(f"Terminal not found: {terminal_id}")
-        
-        process = terminal['process']
+        terminal = self._get_terminal(terminal_id)
         
-        # Wait for the process to complete
-        await process.wait()
+        # Wait for the process to complete and its output to be drained
+        await self._terminals.wait(terminal)
         
-        self._log.info("Terminal %s exited with code %s", terminal_id, process.returncode)
+        exit_code, signal_name = terminal.exit_status()
+        self._log.info("Terminal %s exited with code %s signal %s", terminal_id, exit_code, signal_name)
         
-        return WaitForTerminalExitResponse(
-            exitCode=process.returncode,
-            signal=None  # Unix signals not easily accessible in asyncio
-        )
+        return WaitForTerminalExitResponse(exitCode=exit_code, signal=signal_name)
     
     async def killTerminal(self, params):
         """Handle terminal kill requests"""
@@ -331,24 +446,10 @@ class ACPClient(Client):
         terminal_id = params.terminalId
         self._log.info("Killing terminal: %s", terminal_id)
         
-        terminal = self._terminals.get(terminal_id)
-        if not terminal:
-            raise RequestError.invalid_params(f"Terminal not found: {terminal_id}")
-        
-        process = terminal['process']
+        terminal = self._get_terminal(terminal_id)
         
         try:
-            # Try graceful termination first
-            process.terminate()
-            
-            # Wait a bit for graceful shutdown
-            try:
-                await asyncio.wait_for(process.wait(), timeout=2.0)
-            except asyncio.TimeoutError:
-                # Force kill if termination didn't work
-                process.kill()
-                await process.wait()
-            
+            await self._terminals.kill(terminal)
             self._log.info("Killed terminal %s", terminal_id)
         except Exception as e:
             self._log.error("Error killing terminal %s: %s", terminal_id, e)
@@ -356,8 +457,40 @@ class ACPClient(Client):
         
         return KillTerminalCommandResponse()
     
+    def begin_turn(self):
+        """Start tracking the resources of a new prompt turn"""
+        self._turn_terminals = set()
+        self._turn_permissions = {}
+        self._turn_cancelled = False
+    
+    async def kill_turn_terminals(self, timeout):
+        """Kill the terminals spawned during the current turn"""
+        self._terminals.cancel_pending()
+        terminals = []
+        for terminal_id in self._turn_terminals:
+            terminal = self._terminals.get(terminal_id)
+            if terminal and terminal.process.returncode is None:
+                self._log.info("Killing terminal %s for cancelled turn", terminal_id)
+                terminals.append(terminal)
+        self._turn_terminals = set()
+        
+        if terminals:
+            await asyncio.gather(
+                *(self._terminals.kill(terminal, timeout) for terminal in terminals),
+                return_exceptions=True,
+            )
+    
+    async def close_terminals(self, timeout=None):
+        """Kill and reap every terminal, e.g. when the agent is shut down"""
+        self._turn_terminals = set()
+        await self._terminals.close(timeout)
+    
     async def sessionUpdate(self, params: SessionNotification) -> None:
         """Handle session updates from the agent"""
+        self._handle_session_update(params)
+    
+    def _handle_session_update(self, params: SessionNotification) -> None:
+        """Route a session update to the kernel"""
         update = params.update
         if isinstance(update, dict):
             kind = update.get("sessionUpdate")
@@ -366,7 +499,11 @@ class ACPClient(Client):
             kind = getattr(update, "sessionUpdate", None)
             content = getattr(update, "content", None)
         
-        if kind != "agent_message_chunk" or content is None:
+        # Replayed history is not part of this session's timeline
+        if not self._kernel._replaying:
+            self._kernel._event_log.record(self._kernel._turn_index, update)
+        
+        if kind not in ("agent_message_chunk", "user_message_chunk") or content is None:
             return
         
         if isinstance(content, dict):
@@ -374,9 +511,16 @@ class ACPClient(Client):
         else:
             text = getattr(content, "text", "")
         
-        if text:
+        if not text:
+            return
+        
+        if self._kernel._replaying:
+            # History replayed by loadSession goes to the transcript only
+            role = 'user' if kind == "user_message_chunk" else 'agent'
+            self._kernel._record_transcript(role, text)
+        elif kind == "agent_message_chunk":
             # Send output to notebook
-            self._kernel._agent_output.append(text)
+            self._kernel._on_agent_text(text)
     
     async def extMethod(self, method: str, params: dict) -> dict:
         """Handle extension method calls"""
@@ -387,6 +531,29 @@ class ACPClient(Client):
         pass
 
 
+class ACPClientConnection(ClientSideConnection):
+    """Client-side connection that reports session update dispatch to the client
+
+    Updates are counted around the whole dispatch rather than in
+    sessionUpdate, so one that fails validation (and so never reaches
+    sessionUpdate) is still counted as handled.
+    """
+    
+    def _create_handler(self, client):
+        handler = super()._create_handler(client)
+        
+        async def counting_handler(method, params, is_notification):
+            if not (is_notification and method == CLIENT_METHODS['session_update']):
+                return await handler(method, params, is_notification)
+            seq = client._update_dispatched()
+            try:
+                return await handler(method, params, is_notification)
+            finally:
+                client._update_finished(seq)
+        
+        return counting_handler
+
+
 class ACPKernel(MetaKernel):
     """Jupyter kernel for Agent Client Protocol"""
     
@@ -418,24 +585,204 @@ class ACPKernel(MetaKernel):
         # ACP connection tracking
         self._session_id = None
         self._conn = None
+        self._client = None
         self._proc = None
-        self._agent_output = []
-        self._event_loop = None
+        self._start_task = None
+        self._agent_output = None
+        self._output_streamer = None
+        self._streamed_chars = 0
+        
+        # All agent traffic runs on one long-lived event loop in a background
+        # thread; cells submit coroutines to it and block on the result
+        self._engine = EventLoopThread()
+        self._engine.start()
+        
+        # Output streaming - chunks are written to the cell as they arrive,
+        # coalesced so that no more than one write happens per interval/size
+        self._stream_output = _env_flag('ACP_STREAM_OUTPUT', True)
+        self._stream_flush_interval = float(os.environ.get('ACP_STREAM_FLUSH_INTERVAL', '0.1'))
+        self._stream_flush_size = int(os.environ.get('ACP_STREAM_FLUSH_SIZE', '4096'))
+        
+        # Response buffering - large responses spill to a temporary file and
+        # the cell only gets their head and tail
+        self._output_spill_bytes = int(os.environ.get('ACP_OUTPUT_SPILL_BYTES', str(8 * 1024 * 1024)))
+        self._output_head_chars = int(os.environ.get('ACP_OUTPUT_HEAD_CHARS', '20000'))
+        self._output_tail_chars = int(os.environ.get('ACP_OUTPUT_TAIL_CHARS', '20000'))
+        
+        # Upper bound on waiting for late session updates after a prompt returns
+        self._drain_timeout = float(os.environ.get('ACP_DRAIN_TIMEOUT', '5.0'))
+        
+        # Deadline for an interrupted turn to wind down before it is abandoned
+        self._interrupt_timeout = float(os.environ.get('ACP_INTERRUPT_TIMEOUT', '3.0'))
+        self._last_stop_reason = None
         
         # Agent configuration - can be overridden via environment variables
         self._agent_command = os.environ.get('ACP_AGENT_COMMAND', 'codex-acp')
         self._agent_args = os.environ.get('ACP_AGENT_ARGS', '').split() if os.environ.get('ACP_AGENT_ARGS') else []
         
+        # Terminal limits - commands the agent runs are queued once the
+        # per-session or per-kernel cap is reached (0 = unlimited) and can be
+        # started with a lower priority and resource limits
+        self._terminal_scheduler = TerminalScheduler(
+            max_total=int(os.environ.get('ACP_TERMINAL_MAX_TOTAL', '0')),
+            max_per_session=int(os.environ.get('ACP_TERMINAL_MAX_PER_SESSION', '0')),
+        )
+        self._terminal_nice = int(os.environ.get('ACP_TERMINAL_NICE', '0'))
+        try:
+            self._terminal_rlimits = parse_rlimits(os.environ.get('ACP_TERMINAL_RLIMITS', ''))
+        except ValueError as e:
+            self._log.error("Ignoring ACP_TERMINAL_RLIMITS: %s", e)
+            self._terminal_rlimits = []
+        
+        # Run commands on a pseudo-terminal so tools that buffer output on a
+        # pipe flush it line by line; optionally strip ANSI escape sequences
+        self._terminal_pty = _env_flag('ACP_TERMINAL_PTY')
+        self._terminal_strip_ansi = _env_flag('ACP_TERMINAL_STRIP_ANSI')
+        
+        # Optionally start commands from a small helper process instead of
+        # forking the (large) kernel process for each one
+        self._spawn_server = SpawnServer() if _env_flag('ACP_TERMINAL_SPAWN_SERVER') else None
+        
+        # Live view of the agent's terminals in the running cell (opt-in)
+        self._terminal_mirror = _env_flag('ACP_TERMINAL_MIRROR')
+        self._terminal_mirror_interval = float(os.environ.get('ACP_TERMINAL_MIRROR_INTERVAL', '1.0'))
+        self._terminal_mirror_lines = int(os.environ.get('ACP_TERMINAL_MIRROR_LINES', '20'))
+        self._terminal_mirrors = None
+        
+        # File requests from the agent run on a bounded thread pool; writes
+        # replace the target atomically, with a configurable fsync policy, and
+        # repeated reads of unchanged files are served from a content cache
+        fsync = os.environ.get('ACP_FILE_FSYNC', 'file').strip().lower()
+        if fsync not in FSYNC_POLICIES:
+            self._log.error("Ignoring ACP_FILE_FSYNC=%s (expected one of %s)", fsync, ', '.join(FSYNC_POLICIES))
+            fsync = 'file'
+        self._file_io = FileIO(
+            max_workers=int(os.environ.get('ACP_FILE_IO_WORKERS', '4')),
+            fsync=fsync,
+            cache_bytes=int(os.environ.get('ACP_FILE_CACHE_BYTES', str(64 * 1024 * 1024))),
+        )
+        
         # Session configuration
         self._session_cwd = os.getcwd()
         self._mcp_servers = []
         
+        # MCP servers are probed with an initialize handshake before a
+        # session starts; ones that fail outright are left out of it
+        self._mcp_preflight = _env_flag('ACP_MCP_PREFLIGHT', True)
+        self._mcp_probe = McpProbe(
+            timeout=float(os.environ.get('ACP_MCP_PROBE_TIMEOUT', '10')),
+            ttl=float(os.environ.get('ACP_MCP_PROBE_TTL', '300')),
+        )
+        self._mcp_warnings = []
+        
+        # Optionally share one instance of each MCP server among all local
+        # kernels through a broker, for agents that can connect over HTTP
+        self._mcp_broker = None
+        if _env_flag('ACP_MCP_BROKER'):
+            self._mcp_broker = McpBroker(
+                state_path=os.environ.get('ACP_MCP_BROKER_STATE') or None,
+                idle_timeout=float(os.environ.get('ACP_MCP_BROKER_IDLE', '60')),
+            )
+        
         # Permission configuration
         self._permission_mode = 'auto'
-        self._permission_history = []
+        
+        # Audit log of permission decisions: a bounded in-memory ring, and
+        # optionally a rotating JSONL file written from a background thread
+        audit_path = os.environ.get('ACP_PERMISSION_AUDIT_FILE', '').strip() or None
+        try:
+            self._permission_audit = PermissionAuditLog(
+                max_records=int(os.environ.get('ACP_PERMISSION_LOG_SIZE', '1000')),
+                path=audit_path,
+                max_bytes=int(os.environ.get('ACP_PERMISSION_AUDIT_MAX_BYTES', str(10 * 1024 * 1024))),
+                backup_count=int(os.environ.get('ACP_PERMISSION_AUDIT_BACKUPS', '5')),
+            )
+        except OSError as e:
+            self._log.error("Cannot open permission audit file %s: %s", audit_path, e)
+            self._permission_audit = PermissionAuditLog(
+                max_records=int(os.environ.get('ACP_PERMISSION_LOG_SIZE', '1000')),
+            )
+        
+        # Manual approval: requests are answered on the main thread through
+        # the frontend's stdin channel while a cell waits on the agent; with
+        # no answer in time (or no stdin) the default answer is used
+        self._permission_prompt_timeout = float(os.environ.get('ACP_PERMISSION_PROMPT_TIMEOUT', '60'))
+        self._permission_prompt_default = os.environ.get('ACP_PERMISSION_PROMPT_DEFAULT', 'deny').strip().lower()
+        if self._permission_prompt_default not in ('allow', 'deny'):
+            self._log.error("Ignoring ACP_PERMISSION_PROMPT_DEFAULT=%s (expected allow or deny)",
+                            self._permission_prompt_default)
+            self._permission_prompt_default = 'deny'
+        self._permission_prompts = queue.Queue()
+        self._permission_prompts_lock = threading.Lock()
+        self._servicing_prompts = False
+        
+        # Optional rule-based permission policy, loaded from a JSON file
+        self._permission_policy = None
+        policy_path = os.environ.get('ACP_PERMISSION_POLICY', '').strip()
+        if policy_path:
+            try:
+                self._permission_policy = PermissionPolicy.load(policy_path)
+            except ValueError as e:
+                self._log.error("Ignoring ACP_PERMISSION_POLICY: %s", e)
+        
+        # Session resume - the session id and cwd are persisted so a restarted
+        # agent or kernel can continue the conversation through loadSession
+        self._resume_sessions = _env_flag('ACP_SESSION_RESUME', True)
+        self._session_store = SessionStore(os.environ.get('ACP_SESSION_STORE') or None)
+        self._session_command = None  # Agent command the current session belongs to
+        self._resume_session_id = None
+        self._session_resumed = False
+        self._replaying = False
+        self._transcript = []
+        self._agent_capabilities = None
+        
+        # Stored sessions are keyed per notebook. Without a notebook name
+        # (nbconvert, papermill, consoles) the key falls back to the cwd,
+        # which unrelated runs share, so a stored session is then only
+        # continued when ACP_SESSION_RESUME is set explicitly
+        self._session_scope = os.environ.get('JPY_SESSION_NAME')
+        self._resume_stored = self._resume_sessions and (
+            self._session_scope is not None or _env_flag('ACP_SESSION_RESUME')
+        )
+        if self._session_scope is None:
+            self._session_scope = os.getcwd()
+        if self._resume_stored:
+            record = self._session_store.load(self._session_key())
+            if record and os.path.isdir(record.get('cwd') or ''):
+                self._resume_session_id = record['session_id']
+                self._session_cwd = record['cwd']
+        
+        # Timeline of session updates (tool calls, plans, thoughts, ...) kept
+        # in a bounded ring buffer for '%agent events'
+        self._event_log = EventLog(max_events=int(os.environ.get('ACP_EVENT_LOG_SIZE', '2000')))
+        
+        # Optional cache of recorded responses, used to replay deterministic
+        # notebook runs (e.g. in CI) without spawning the agent
+        self._turn_index = 0
+        self._response_cache = None
+        cache_setting = os.environ.get('ACP_RESPONSE_CACHE', '').strip()
+        if cache_setting and cache_setting.lower() not in ('0', 'false', 'no', 'off'):
+            cache_path = None if cache_setting.lower() in ('1', 'true', 'yes', 'on') else cache_setting
+            self._response_cache = ResponseCache(
+                cache_path,
+                max_bytes=int(os.environ.get('ACP_RESPONSE_CACHE_MAX_BYTES', str(256 * 1024 * 1024))),
+            )
+        
+        # Warm spare: keep one agent process initialized and waiting so that
+        # session new/restart can swap it in instead of cold starting
+        self._warm_spare = _env_flag('ACP_WARM_SPARE')
+        self._spare = None
+        self._spare_task = None
+        self._retiring = set()
         
         # Load custom magics
         self._load_magics()
+        
+        # Optionally spawn and initialize the agent right away so the first
+        # cell does not pay for a cold start
+        if _env_flag('ACP_EAGER_START'):
+            self._log.info("Eagerly starting agent in the background")
+            self._engine.submit(self._start_agent())
     
     def _load_magics(self):
         """Load custom magic commands"""
@@ -465,22 +812,45 @@ Use '%agent' with subcommands to manage configuration and sessions:
   MCP Server Configuration:
     %agent mcp add NAME COMMAND [ARGS...]  - add MCP server
     %agent mcp list                        - list MCP servers
+    %agent mcp check [NAME]                - probe MCP servers now
+    %agent mcp broker                      - show the shared MCP broker
     %agent mcp remove NAME                 - remove MCP server
     %agent mcp clear                       - clear all MCP servers
 
   Permission Configuration:
     %agent permissions [auto|manual|deny]  - set permission mode
-    %agent permissions list                - show permission history
+    %agent permissions list [FILTERS]      - show recent permission decisions
+    %agent permissions policy [show|load PATH|reload|clear|test ...]
+                                           - manage the rule-based policy
 
   Session Management:
     %agent session new [CWD]               - create new session
     %agent session info                    - show session information
     %agent session restart                 - restart current session
+    %agent session transcript [N]          - show session transcript
 
   Agent Configuration:
     %agent config [COMMAND [ARGS...]]     - configure agent command
     %agent env [KEY=VALUE]                 - set environment variables
 
+  Response Cache:
+    %agent cache [info|clear]              - show or clear the response cache
+
+  Response Output:
+    %agent output [info]                   - show the size of the last response
+    %agent output save PATH                - save the whole last response
+
+  Event Log:
+    %agent events [TURN|all]               - show the timeline of a turn
+    %agent events tools [TURN|all]         - show tool-call durations
+
+  Terminals:
+    %agent terminals                       - show running and queued terminals
+    %agent terminals mirror [on|off]       - mirror terminal output into the cell
+
+  File Access:
+    %agent files [info|clear]              - show file I/O and cache statistics
+
 For detailed help: %agent (shows all subcommands)
 For help on any magic: %agent?
 
@@ -564,13 +934,24 @@ Commands:
       Example: %agent mcp add filesystem /usr/local/bin/mcp-server-filesystem
       
   %agent mcp list
-      List all configured MCP servers
+      List all configured MCP servers and their last check result
+      
+  %agent mcp check [NAME]
+      Start each server (or only NAME) and send it an MCP initialize request
+      
+  %agent mcp broker
+      Show the shared MCP broker (ACP_MCP_BROKER=1) and the servers it runs
       
   %agent mcp remove NAME
       Remove a specific MCP server by name
       
   %agent mcp clear
       Remove all configured MCP servers
+
+Servers are checked when added and before each session starts. Ones that
+cannot be started, exit or reject initialize are left out of the session
+with a warning; ones that do not answer within ACP_MCP_PROBE_TIMEOUT seconds
+are kept, with a warning. Set ACP_MCP_PREFLIGHT=0 to skip the checks.
 """
         
         elif subcommand == 'session':
@@ -587,7 +968,12 @@ Commands:
       Display information about the current session
       
   %agent session restart
-      Restart the current session with the same configuration
+      Restart the current session with the same configuration. If the agent
+      supports loadSession, the conversation is resumed rather than lost.
+      
+  %agent session transcript [N]
+      Show the last N transcript entries (default 20), including history
+      replayed when a session is resumed
 """
         
         elif subcommand == 'permissions':
@@ -599,11 +985,39 @@ Commands:
   %agent permissions [auto|manual|deny]
       Set the permission mode:
       - auto: automatically approve all requests (default)
-      - manual: prompt for each request (not yet implemented)
+      - manual: prompt for each request in the notebook
       - deny: automatically deny all requests
       
-  %agent permissions list
-      Show the history of permission requests
+  %agent permissions list [N|all] [allowed|denied|cancelled] [kind=KIND] [turn=N|last] [source=SOURCE]
+      Show the last N (default 10) recorded decisions, optionally filtered
+      by outcome, tool kind, turn or what decided them (policy, mode:auto,
+      prompt, timeout, remembered, ...)
+      
+  %agent permissions policy [show]
+      Show the rule-based policy and its decision cache statistics
+      
+  %agent permissions policy load PATH | reload | clear
+      Load a policy from a JSON file, reload it, or remove it
+      
+  %agent permissions policy test KIND [PATH|COMMAND]
+      Show which rule decides a request (COMMAND for kind 'execute')
+
+A policy is a list of rules matched in order on the tool kind, the paths the
+tool call touches (globs, '{cwd}' is the session directory), the command it
+runs and its title, each rule deciding allow, deny or ask. Requests no rule
+matches follow the policy's default or, without one, the permission mode.
+ACP_PERMISSION_POLICY=PATH loads a policy when the kernel starts.
+
+In manual mode (and for 'ask' rules) the kernel shows the request and its
+options and asks for a choice through the notebook's input box. Without an
+answer within ACP_PERMISSION_PROMPT_TIMEOUT seconds (default 60, 0 = wait
+forever) the ACP_PERMISSION_PROMPT_DEFAULT answer (deny or allow) is used.
+An 'always' answer applies to similar requests for the rest of the turn.
+
+Decisions are kept in a ring of ACP_PERMISSION_LOG_SIZE records (default
+1000). Set ACP_PERMISSION_AUDIT_FILE to also append them as JSON lines to a
+file, rotated at ACP_PERMISSION_AUDIT_MAX_BYTES with
+ACP_PERMISSION_AUDIT_BACKUPS old files kept.
 """
         
         elif subcommand == 'config':
@@ -619,6 +1033,94 @@ Commands:
       Without arguments, displays the current configuration
 """
         
+        elif subcommand == 'cache':
+            return """Response Cache
+
+When ACP_RESPONSE_CACHE is set, responses are recorded on disk and replayed
+for identical prompts (same prompt text, agent command/args, MCP servers and
+turn index) without starting the agent.
+
+Commands:
+  %agent cache [info]
+      Show cache location, size and hit/miss counts
+      
+  %agent cache clear
+      Remove all recorded responses
+"""
+        
+        elif subcommand == 'output':
+            return """Response Output
+
+Responses longer than ACP_OUTPUT_HEAD_CHARS + ACP_OUTPUT_TAIL_CHARS characters
+are shown in the cell as their head and tail only. Responses larger than
+ACP_OUTPUT_SPILL_BYTES are kept in a temporary file instead of memory. The
+last response is available until the next prompt.
+
+Commands:
+  %agent output [info]
+      Show the size of the last response and where it is stored
+      
+  %agent output save PATH
+      Write the whole last response to PATH
+"""
+        
+        elif subcommand == 'events':
+            return """Event Log
+
+Every session update from the agent (message and thought chunks, tool calls,
+tool-call updates, plans, mode changes) is recorded with a timestamp in a
+ring buffer of ACP_EVENT_LOG_SIZE events (default 2000). Consecutive chunks
+are folded into one event.
+
+Commands:
+  %agent events [TURN|all]
+      Show the timeline of a turn, relative to its first event
+      Without arguments, shows the last turn
+      
+  %agent events tools [TURN|all]
+      Show tool calls with their status and duration
+      
+  %agent events clear
+      Clear the event log
+"""
+        
+        elif subcommand == 'terminals':
+            return """Terminals
+
+Commands the agent runs are limited by ACP_TERMINAL_MAX_PER_SESSION and
+ACP_TERMINAL_MAX_TOTAL (0 = unlimited); requests over a limit wait in a FIFO
+queue. ACP_TERMINAL_NICE and ACP_TERMINAL_RLIMITS (e.g. cpu=600,as=4G) are
+applied to each command. ACP_TERMINAL_PTY=1 runs commands on a pseudo-terminal
+and ACP_TERMINAL_STRIP_ANSI=1 removes escape sequences from their output.
+ACP_TERMINAL_SPAWN_SERVER=1 starts commands from a small helper process.
+ACP_TERMINAL_MIRROR=1 shows a live view of each command in the running cell
+(or use '%agent terminals mirror on').
+
+Commands:
+  %agent terminals
+      Show the limits, queue depth, wait times and the current terminals
+      
+  %agent terminals mirror [on|off]
+      Show or set live mirroring of terminal output into the running cell
+"""
+        
+        elif subcommand == 'files':
+            return """File Access
+
+Files the agent reads and writes run on a thread pool of ACP_FILE_IO_WORKERS
+threads; writes atomically replace the target and are synced according to
+ACP_FILE_FSYNC (none, file or full). Whole-file reads are cached, up to
+ACP_FILE_CACHE_BYTES in total (0 disables the cache), while the file is
+unchanged.
+
+Commands:
+  %agent files [info]
+      Show read/write counts and cache hits, misses and bytes saved
+      
+  %agent files clear
+      Empty the file content cache
+"""
+        
         elif subcommand == 'env':
             return """Environment Variables
 
@@ -636,112 +1138,613 @@ Commands:
             return None
     
     async def _start_agent(self):
-        """Start the ACP agent process"""
-        if self._proc is not None:
-            return
-        
-        self._log.info("Starting agent: %s %s", self._agent_command, ' '.join(self._agent_args))
+        """Start the ACP agent process, joining a startup already in progress"""
+        if self._start_task is None:
+            if self._proc is not None:
+                return
+            self._start_task = asyncio.ensure_future(self._launch_agent())
+            self._start_task.add_done_callback(self._on_start_done)
+        
+        # Shield the shared startup so an interrupted cell does not abort it
+        await asyncio.shield(self._start_task)
+    
+    def _on_start_done(self, task):
+        """Clear the startup task, logging failures nobody awaited"""
+        if self._start_task is task:
+            self._start_task = None
+        if not task.cancelled() and task.exception() is not None:
+            self._log.debug("Agent startup failed: %s", task.exception())
+    
+    async def _launch_agent(self):
+        """Spawn the agent, initialize it and open a session"""
+        # Check the MCP servers while the agent starts
+        servers = list(self._mcp_servers)
+        probe_task = None
+        if self._mcp_preflight and servers:
+            probe_task = asyncio.ensure_future(
+                self._mcp_probe.probe_all(servers, self._session_cwd)
+            )
         
         try:
-            # Find the agent executable
-            program_path = Path(self._agent_command)
-            spawn_program = self._agent_command
-            spawn_args = self._agent_args
+            # Prefer the warm spare, which is already past initialize
+            agent = self._take_spare()
+            if agent is None:
+                agent = await self._spawn_agent()
+            else:
+                self._log.info("Using warm spare agent (PID %s)", agent['proc'].pid)
             
-            if program_path.exists() and not os.access(program_path, os.X_OK):
-                spawn_program = sys.executable
-                spawn_args = [str(program_path), *self._agent_args]
+            self._proc = agent['proc']
+            self._conn = agent['conn']
+            self._client = agent['client']
+            self._agent_capabilities = agent['init'].agentCapabilities
             
-            # Start the agent process
-            self._proc = await asyncio.create_subprocess_exec(
-                spawn_program,
-                *spawn_args,
-                stdin=aio_subprocess.PIPE,
-                stdout=aio_subprocess.PIPE,
-                stderr=aio_subprocess.PIPE,
-            )
+            # Create a new session with MCP servers
+            mcp_servers = await self._session_mcp_servers(await self._usable_mcp_servers(servers, probe_task))
+            
+            # Resume the previous session if the agent supports it, so the
+            # conversation context does not have to be primed again
+            self._session_resumed = await self._load_session(mcp_servers)
+            if not self._session_resumed:
+                session = await self._conn.newSession(
+                    NewSessionRequest(mcpServers=mcp_servers, cwd=self._session_cwd)
+                )
+                self._session_id = session.sessionId
+                self._transcript = []
+                self._event_log.clear()
+            
+            self._resume_session_id = None
+            self._session_command = self._agent_command
+            if self._resume_sessions:
+                self._session_store.save(self._session_key(), self._session_id, self._session_cwd)
             
-            if self._proc.stdin is None or self._proc.stdout is None:
+            self._log.info("Agent started with session ID: %s", self._session_id)
+        except Exception as e:
+            # Clean up on failure to prevent inconsistent state
+            self._log.error("Failed to start agent: %s", e)
+            if probe_task is not None:
+                probe_task.cancel()
+            await self._stop_agent()
+            raise
+        
+        # Get the next agent ready while this one is in use
+        self._refill_spare()
+    
+    async def _usable_mcp_servers(self, servers, probe_task):
+        """The servers probed by probe_task, less those that failed outright
+        
+        A server that only timed out is kept, since it may just be slow to
+        start (an npx server on its first run, say).
+        """
+        if probe_task is None:
+            return servers
+        try:
+            results = await probe_task
+        except Exception as e:
+            self._log.error("MCP pre-flight check failed: %s", e)
+            return servers
+        
+        usable = []
+        for server, result in zip(servers, results):
+            if result.ok:
+                usable.append(server)
+            elif result.timed_out:
+                usable.append(server)
+                message = f"MCP server '{server['name']}' may not be working: {result.error}"
+                self._log.warning("%s", message)
+                self._mcp_warnings.append(message)
+            else:
+                message = f"MCP server '{server['name']}' left out of the session: {result.error}"
+                self._log.warning("%s", message)
+                self._mcp_warnings.append(message)
+        return usable
+    
+    async def _session_mcp_servers(self, servers):
+        """The McpServer entries to pass to the agent for a new session
+        
+        With the broker enabled and an agent that accepts HTTP MCP servers,
+        each server is served by the shared broker; otherwise, or if the
+        broker cannot serve it, the agent starts the server itself.
+        """
+        from acp.schema import HttpHeader, HttpMcpServer, StdioMcpServer
+        
+        capabilities = self._agent_capabilities
+        mcp_capabilities = getattr(capabilities, 'mcpCapabilities', None)
+        use_broker = (
+            self._mcp_broker is not None
+            and mcp_capabilities is not None
+            and mcp_capabilities.http
+        )
+        if self._mcp_broker is not None and servers and not use_broker:
+            self._log.info("Agent does not accept HTTP MCP servers; not using the MCP broker")
+        
+        async def session_server(server_config):
+            if use_broker:
+                try:
+                    url, headers = await self._mcp_broker.register(server_config, self._session_cwd)
+                    return HttpMcpServer(
+                        name=server_config['name'],
+                        url=url,
+                        headers=[HttpHeader(name=name, value=value) for name, value in headers],
+                        type='http',
+                    )
+                except Exception as e:
+                    message = (
+                        f"MCP broker cannot serve '{server_config['name']}', "
+                        f"so the agent starts it: {e}"
+                    )
+                    self._log.warning("%s", message)
+                    self._mcp_warnings.append(message)
+            return StdioMcpServer(
+                name=server_config['name'],
+                command=server_config['command'],
+                args=server_config['args'],
+                env=server_config.get('env', [])
+            )
+        
+        return list(await asyncio.gather(*(session_server(server) for server in servers)))
+    
+    def _report_mcp_warnings(self):
+        """Show MCP server problems from the last session start in the cell"""
+        warnings, self._mcp_warnings = self._mcp_warnings, []
+        for message in warnings:
+            self.Error(f"Warning: {message}")
+    
+    def _session_key(self):
+        """The session store key for the current notebook and agent"""
+        return '{}::{}'.format(self._session_scope, self._agent_command)
+    
+    def _remembered_session(self):
+        """The stored session id for the current agent, if it ran in the current cwd"""
+        if not self._resume_stored:
+            return None
+        record = self._session_store.load(self._session_key())
+        if record and record.get('cwd') == self._session_cwd:
+            return record['session_id']
+        return None
+    
+    async def _load_session(self, mcp_servers):
+        """Try to resume the remembered session with ACP loadSession
+        
+        Returns True if the session was loaded.
+        """
+        session_id = self._resume_session_id
+        if not session_id or not self._resume_sessions:
+            return False
+        
+        capabilities = self._agent_capabilities
+        if capabilities is None or not capabilities.loadSession:
+            self._log.info("Agent does not support loadSession; starting a new session")
+            return False
+        
+        self._log.info("Resuming session %s", session_id)
+        self._transcript = []
+        self._replaying = True
+        try:
+            await self._conn.loadSession(
+                LoadSessionRequest(sessionId=session_id, cwd=self._session_cwd, mcpServers=mcp_servers)
+            )
+            # Let the replayed history land in the transcript before live
+            # updates start going to cells
+            await self._client.drain_updates(self._drain_timeout)
+        except Exception as e:
+            self._log.warning("Failed to resume session %s: %s", session_id, e)
+            return False
+        finally:
+            self._replaying = False
+        
+        self._session_id = session_id
+        return True
+    
+    def _record_transcript(self, role, text):
+        """Append text to the session transcript, merging consecutive chunks"""
+        if self._transcript and self._transcript[-1]['role'] == role:
+            self._transcript[-1]['text'] += text
+        else:
+            self._transcript.append({'role': role, 'text': text})
+    
+    def _agent_config_key(self):
+        """Key identifying the agent configuration a process was spawned with"""
+        return (
+            self._agent_command,
+            tuple(self._agent_args),
+            tuple(sorted(os.environ.items())),
+        )
+    
+    async def _spawn_agent(self):
+        """Spawn an agent process and run the initialize handshake
+        
+        Returns a dict holding the process, its connection and client.
+        """
+        self._log.info("Starting agent: %s %s", self._agent_command, ' '.join(self._agent_args))
+        
+        key = self._agent_config_key()
+        
+        # Find the agent executable
+        program_path = Path(self._agent_command)
+        spawn_program = self._agent_command
+        spawn_args = self._agent_args
+        
+        if program_path.exists() and not os.access(program_path, os.X_OK):
+            spawn_program = sys.executable
+            spawn_args = [str(program_path), *self._agent_args]
+        
+        # Start the agent process
+        proc = await asyncio.create_subprocess_exec(
+            spawn_program,
+            *spawn_args,
+            stdin=aio_subprocess.PIPE,
+            stdout=aio_subprocess.PIPE,
+            stderr=aio_subprocess.PIPE,
+        )
+        agent = {'proc': proc, 'conn': None, 'client': None, 'init': None, 'key': key}
+        
+        try:
+            if proc.stdin is None or proc.stdout is None:
                 raise RuntimeError("Agent process does not expose stdio pipes")
             
             # Create client connection
             client_impl = ACPClient(self)
-            self._conn = ClientSideConnection(
+            agent['client'] = client_impl
+            agent['conn'] = ACPClientConnection(
                 lambda _agent: client_impl,
-                self._proc.stdin,
-                self._proc.stdout
+                proc.stdin,
+                proc.stdout,
+                observers=[client_impl._observe_message],
             )
             
             # Initialize the agent
-            await self._conn.initialize(
+            agent['init'] = await agent['conn'].initialize(
                 InitializeRequest(protocolVersion=PROTOCOL_VERSION, clientCapabilities=None)
             )
-            
-            # Create a new session with MCP servers
-            from acp.schema import StdioMcpServer
-            
-            mcp_servers = []
-            for server_config in self._mcp_servers:
-                mcp_servers.append(StdioMcpServer(
-                    name=server_config['name'],
-                    command=server_config['command'],
-                    args=server_config['args'],
-                    env=server_config.get('env', [])
-                ))
-            
-            session = await self._conn.newSession(
-                NewSessionRequest(mcpServers=mcp_servers, cwd=self._session_cwd)
-            )
-            self._session_id = session.sessionId
-            
-            self._log.info("Agent started with session ID: %s", self._session_id)
-        except Exception as e:
-            # Clean up on failure to prevent inconsistent state
-            self._log.error("Failed to start agent: %s", e)
-            await self._stop_agent()
+        except BaseException:
+            await self._shutdown_agent(agent)
             raise
+        
+        return agent
+    
+    async def _shutdown_agent(self, agent):
+        """Close an agent's connection and terminate its process"""
+        proc = agent['proc']
+        
+        # The event loop outlives the agent, so shut down the connection's
+        # reader and dispatcher tasks rather than leaving them on the loop
+        if agent['conn'] is not None:
+            try:
+                await agent['conn'].close()
+            except Exception as e:
+                self._log.error("Error closing agent connection: %s", e)
+        
+        # Terminals the agent left running would otherwise outlive it
+        if agent['client'] is not None:
+            try:
+                await agent['client'].close_terminals()
+            except Exception as e:
+                self._log.error("Error cleaning up terminals: %s", e)
+        
+        if proc.returncode is None:
+            try:
+                proc.terminate()
+                try:
+                    await asyncio.wait_for(proc.wait(), timeout=5.0)
+                except asyncio.TimeoutError:
+                    proc.kill()
+                    await proc.wait()
+            except ProcessLookupError:
+                pass
+    
+    def _detach_agent(self):
+        """Forget the running agent and return it, or None if there is none"""
+        if self._proc is None:
+            return None
+        
+        agent = {
+            'proc': self._proc,
+            'conn': self._conn,
+            'client': self._client,
+        }
+        self._agent_capabilities = None
+        self._proc = None
+        self._conn = None
+        self._client = None
+        self._session_id = None
+        return agent
+    
+    async def _cancel_start(self):
+        """Abort a startup that is still in progress"""
+        start_task = self._start_task
+        if start_task is not None and start_task is not asyncio.current_task():
+            start_task.cancel()
+            try:
+                await start_task
+            except BaseException:
+                pass
     
     async def _stop_agent(self):
         """Stop the ACP agent process"""
-        if self._proc is None:
+        await self._cancel_start()
+        
+        agent = self._detach_agent()
+        if agent is None:
             return
         
         self._log.info("Stopping agent")
+        await self._shutdown_agent(agent)
+    
+    async def _restart_agent(self, resume=True):
+        """Replace the running agent
+        
+        With resume the current session is continued through loadSession when
+        the agent supports it; otherwise a fresh session is created. With a
+        matching warm spare the new agent is swapped in immediately and the
+        old process is retired in the background.
+        """
+        await self._cancel_start()
+        
+        if not resume:
+            self._resume_session_id = None
+            self._turn_index = 0
+        elif self._session_command == self._agent_command:
+            self._resume_session_id = self._session_id
+        else:
+            # '%agent config' switched agents: the current session belongs to
+            # the old one, so continue the new agent's own session, if any
+            self._resume_session_id = self._remembered_session()
+        agent = self._detach_agent()
+        if agent is not None:
+            if self._spare_ready():
+                self._log.info("Retiring agent (PID %s) in the background", agent['proc'].pid)
+                self._retire_agent(agent)
+            else:
+                self._log.info("Stopping agent")
+                await self._shutdown_agent(agent)
+        
+        await self._start_agent()
+    
+    def _retire_agent(self, agent):
+        """Shut an agent down in the background"""
+        task = asyncio.ensure_future(self._shutdown_agent(agent))
+        self._retiring.add(task)
+        task.add_done_callback(self._retiring.discard)
+    
+    def _spare_ready(self):
+        """Return True if a live warm spare matches the current configuration"""
+        spare = self._spare
+        return (
+            spare is not None
+            and spare['proc'].returncode is None
+            and spare['key'] == self._agent_config_key()
+        )
+    
+    def _take_spare(self):
+        """Take the warm spare if it is usable, discarding a stale one"""
+        spare = self._spare
+        if spare is None:
+            return None
+        
+        self._spare = None
+        if spare['proc'].returncode is None and spare['key'] == self._agent_config_key():
+            return spare
+        
+        self._log.info("Discarding stale warm spare agent")
+        self._retire_agent(spare)
+        return None
+    
+    def _refill_spare(self):
+        """Start spawning a warm spare agent if the pool is empty"""
+        if not self._warm_spare or self._spare is not None or self._spare_task is not None:
+            return
+        
+        self._spare_task = asyncio.ensure_future(self._spawn_agent())
+        self._spare_task.add_done_callback(self._on_spare_ready)
+    
+    def _on_spare_ready(self, task):
+        """Store a freshly spawned warm spare"""
+        self._spare_task = None
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            self._log.warning("Failed to spawn warm spare agent: %s", task.exception())
+            return
         
-        if self._proc.returncode is None:
-            self._proc.terminate()
+        self._spare = task.result()
+        self._log.info("Warm spare agent ready (PID %s)", self._spare['proc'].pid)
+    
+    async def _stop_spare(self):
+        """Shut down the warm spare and any agents still being retired"""
+        if self._spare_task is not None:
+            self._spare_task.cancel()
             try:
-                await asyncio.wait_for(self._proc.wait(), timeout=5.0)
-            except asyncio.TimeoutError:
-                self._proc.kill()
-                await self._proc.wait()
+                await self._spare_task
+            except BaseException:
+                pass
         
-        self._proc = None
-        self._conn = None
-        self._session_id = None
+        spare, self._spare = self._spare, None
+        if spare is not None:
+            await self._shutdown_agent(spare)
+        
+        if self._retiring:
+            await asyncio.gather(*self._retiring, return_exceptions=True)
+    
+    def _on_agent_text(self, text):
+        """Record a chunk of agent message text, streaming it if enabled"""
+        output = self._agent_output
+        if output is None:
+            return
+        already = output.nchars
+        output.append(text)
+        
+        # Stream only the head; the rest is summarized when the turn ends
+        if self._output_streamer is not None and already < output.head_chars:
+            head = text[:output.head_chars - already]
+            self._output_streamer.append(head)
+            self._streamed_chars += len(head)
+    
+    def _begin_output(self):
+        """Start a new response buffer and start streaming if enabled
+        
+        The previous response is kept until then so that
+        ``%agent output save`` can still retrieve it.
+        """
+        if self._agent_output is not None:
+            self._agent_output.close()
+        self._agent_output = OutputBuffer(
+            spill_bytes=self._output_spill_bytes,
+            head_chars=self._output_head_chars,
+            tail_chars=self._output_tail_chars,
+        )
+        self._streamed_chars = 0
+        self._last_stop_reason = None
+        self._terminal_mirrors = []
+        if self._stream_output:
+            self._output_streamer = OutputStreamer(
+                self.Write,
+                flush_interval=self._stream_flush_interval,
+                flush_size=self._stream_flush_size,
+            )
+    
+    def _mirror_terminal(self, terminal):
+        """Show a live view of a terminal in the cell if mirroring is on"""
+        if not self._terminal_mirror or self._terminal_mirrors is None:
+            return
+        
+        mirror = TerminalMirror(
+            terminal,
+            lambda msg_type, content: self.send_response(self.iopub_socket, msg_type, content),
+            interval=self._terminal_mirror_interval,
+            lines=self._terminal_mirror_lines,
+        )
+        mirror.start()
+        self._terminal_mirrors.append(mirror)
+    
+    def _stop_terminal_mirrors(self):
+        """Give the turn's terminal views their final update"""
+        mirrors, self._terminal_mirrors = self._terminal_mirrors, None
+        for mirror in mirrors or ():
+            mirror.stop()
+    
+    def _end_streaming(self):
+        """Flush and detach the output streamer; return True if one was active"""
+        streamer, self._output_streamer = self._output_streamer, None
+        if streamer is None:
+            return False
+        streamer.close()
+        return True
     
-    async def _send_prompt(self, code: str) -> str:
+    def _finish_output(self):
+        """Complete the response and return what the cell should display
+        
+        When output streaming is enabled the response has already been
+        written to the cell as it arrived and None is returned, so it is not
+        displayed twice. Responses too large to show in full are reduced to
+        their head and tail.
+        """
+        streamed = self._end_streaming()
+        self._stop_terminal_mirrors()
+        output = self._agent_output
+        
+        if not output:
+            if self._last_stop_reason == 'cancelled':
+                return None
+            return "No response from agent"
+        
+        self._record_transcript('agent', output.preview())
+        
+        if not streamed:
+            return output.preview()
+        
+        # The head is already in the cell; add whatever streaming held back
+        rest = output.nchars - self._streamed_chars
+        if rest > 0:
+            tail = output.tail_text()
+            if rest <= len(tail):
+                self.Write(tail[-rest:])
+            else:
+                self.Write(output.omitted_notice(rest - len(tail)) + tail)
+        return None
+    
+    def _response_cache_key(self, code):
+        """Cache key for a prompt in the current configuration and turn"""
+        return self._response_cache.make_key(
+            code,
+            self._agent_command,
+            self._agent_args,
+            self._mcp_servers,
+            self._turn_index,
+        )
+    
+    async def _send_prompt(self, code: str):
         """Send a prompt to the agent and get the response"""
+        # Replay a recorded response without touching the agent
+        cache_key = None
+        if self._response_cache is not None:
+            cache_key = self._response_cache_key(code)
+        self._turn_index += 1
+        
+        if cache_key is not None:
+            chunks = await self._response_cache.lookup(cache_key)
+            if chunks is not None:
+                self._log.info("Replaying cached response for turn %d", self._turn_index)
+                self._record_transcript('user', code)
+                self._begin_output()
+                for chunk in chunks:
+                    self._on_agent_text(chunk)
+                self._last_stop_reason = 'end_turn'
+                return self._finish_output()
+        
+        # Restart an agent that has exited, resuming its session
+        if self._proc is not None and self._start_task is None and self._proc.returncode is not None:
+            self._log.warning("Agent exited unexpectedly with code %s", self._proc.returncode)
+            self._resume_session_id = self._session_id
+            agent = self._detach_agent()
+            await self._shutdown_agent(agent)
+        
         # Ensure agent is started
         if self._conn is None or self._session_id is None:
             await self._start_agent()
+        self._report_mcp_warnings()
+        
+        self._record_transcript('user', code)
         
         # Clear previous output
-        self._agent_output = []
+        self._begin_output()
+        self._client.begin_turn()
+        self._event_log.mark(self._turn_index, 'prompt')
         
-        # Send the prompt
-        await self._conn.prompt(
-            PromptRequest(
-                sessionId=self._session_id,
-                prompt=[text_block(code)],
+        try:
+            # Send the prompt
+            response = await self._conn.prompt(
+                PromptRequest(
+                    sessionId=self._session_id,
+                    prompt=[text_block(code)],
+                )
             )
-        )
+            self._last_stop_reason = response.stopReason
+            
+            # The prompt response can overtake updates that were read before
+            # it but are still being dispatched; wait for those to be handled
+            await self._client.drain_updates(self._drain_timeout)
+        except BaseException as e:
+            self._event_log.mark(self._turn_index, 'stop', type(e).__name__)
+            self._end_streaming()
+            self._stop_terminal_mirrors()
+            raise
         
-        # Wait a bit for the response to accumulate
-        await asyncio.sleep(0.5)
+        self._event_log.mark(self._turn_index, 'stop', self._last_stop_reason)
         
-        # Return the accumulated output
-        return ''.join(self._agent_output) if self._agent_output else "No response from agent"
+        # Only complete turns are worth replaying, and responses that spilled
+        # to disk are too large to load back into memory for the cache
+        chunks = self._agent_output.chunks()
+        if cache_key is not None and self._last_stop_reason == 'end_turn' and chunks:
+            try:
+                await self._response_cache.record(cache_key, chunks)
+            except Exception as e:
+                self._log.warning("Failed to cache response: %s", e)
+        
+        return self._finish_output()
+    
+    def _run_async(self, coro, timeout=None):
+        """Run a coroutine on the agent event loop and wait for its result"""
+        return self._engine.run(coro, timeout)
     
     def do_execute_direct(self, code):
         """
@@ -750,33 +1753,226 @@ Commands:
         if not code.strip():
             return ""
         
-        # Get or create event loop
-        try:
-            loop = asyncio.get_event_loop()
-            if loop.is_closed():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        
         # Run the async prompt
         try:
-            result = loop.run_until_complete(self._send_prompt(code))
-            return result
+            future = self._engine.submit(self._send_prompt(code))
+            try:
+                return self._wait_for(future)
+            except KeyboardInterrupt:
+                partial = self._interrupt_prompt(future)
+                notice = "Interrupted: the agent turn was cancelled"
+                return f"{partial}\n\n{notice}" if partial else notice
         except Exception as e:
             self._log.error("Error sending prompt: %s", e, exc_info=True)
             return f"Error: {str(e)}\n\nMake sure the ACP agent is configured correctly.\nCurrent agent: {self._agent_command}"
     
+    def _wait_for(self, future):
+        """Wait for a future from the agent loop, answering permission prompts meanwhile"""
+        with self._permission_prompts_lock:
+            self._servicing_prompts = bool(getattr(self, '_allow_stdin', False))
+        future.add_done_callback(lambda _: self._permission_prompts.put(None))
+        try:
+            while not future.done():
+                prompt = self._permission_prompts.get()
+                if prompt is not None:
+                    self._answer_permission_prompt(prompt)
+            return future.result()
+        finally:
+            # Nobody is left to answer prompts that are still queued
+            with self._permission_prompts_lock:
+                self._servicing_prompts = False
+                pending = []
+                while not self._permission_prompts.empty():
+                    pending.append(self._permission_prompts.get_nowait())
+            for prompt in pending:
+                if prompt is not None:
+                    prompt.source = 'interrupted'
+                    prompt.resolve(None)
+    
+    def _post_permission_prompt(self, prompt):
+        """Queue a prompt for the main thread; False if nobody will answer it"""
+        with self._permission_prompts_lock:
+            if not self._servicing_prompts:
+                return False
+            self._permission_prompts.put(prompt)
+            return True
+    
+    def _default_permission_option(self, options):
+        """The option chosen when a prompt gets no answer"""
+        if self._permission_prompt_default == 'allow':
+            kinds = ('allow_once', 'allow_always')
+        else:
+            kinds = ('reject_once', 'reject_always')
+        for option in options:
+            if option.kind in kinds:
+                return option.optionId
+        return None
+    
+    def _answer_permission_prompt(self, prompt):
+        """Ask the user about a permission request and pass the answer back"""
+        for line in prompt.describe():
+            self.Print(line)
+        
+        timeout = self._permission_prompt_timeout
+        count = len(prompt.params.options)
+        question = f"Choose 1-{count} (default: {self._permission_prompt_default}"
+        question += f" in {timeout:g}s): " if timeout > 0 else "): "
+        try:
+            answer = self._input_with_timeout(question, timeout)
+        except BaseException:
+            prompt.source = 'interrupted'
+            prompt.resolve(None)
+            raise
+        
+        option_id = prompt.choose(answer) if answer is not None else None
+        if option_id is None:
+            if answer is None:
+                prompt.source = 'timeout'
+                self.Print(f"No answer, using the default ({self._permission_prompt_default})")
+            else:
+                prompt.source = 'default'
+                if answer.strip():
+                    self.Print(f"Unrecognized answer {answer!r}, using the default ({self._permission_prompt_default})")
+            option_id = self._default_permission_option(prompt.params.options)
+        prompt.resolve(option_id)
+    
+    def _input_with_timeout(self, prompt, timeout):
+        """Ask the frontend for a line of input; None if none arrives in time
+        
+        Like Kernel.raw_input, but gives up after timeout seconds (0 waits
+        forever). A reply that arrives later is discarded by the next request.
+        """
+        import zmq
+        
+        # Purge stale replies, e.g. to an earlier prompt that timed out
+        while True:
+            try:
+                self.stdin_socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                if e.errno == zmq.EAGAIN:
+                    break
+                raise
+        
+        if hasattr(self, '_get_shell_context_var'):
+            ident = self._get_shell_context_var(self._shell_parent_ident)
+        else:
+            ident = self._parent_ident['shell']
+        self.session.send(
+            self.stdin_socket, 'input_request',
+            {'prompt': prompt, 'password': False},
+            self.get_parent('shell'), ident=ident,
+        )
+        
+        deadline = time.monotonic() + timeout if timeout > 0 else None
+        while True:
+            wait = 0.05
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                wait = min(wait, remaining)
+            rlist, _, xlist = zmq.select([self.stdin_socket], [], [self.stdin_socket], wait)
+            if rlist or xlist:
+                _, reply = self.session.recv(self.stdin_socket)
+                if reply is not None:
+                    value = reply.get('content', {}).get('value', '')
+                    return '' if value == '\x04' else value
+    
+    async def _cancel_turn(self, prompt_future):
+        """Cancel the running prompt turn within the interrupt deadline"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._interrupt_timeout
+        
+        # Ask the agent to stop working on the turn
+        if self._client is not None:
+            self._client._turn_cancelled = True
+        if self._conn is not None and self._session_id is not None:
+            try:
+                await asyncio.wait_for(
+                    self._conn.cancel(CancelNotification(sessionId=self._session_id)),
+                    timeout=self._interrupt_timeout,
+                )
+            except Exception as e:
+                self._log.error("Error sending cancel notification: %s", e)
+        
+        # Kill the terminals the turn spawned so they stop holding the session
+        if self._client is not None:
+            await self._client.kill_turn_terminals(
+                timeout=max(0.0, deadline - loop.time()) / 2
+            )
+        
+        # Give the prompt the rest of the deadline to finish with a
+        # 'cancelled' stop reason, then abandon it
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(prompt_future)),
+                timeout=max(0.0, deadline - loop.time()),
+            )
+        except asyncio.TimeoutError:
+            self._log.warning("Agent did not finish the cancelled turn in time")
+            prompt_future.cancel()
+        except Exception:
+            # The prompt's own error is reported by the caller
+            pass
+    
+    def _interrupt_prompt(self, prompt_future):
+        """Handle a kernel interrupt during a prompt
+        
+        Returns any output the turn produced before it was cancelled.
+        """
+        self._log.info("Interrupt received, cancelling agent turn")
+        
+        cancel_future = self._engine.submit(self._cancel_turn(prompt_future))
+        while True:
+            try:
+                cancel_future.result(timeout=self._interrupt_timeout + 1.0)
+                break
+            except KeyboardInterrupt:
+                # Repeated interrupts while we are already cancelling
+                continue
+            except Exception as e:
+                self._log.error("Error cancelling agent turn: %s", e)
+                prompt_future.cancel()
+                break
+        
+        if prompt_future.done() and not prompt_future.cancelled():
+            if prompt_future.exception() is None:
+                return prompt_future.result()
+        return None
+    
     def do_shutdown(self, restart):
         """Shutdown the kernel"""
-        # Stop the agent process
-        if self._proc is not None:
+        # Stop the agent process and any warm spare
+        try:
+            self._run_async(self._stop_agent())
+            self._run_async(self._stop_spare())
+        except Exception as e:
+            self._log.error("Error stopping agent: %s", e)
+        
+        if self._spawn_server is not None:
+            try:
+                self._run_async(self._spawn_server.close())
+            except Exception as e:
+                self._log.error("Error stopping spawn server: %s", e)
+        
+        # The broker itself keeps running for other kernels
+        if self._mcp_broker is not None:
             try:
-                loop = asyncio.get_event_loop()
-                loop.run_until_complete(self._stop_agent())
+                self._run_async(self._mcp_broker.release())
             except Exception as e:
-                self._log.error("Error stopping agent: %s", e)
+                self._log.error("Error releasing MCP broker servers: %s", e)
+        
+        # Stop the agent event loop thread
+        self._engine.stop()
+        self._file_io.close()
+        
+        if self._response_cache is not None:
+            self._response_cache.close()
+        
+        if self._agent_output is not None:
+            self._agent_output.close()
+        
+        self._permission_audit.close()
         
         return super().do_shutdown(restart)
     
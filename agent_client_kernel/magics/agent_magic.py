@@ -3,6 +3,9 @@
 
 from metakernel import Magic
 import os
+import time
+
+from agent_client_kernel.permissions import PermissionPolicy
 
 
 class AgentMagic(Magic):
@@ -43,22 +46,45 @@ class AgentMagic(Magic):
         MCP Server Configuration:
           %agent mcp add NAME COMMAND [ARGS...]  - add MCP server
           %agent mcp list                        - list MCP servers
+          %agent mcp check [NAME]                - probe MCP servers now
+          %agent mcp broker                      - show the shared MCP broker
           %agent mcp remove NAME                 - remove MCP server
           %agent mcp clear                       - clear all MCP servers
 
         Permission Configuration:
           %agent permissions [MODE]              - set permission mode (auto/manual/deny)
-          %agent permissions list                - show permission history
+          %agent permissions list [FILTERS]      - show recent permission decisions
+          %agent permissions policy [ACTION]     - show/load/reload/clear/test the rule policy
 
         Session Management:
           %agent session new [CWD]               - create new session
           %agent session info                    - show session information
           %agent session restart                 - restart current session
+          %agent session transcript [N]          - show the session transcript
 
         Agent Configuration:
           %agent config [COMMAND [ARGS...]]     - configure agent command
           %agent env [KEY=VALUE]                 - set environment variables
 
+        Response Cache:
+          %agent cache [info|clear]              - show or clear the response cache
+
+        Response Output:
+          %agent output [info]                   - show the size of the last response
+          %agent output save PATH                - save the whole last response to a file
+
+        Event Log:
+          %agent events [TURN|all]               - show the timeline of a turn (default: last)
+          %agent events tools [TURN|all]         - show tool-call durations
+          %agent events clear                    - clear the event log
+
+        Terminals:
+          %agent terminals                       - show running and queued terminals
+          %agent terminals mirror [on|off]       - mirror terminal output into the cell
+
+        File Access:
+          %agent files [info|clear]              - show file I/O and cache statistics
+
         Examples:
             %agent mcp add filesystem /usr/local/bin/mcp-server-filesystem
             %agent permissions auto
@@ -84,6 +110,16 @@ class AgentMagic(Magic):
             self._handle_config(subargs)
         elif subcommand == 'env':
             self._handle_env(subargs)
+        elif subcommand == 'cache':
+            self._handle_cache(subargs)
+        elif subcommand == 'output':
+            self._handle_output(subargs)
+        elif subcommand == 'events':
+            self._handle_events(subargs)
+        elif subcommand == 'terminals':
+            self._handle_terminals(subargs)
+        elif subcommand == 'files':
+            self._handle_files(subargs)
         else:
             self.kernel.Error(f"Unknown subcommand: {subcommand}")
             self.kernel.Print("Use '%agent' without arguments to see available subcommands")
@@ -95,29 +131,52 @@ class AgentMagic(Magic):
         self.kernel.Print("MCP Server Configuration:")
         self.kernel.Print("  %agent mcp add NAME COMMAND [ARGS...]")
         self.kernel.Print("  %agent mcp list")
+        self.kernel.Print("  %agent mcp check [NAME]")
+        self.kernel.Print("  %agent mcp broker")
         self.kernel.Print("  %agent mcp remove NAME")
         self.kernel.Print("  %agent mcp clear")
         self.kernel.Print("")
         self.kernel.Print("Permission Configuration:")
         self.kernel.Print("  %agent permissions [auto|manual|deny]")
-        self.kernel.Print("  %agent permissions list")
+        self.kernel.Print("  %agent permissions list [N|all] [allowed|denied|cancelled] [kind=K] [turn=N|last]")
+        self.kernel.Print("  %agent permissions policy [show|load PATH|reload|clear|test KIND [ARG]]")
         self.kernel.Print("")
         self.kernel.Print("Session Management:")
         self.kernel.Print("  %agent session new [CWD]")
         self.kernel.Print("  %agent session info")
         self.kernel.Print("  %agent session restart")
+        self.kernel.Print("  %agent session transcript [N]")
         self.kernel.Print("")
         self.kernel.Print("Agent Configuration:")
         self.kernel.Print("  %agent config [COMMAND [ARGS...]]")
         self.kernel.Print("  %agent env [KEY=VALUE]")
         self.kernel.Print("")
+        self.kernel.Print("Response Cache:")
+        self.kernel.Print("  %agent cache [info|clear]")
+        self.kernel.Print("")
+        self.kernel.Print("Response Output:")
+        self.kernel.Print("  %agent output [info]")
+        self.kernel.Print("  %agent output save PATH")
+        self.kernel.Print("")
+        self.kernel.Print("Event Log:")
+        self.kernel.Print("  %agent events [TURN|all]")
+        self.kernel.Print("  %agent events tools [TURN|all]")
+        self.kernel.Print("  %agent events clear")
+        self.kernel.Print("")
+        self.kernel.Print("Terminals:")
+        self.kernel.Print("  %agent terminals")
+        self.kernel.Print("  %agent terminals mirror [on|off]")
+        self.kernel.Print("")
+        self.kernel.Print("File Access:")
+        self.kernel.Print("  %agent files [info|clear]")
+        self.kernel.Print("")
         self.kernel.Print("Use '%agent SUBCOMMAND' for detailed help")
 
     # MCP Server Management
     def _handle_mcp(self, args):
         """Handle MCP subcommands"""
         if not args.strip():
-            self.kernel.Error("Usage: %agent mcp [add|list|remove|clear]")
+            self.kernel.Error("Usage: %agent mcp [add|list|check|broker|remove|clear]")
             return
 
         parts = args.split(None, 1)
@@ -128,13 +187,17 @@ class AgentMagic(Magic):
             self._mcp_add(actionargs)
         elif action == 'list':
             self._mcp_list(actionargs)
+        elif action == 'check':
+            self._mcp_check(actionargs)
+        elif action == 'broker':
+            self._mcp_broker(actionargs)
         elif action == 'remove':
             self._mcp_remove(actionargs)
         elif action == 'clear':
             self._mcp_clear(actionargs)
         else:
             self.kernel.Error(f"Unknown MCP action: {action}")
-            self.kernel.Print("Available actions: add, list, remove, clear")
+            self.kernel.Print("Available actions: add, list, check, broker, remove, clear")
 
     def _mcp_add(self, args):
         """Add an MCP server"""
@@ -154,25 +217,61 @@ class AgentMagic(Magic):
         if not hasattr(self.kernel, '_mcp_servers'):
             self.kernel._mcp_servers = []
 
+        new_server = {
+            'name': name,
+            'command': command,
+            'args': server_args,
+            'env': []
+        }
+
         # Check if server with this name already exists
         for i, server in enumerate(self.kernel._mcp_servers):
             if server['name'] == name:
-                self.kernel._mcp_servers[i] = {
-                    'name': name,
-                    'command': command,
-                    'args': server_args,
-                    'env': []
-                }
+                self.kernel._mcp_servers[i] = new_server
                 self.kernel.Print(f"Updated MCP server '{name}'")
+                break
+        else:
+            self.kernel._mcp_servers.append(new_server)
+            self.kernel.Print(f"Added MCP server '{name}'")
+
+        # Catch a bad command or path now rather than at the next session
+        if getattr(self.kernel, '_mcp_preflight', False):
+            self._mcp_probe([new_server], refresh=True)
+
+    def _mcp_probe(self, servers, refresh=False):
+        """Probe servers concurrently and print the result for each"""
+        probe = self.kernel._mcp_probe
+        cwd = getattr(self.kernel, '_session_cwd', os.getcwd())
+        try:
+            results = self.kernel._run_async(probe.probe_all(servers, cwd, refresh=refresh))
+        except Exception as e:
+            self.kernel.Error(f"Error probing MCP servers: {e}")
+            return
+        for server, result in zip(servers, results):
+            if result.ok:
+                self.kernel.Print(f"  {server['name']}: {result.describe()}")
+            else:
+                self.kernel.Error(f"  {server['name']}: {result.describe()}")
+        if not all(result.ok or result.timed_out for result in results):
+            self.kernel.Print("Servers that fail this check are left out of new sessions")
+        elif not all(result.ok for result in results):
+            self.kernel.Print("Servers that time out are still used, in case they are only slow to start")
+
+    def _mcp_check(self, args):
+        """Probe MCP servers with an initialize handshake"""
+        servers = getattr(self.kernel, '_mcp_servers', [])
+        name = args.strip()
+        if name:
+            servers = [server for server in servers if server['name'] == name]
+            if not servers:
+                self.kernel.Error(f"No MCP server named '{name}' found")
                 return
+        if not servers:
+            self.kernel.Print("No MCP servers configured")
+            return
 
-        self.kernel._mcp_servers.append({
-            'name': name,
-            'command': command,
-            'args': server_args,
-            'env': []
-        })
-        self.kernel.Print(f"Added MCP server '{name}'")
+        self.kernel.Print(f"Checking {len(servers)} MCP server(s)...")
+        self._mcp_probe(servers, refresh=True)
 
     def _mcp_list(self, args):
         """List MCP servers"""
@@ -180,10 +279,44 @@ class AgentMagic(Magic):
             self.kernel.Print("No MCP servers configured")
             return
 
+        probe = getattr(self.kernel, '_mcp_probe', None)
+        cwd = getattr(self.kernel, '_session_cwd', os.getcwd())
         self.kernel.Print("Configured MCP servers:")
         for server in self.kernel._mcp_servers:
             args_str = ' '.join(server['args']) if server['args'] else '(no args)'
             self.kernel.Print(f"  - {server['name']}: {server['command']} {args_str}")
+            result = probe.cached(server, cwd) if probe is not None else None
+            if result is not None:
+                age = time.time() - result.checked
+                self.kernel.Print(f"      last check ({age:.0f}s ago): {result.describe()}")
+
+    def _mcp_broker(self, args):
+        """Show the shared MCP broker and the servers it runs"""
+        broker = getattr(self.kernel, '_mcp_broker', None)
+        if broker is None:
+            self.kernel.Print("MCP broker: disabled (set ACP_MCP_BROKER=1 to share MCP servers between kernels)")
+            return
+
+        try:
+            status = self.kernel._run_async(broker.status())
+        except Exception as e:
+            self.kernel.Error(f"Error querying MCP broker: {e}")
+            return
+        if status is None:
+            self.kernel.Print("MCP broker: not running (it is started with the first session that uses it)")
+            self.kernel.Print(f"  State file: {broker.state_path}")
+            return
+
+        self.kernel.Print(f"MCP broker: PID {status['pid']}")
+        self.kernel.Print(f"  State file: {broker.state_path}")
+        if not status['servers']:
+            self.kernel.Print("  No servers running")
+        for server in status['servers']:
+            state = f"PID {server['pid']}" if server['running'] else "stopped"
+            self.kernel.Print(
+                f"  - {server['name']}: {server['command']} [{state}, "
+                f"{len(server['clients'])} kernel(s), {server['sessions']} session(s)]"
+            )
 
     def _mcp_remove(self, args):
         """Remove an MCP server"""
@@ -221,8 +354,8 @@ class AgentMagic(Magic):
             mode = getattr(self.kernel, '_permission_mode', 'auto')
             self.kernel.Print(f"Current permission mode: {mode}")
             self.kernel.Print("\nAvailable modes:")
-            self.kernel.Print("  auto   - automatically approve all requests (current default)")
-            self.kernel.Print("  manual - prompt for each request (not yet implemented)")
+            self.kernel.Print("  auto   - automatically approve all requests (default)")
+            self.kernel.Print("  manual - prompt for each request in the notebook")
             self.kernel.Print("  deny   - automatically deny all requests")
             return
 
@@ -230,43 +363,129 @@ class AgentMagic(Magic):
         action = parts[0].lower()
 
         if action == 'list':
-            self._permissions_list()
+            self._permissions_list(parts[1] if len(parts) > 1 else '')
+        elif action == 'policy':
+            self._permissions_policy(parts[1] if len(parts) > 1 else '')
         elif action in ['auto', 'manual', 'deny']:
             self._permissions_set(action)
         else:
             self.kernel.Error(f"Invalid permissions argument: {action}")
-            self.kernel.Print("Usage: %agent permissions [auto|manual|deny|list|show]")
+            self.kernel.Print("Usage: %agent permissions [auto|manual|deny|list|show|policy]")
 
     def _permissions_set(self, mode):
         """Set permission mode"""
-        if mode == 'manual':
-            self.kernel.Print("Warning: manual mode is not yet fully implemented")
-            self.kernel.Print("Falling back to 'auto' mode")
-            mode = 'auto'
-
         self.kernel._permission_mode = mode
         self.kernel.Print(f"Permission mode set to: {mode}")
 
-    def _permissions_list(self):
-        """List permission history"""
-        if not hasattr(self.kernel, '_permission_history'):
-            self.kernel.Print("No permission requests recorded")
-            return
+    def _permissions_list(self, args=''):
+        """List recorded permission decisions, optionally filtered
+
+        Arguments: a count (default 10, 'all' for every record), a decision
+        (allowed, denied, cancelled) and kind=KIND, turn=N|last, source=SOURCE.
+        """
+        audit = self.kernel._permission_audit
+        count = 10
+        filters = {}
+        for arg in args.split():
+            name, _, value = arg.partition('=')
+            name = name.lower()
+            if arg.isdigit():
+                count = int(arg)
+            elif name == 'all' and not value:
+                count = None
+            elif name in ('allowed', 'denied', 'cancelled') and not value:
+                filters['decision'] = name
+            elif name in ('kind', 'source') and value:
+                filters[name] = value
+            elif name == 'turn' and (value.isdigit() or value == 'last'):
+                filters['turn'] = self.kernel._turn_index if value == 'last' else int(value)
+            else:
+                self.kernel.Error(f"Invalid list argument: {arg}")
+                self.kernel.Print("Usage: %agent permissions list [N|all] [allowed|denied|cancelled] "
+                                  "[kind=KIND] [turn=N|last] [source=SOURCE]")
+                return
 
-        if not self.kernel._permission_history:
+        records = audit.records(**filters)
+        if not records:
             self.kernel.Print("No permission requests recorded")
             return
+        shown = records if count is None else records[-count:]
 
-        self.kernel.Print("Recent permission requests:")
-        for i, entry in enumerate(self.kernel._permission_history[-10:], 1):
-            status = "✓ APPROVED" if entry['approved'] else "✗ DENIED"
-            self.kernel.Print(f"  {i}. {status} - {entry['request']}")
+        self.kernel.Print(f"Permission decisions ({len(shown)} of {len(records)} matching, {audit.total} total):")
+        for record in shown:
+            self.kernel.Print(f"  {record.describe()}")
+        if audit.path:
+            self.kernel.Print(f"Audit file: {audit.path}")
+
+    def _permissions_policy(self, args):
+        """Show, load, reload, clear or test the permission policy"""
+        parts = args.split(None, 1)
+        action = parts[0].lower() if parts else 'show'
+        policy = self.kernel._permission_policy
+
+        if action == 'show':
+            if policy is None:
+                self.kernel.Print("No permission policy loaded")
+                self.kernel.Print("Use '%agent permissions policy load PATH' or set ACP_PERMISSION_POLICY")
+                return
+            self.kernel.Print(f"Permission policy: {policy.path or '(inline)'}")
+            for rule in policy.rules:
+                self.kernel.Print(f"  {rule.index + 1}. {rule.describe()}")
+            default = policy.default or f"permission mode ({self.kernel._permission_mode})"
+            self.kernel.Print(f"  Default: {default}")
+            self.kernel.Print(f"  Decision cache: {policy.hits} hits, {policy.misses} misses")
+        elif action in ('load', 'reload'):
+            if action == 'load':
+                if len(parts) < 2:
+                    self.kernel.Error("Usage: %agent permissions policy load PATH")
+                    return
+                path = parts[1].strip()
+            elif policy is None or policy.path is None:
+                self.kernel.Error("No policy file to reload")
+                return
+            else:
+                path = policy.path
+            try:
+                policy = PermissionPolicy.load(path)
+            except ValueError as e:
+                self.kernel.Error(f"Failed to load policy: {e}")
+                return
+            self.kernel._permission_policy = policy
+            self.kernel.Print(f"Loaded {len(policy.rules)} rule(s) from {policy.path}")
+        elif action == 'clear':
+            self.kernel._permission_policy = None
+            self.kernel.Print("Permission policy removed")
+        elif action == 'test':
+            test_args = parts[1].split(None, 1) if len(parts) > 1 else []
+            if not test_args:
+                self.kernel.Error("Usage: %agent permissions policy test KIND [PATH|COMMAND]")
+                return
+            if policy is None:
+                self.kernel.Print("No permission policy loaded")
+                return
+            kind = test_args[0]
+            target = test_args[1].strip() if len(test_args) > 1 else None
+            tool_call = {'kind': kind, 'title': None, 'locations': [], 'rawInput': None}
+            if target and kind == 'execute':
+                tool_call['rawInput'] = {'command': target}
+            elif target:
+                tool_call['locations'] = [{'path': target}]
+            decision, rule = policy.decide_request({'toolCall': tool_call}, self.kernel._session_cwd)
+            if rule is not None:
+                self.kernel.Print(f"{decision} (rule {rule.index + 1}: {rule.describe()})")
+            elif decision is not None:
+                self.kernel.Print(f"{decision} (policy default)")
+            else:
+                self.kernel.Print(f"No rule matches; permission mode '{self.kernel._permission_mode}' applies")
+        else:
+            self.kernel.Error(f"Unknown policy action: {action}")
+            self.kernel.Print("Available actions: show, load, reload, clear, test")
 
     # Session Management
     def _handle_session(self, args):
         """Handle session subcommands"""
         if not args.strip():
-            self.kernel.Error("Usage: %agent session [new|info|restart]")
+            self.kernel.Error("Usage: %agent session [new|info|restart|transcript]")
             return
 
         parts = args.split(None, 1)
@@ -279,14 +498,14 @@ class AgentMagic(Magic):
             self._session_info(actionargs)
         elif action == 'restart':
             self._session_restart(actionargs)
+        elif action == 'transcript':
+            self._session_transcript(actionargs)
         else:
             self.kernel.Error(f"Unknown session action: {action}")
-            self.kernel.Print("Available actions: new, info, restart")
+            self.kernel.Print("Available actions: new, info, restart, transcript")
 
     def _session_new(self, args):
         """Create a new session"""
-        import asyncio
-
         cwd = args.strip() if args.strip() else os.getcwd()
 
         # Validate the directory
@@ -296,29 +515,16 @@ class AgentMagic(Magic):
 
         self.kernel.Print(f"Creating new session with working directory: {cwd}")
 
-        # Get or create event loop
-        try:
-            loop = asyncio.get_event_loop()
-            if loop.is_closed():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-
-        # Stop existing session
         if hasattr(self.kernel, '_session_id') and self.kernel._session_id:
             self.kernel.Print("Terminating existing session...")
-            try:
-                loop.run_until_complete(self.kernel._stop_agent())
-            except Exception as e:
-                self.kernel.Error(f"Error stopping existing session: {e}")
 
-        # Start new session with configured MCP servers and working directory
+        # Replace any existing session with one using the configured MCP
+        # servers and working directory
         try:
             self.kernel._session_cwd = cwd
-            loop.run_until_complete(self.kernel._start_agent())
+            self.kernel._run_async(self.kernel._restart_agent(resume=False))
             self.kernel.Print(f"New session created: {self.kernel._session_id}")
+            self.kernel._report_mcp_warnings()
             
             # List MCP servers if any were configured
             if hasattr(self.kernel, '_mcp_servers') and self.kernel._mcp_servers:
@@ -339,6 +545,8 @@ class AgentMagic(Magic):
 
         self.kernel.Print("Current Session Information:")
         self.kernel.Print(f"  Session ID: {self.kernel._session_id}")
+        if getattr(self.kernel, '_session_resumed', False):
+            self.kernel.Print("  Resumed: yes (history restored with loadSession)")
         
         cwd = getattr(self.kernel, '_session_cwd', os.getcwd())
         self.kernel.Print(f"  Working Directory: {cwd}")
@@ -363,32 +571,41 @@ class AgentMagic(Magic):
 
     def _session_restart(self, args):
         """Restart the current session"""
-        import asyncio
-
         cwd = getattr(self.kernel, '_session_cwd', os.getcwd())
         
         self.kernel.Print("Restarting session...")
 
-        # Get or create event loop
-        try:
-            loop = asyncio.get_event_loop()
-            if loop.is_closed():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-
         # Stop and restart
         try:
-            if hasattr(self.kernel, '_session_id') and self.kernel._session_id:
-                loop.run_until_complete(self.kernel._stop_agent())
-            
-            loop.run_until_complete(self.kernel._start_agent())
-            self.kernel.Print(f"Session restarted: {self.kernel._session_id}")
+            self.kernel._run_async(self.kernel._restart_agent())
+            if getattr(self.kernel, '_session_resumed', False):
+                self.kernel.Print(f"Session resumed: {self.kernel._session_id}")
+            else:
+                self.kernel.Print(f"Session restarted: {self.kernel._session_id}")
+            self.kernel._report_mcp_warnings()
         except Exception as e:
             self.kernel.Error(f"Error restarting session: {e}")
 
+    def _session_transcript(self, args):
+        """Show the session transcript, including history restored on resume"""
+        transcript = getattr(self.kernel, '_transcript', [])
+        if not transcript:
+            self.kernel.Print("Transcript is empty")
+            return
+
+        try:
+            count = int(args.strip()) if args.strip() else 20
+        except ValueError:
+            self.kernel.Error("Usage: %agent session transcript [N]")
+            return
+
+        entries = transcript[-count:] if count > 0 else transcript
+        for entry in entries:
+            label = "User" if entry['role'] == 'user' else "Agent"
+            self.kernel.Print(f"[{label}]")
+            self.kernel.Print(entry['text'].rstrip())
+            self.kernel.Print("")
+
     # Agent Configuration
     def _handle_config(self, args):
         """Handle agent config"""
@@ -421,6 +638,9 @@ class AgentMagic(Magic):
         # Update configuration
         self.kernel._agent_command = command
         self.kernel._agent_args = agent_args
+        if not self.kernel._session_id:
+            # The remembered session belonged to the previous agent
+            self.kernel._resume_session_id = self.kernel._remembered_session()
 
         self.kernel.Print("Agent configuration updated:")
         self.kernel.Print(f"  Command: {command}")
@@ -479,6 +699,245 @@ class AgentMagic(Magic):
         
         self.kernel.Print(f"Set {key}={display_value}")
 
+    # Response Cache
+    def _handle_cache(self, args):
+        """Handle response cache subcommands"""
+        cache = getattr(self.kernel, '_response_cache', None)
+        if cache is None:
+            self.kernel.Print("Response cache is disabled")
+            self.kernel.Print("Set ACP_RESPONSE_CACHE=1 (or a file path) before starting the kernel to enable it")
+            return
+
+        action = args.strip().lower() or 'info'
+        if action == 'info':
+            stats = cache.stats()
+            self.kernel.Print("Response Cache:")
+            self.kernel.Print(f"  Location: {cache.path}")
+            self.kernel.Print(f"  Entries: {stats['entries']}")
+            self.kernel.Print(f"  Size: {stats['bytes']} / {stats['max_bytes']} bytes")
+            self.kernel.Print(f"  Hits: {stats['hits']}  Misses: {stats['misses']}")
+        elif action == 'clear':
+            cache.clear()
+            self.kernel.Print("Response cache cleared")
+        else:
+            self.kernel.Error(f"Unknown cache action: {action}")
+            self.kernel.Print("Available actions: info, clear")
+
+    # Response Output
+    def _handle_output(self, args):
+        """Handle last-response output subcommands"""
+        output = getattr(self.kernel, '_agent_output', None)
+        if not output:
+            self.kernel.Print("No agent response yet")
+            return
+
+        parts = args.split(None, 1)
+        action = parts[0].lower() if parts else 'info'
+        if action == 'info':
+            self.kernel.Print("Last Response:")
+            self.kernel.Print(f"  Size: {output.nbytes} bytes ({output.nchars} characters)")
+            self.kernel.Print(f"  Stored: {'temporary file' if output.spilled else 'memory'}")
+            self.kernel.Print(f"  Truncated in cell: {'yes' if output.truncated else 'no'}")
+        elif action == 'save':
+            if len(parts) < 2:
+                self.kernel.Error("Usage: %agent output save PATH")
+                return
+            path = os.path.expanduser(parts[1].strip())
+            try:
+                output.save(path)
+            except OSError as e:
+                self.kernel.Error(f"Failed to save output: {e}")
+                return
+            self.kernel.Print(f"Saved {output.nbytes} bytes to {path}")
+        else:
+            self.kernel.Error(f"Unknown output action: {action}")
+            self.kernel.Print("Available actions: info, save")
+
+    # Event Log
+    def _handle_events(self, args):
+        """Handle event log subcommands"""
+        log = getattr(self.kernel, '_event_log', None)
+        if log is None:
+            self.kernel.Print("Event log is not available")
+            return
+
+        parts = args.split()
+        if parts and parts[0].lower() == 'clear':
+            log.clear()
+            self.kernel.Print("Event log cleared")
+            return
+
+        show_tools = bool(parts) and parts[0].lower() == 'tools'
+        if show_tools:
+            parts = parts[1:]
+
+        if not len(log):
+            self.kernel.Print("Event log is empty")
+            return
+
+        # Select the turn: default is the last one, 'all' means every turn
+        turn = log.last_turn()
+        if parts:
+            if parts[0].lower() == 'all':
+                turn = None
+            else:
+                try:
+                    turn = int(parts[0])
+                except ValueError:
+                    self.kernel.Error("Usage: %agent events [tools] [TURN|all]")
+                    return
+
+        if show_tools:
+            self._show_tool_calls(log.tool_calls(turn), turn)
+        else:
+            self._show_events(log.events(turn), turn)
+
+    def _show_events(self, events, turn):
+        """Print a timeline of events relative to the first one"""
+        if not events:
+            self.kernel.Print(f"No events for turn {turn}")
+            return
+
+        label = "All turns" if turn is None else f"Turn {turn}"
+        self.kernel.Print(f"{label} ({len(events)} events):")
+        start = events[0].time
+        for event in events:
+            if event.count > 1 or event.kind.endswith('_chunk'):
+                detail = f"{event.count} chunk(s), {event.size} chars"
+            elif event.tool_call_id is not None:
+                detail = f"{event.tool_call_id} {event.title or ''} [{event.status or '?'}]"
+            elif event.title:
+                detail = event.title
+            elif event.size:
+                detail = str(event.size)
+            else:
+                detail = ''
+            prefix = '' if turn is not None else f"#{event.turn} "
+            offset = f"+{event.time - start:.3f}s"
+            self.kernel.Print(f"  {prefix}{offset:>10}  {event.kind:<26} {detail}".rstrip())
+
+    def _show_tool_calls(self, spans, turn):
+        """Print tool calls with their durations"""
+        if not spans:
+            self.kernel.Print(f"No tool calls for turn {turn}")
+            return
+
+        label = "All turns" if turn is None else f"Turn {turn}"
+        self.kernel.Print(f"Tool calls - {label}:")
+        for span in spans:
+            duration = span.duration
+            elapsed = f"{duration:.3f}s" if duration is not None else "running"
+            self.kernel.Print(
+                f"  {span.tool_call_id}  {span.kind or '-'}  {span.status or '?'}  {elapsed}  {span.title or ''}".rstrip()
+            )
+
+    # Terminals
+    def _handle_terminals(self, args):
+        """Show terminal limits, the scheduler queue and running terminals"""
+        parts = args.split()
+        if parts and parts[0].lower() == 'mirror':
+            self._terminal_mirror(parts[1:])
+            return
+        if parts:
+            self.kernel.Error(f"Unknown terminals action: {parts[0]}")
+            self.kernel.Print("Available actions: mirror")
+            return
+
+        scheduler = self.kernel._terminal_scheduler
+        stats = scheduler.stats()
+
+        def limit(value):
+            return str(value) if value else "unlimited"
+
+        self.kernel.Print("Terminal Limits:")
+        self.kernel.Print(f"  Per kernel: {limit(scheduler.max_total)}")
+        self.kernel.Print(f"  Per session: {limit(scheduler.max_per_session)}")
+        if self.kernel._terminal_nice:
+            self.kernel.Print(f"  Nice: {self.kernel._terminal_nice}")
+        if self.kernel._terminal_rlimits:
+            self.kernel.Print(f"  Resource limits: {os.environ.get('ACP_TERMINAL_RLIMITS', '')}")
+        spawn_server = self.kernel._spawn_server
+        if spawn_server is not None:
+            if not spawn_server.available:
+                state = "unavailable, spawning locally"
+            elif spawn_server.pid is not None:
+                state = f"PID {spawn_server.pid}"
+            else:
+                state = "not started"
+            self.kernel.Print(f"  Spawn server: {state}")
+        self.kernel.Print("")
+        self.kernel.Print("Scheduler:")
+        self.kernel.Print(f"  Running: {stats['running']}")
+        self.kernel.Print(f"  Queue depth: {stats['queue_depth']}")
+        if stats['queue_depth']:
+            self.kernel.Print(f"  Oldest queued request: {stats['oldest_wait']:.1f}s")
+        self.kernel.Print(f"  Started: {stats['started']} ({stats['queued']} queued)")
+        self.kernel.Print(f"  Wait: average {stats['average_wait']:.2f}s, max {stats['max_wait']:.2f}s")
+
+        client = self.kernel._client
+        terminals = list(client._terminals) if client is not None else []
+        self.kernel.Print("")
+        if not terminals:
+            self.kernel.Print("No terminals")
+            return
+
+        self.kernel.Print("Terminals:")
+        now = time.monotonic()
+        for terminal in terminals:
+            status = terminal.exit_status()
+            if status is None:
+                state = "running"
+            elif status[1]:
+                state = f"killed by {status[1]}"
+            else:
+                state = f"exited {status[0]}"
+            self.kernel.Print(
+                f"  {terminal.id[:8]}  PID {terminal.pid}  {state}  "
+                f"{now - terminal.started:.1f}s  {terminal.command}"
+            )
+
+    def _terminal_mirror(self, args):
+        """Show or set live mirroring of terminal output"""
+        if args:
+            value = args[0].lower()
+            if value not in ('on', 'off'):
+                self.kernel.Error("Usage: %agent terminals mirror [on|off]")
+                return
+            self.kernel._terminal_mirror = value == 'on'
+        state = "on" if self.kernel._terminal_mirror else "off"
+        self.kernel.Print(f"Terminal mirroring: {state}")
+
+    # File Access
+    def _handle_files(self, args):
+        """Show file I/O statistics or clear the file content cache"""
+        file_io = self.kernel._file_io
+        cache = file_io.cache
+
+        action = args.strip().lower() or 'info'
+        if action == 'info':
+            self.kernel.Print("File Access:")
+            self.kernel.Print(f"  Workers: {file_io.max_workers}  Fsync: {file_io.fsync}")
+            self.kernel.Print(f"  Reads: {file_io.reads}  Writes: {file_io.writes}")
+            if cache is None:
+                self.kernel.Print("  Content cache: disabled")
+                return
+            stats = cache.stats()
+            lookups = stats['hits'] + stats['misses']
+            hit_rate = f" ({stats['hits'] / lookups:.0%})" if lookups else ""
+            self.kernel.Print("Content Cache:")
+            self.kernel.Print(f"  Entries: {stats['entries']}")
+            self.kernel.Print(f"  Size: {stats['bytes']} / {stats['max_bytes']} bytes")
+            self.kernel.Print(f"  Hits: {stats['hits']}{hit_rate}  Misses: {stats['misses']}")
+            self.kernel.Print(f"  Bytes saved: {stats['bytes_saved']}")
+            self.kernel.Print(f"  Invalidations: {stats['invalidations']}")
+        elif action == 'clear':
+            if cache is not None:
+                cache.clear()
+            self.kernel.Print("File content cache cleared")
+        else:
+            self.kernel.Error(f"Unknown files action: {action}")
+            self.kernel.Print("Available actions: info, clear")
+
 
 def register_magics(kernel):
     kernel.register_magics(AgentMagic)
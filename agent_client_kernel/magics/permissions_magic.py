@@ -25,14 +25,15 @@ class PermissionsMagic(Magic):
             %permissions manual
             %permissions show
 
-        Note: Currently only 'auto' mode is fully implemented.
+        In manual mode each request is shown with its options and answered
+        through the notebook's input box.
         """
         if not args.strip() or args.strip() == 'show':
             mode = getattr(self.kernel, '_permission_mode', 'auto')
             self.kernel.Print(f"Current permission mode: {mode}")
             self.kernel.Print("\nAvailable modes:")
-            self.kernel.Print("  auto   - automatically approve all requests (current default)")
-            self.kernel.Print("  manual - prompt for each request (not yet implemented)")
+            self.kernel.Print("  auto   - automatically approve all requests (default)")
+            self.kernel.Print("  manual - prompt for each request in the notebook")
             self.kernel.Print("  deny   - automatically deny all requests")
             return
 
@@ -44,11 +45,6 @@ class PermissionsMagic(Magic):
             self.kernel.Print(f"Valid modes: {', '.join(valid_modes)}")
             return
 
-        if mode == 'manual':
-            self.kernel.Print("Warning: manual mode is not yet fully implemented")
-            self.kernel.Print("Falling back to 'auto' mode")
-            mode = 'auto'
-
         self.kernel._permission_mode = mode
         self.kernel.Print(f"Permission mode set to: {mode}")
 
@@ -62,18 +58,14 @@ class PermissionsMagic(Magic):
         Example:
             %permissions_list
         """
-        if not hasattr(self.kernel, '_permission_history'):
-            self.kernel.Print("No permission requests recorded")
-            return
-
-        if not self.kernel._permission_history:
+        records = self.kernel._permission_audit.records()
+        if not records:
             self.kernel.Print("No permission requests recorded")
             return
 
         self.kernel.Print("Recent permission requests:")
-        for i, entry in enumerate(self.kernel._permission_history[-10:], 1):
-            status = "✓ APPROVED" if entry['approved'] else "✗ DENIED"
-            self.kernel.Print(f"  {i}. {status} - {entry['request']}")
+        for record in records[-10:]:
+            self.kernel.Print(f"  {record.describe()}")
 
 
 def register_magics(kernel):
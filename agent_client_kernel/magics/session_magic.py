@@ -24,8 +24,6 @@ class SessionMagic(Magic):
         Note: Creating a new session will terminate any existing session.
         """
         import os
-        import asyncio
-
         cwd = args.strip() if args.strip() else os.getcwd()
 
         # Validate the directory
@@ -35,28 +33,14 @@ class SessionMagic(Magic):
 
         self.kernel.Print(f"Creating new session with working directory: {cwd}")
 
-        # Get or create event loop
-        try:
-            loop = asyncio.get_event_loop()
-            if loop.is_closed():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-
-        # Stop existing session
         if hasattr(self.kernel, '_session_id') and self.kernel._session_id:
             self.kernel.Print("Terminating existing session...")
-            try:
-                loop.run_until_complete(self.kernel._stop_agent())
-            except Exception as e:
-                self.kernel.Error(f"Error stopping existing session: {e}")
 
-        # Start new session with configured MCP servers and working directory
+        # Replace any existing session with one using the configured MCP
+        # servers and working directory
         try:
             self.kernel._session_cwd = cwd
-            loop.run_until_complete(self.kernel._start_agent())
+            self.kernel._run_async(self.kernel._restart_agent(resume=False))
             self.kernel.Print(f"New session created: {self.kernel._session_id}")
             
             # List MCP servers if any were configured
@@ -121,28 +105,13 @@ class SessionMagic(Magic):
             %session_restart
         """
         import os
-        import asyncio
-
         cwd = getattr(self.kernel, '_session_cwd', os.getcwd())
         
         self.kernel.Print("Restarting session...")
 
-        # Get or create event loop
-        try:
-            loop = asyncio.get_event_loop()
-            if loop.is_closed():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-
         # Stop and restart
         try:
-            if hasattr(self.kernel, '_session_id') and self.kernel._session_id:
-                loop.run_until_complete(self.kernel._stop_agent())
-            
-            loop.run_until_complete(self.kernel._start_agent())
+            self.kernel._run_async(self.kernel._restart_agent())
             self.kernel.Print(f"Session restarted: {self.kernel._session_id}")
         except Exception as e:
             self.kernel.Error(f"Error restarting session: {e}")
@@ -0,0 +1,227 @@
+"""
+Pre-flight checks for configured MCP servers
+
+A misconfigured MCP server otherwise only shows up as an opaque failure of
+the agent's newSession. Each server is started here the way the agent would
+start it and sent an MCP ``initialize`` request; servers that cannot be
+started, exit or answer with an error are reported (and can be left out of
+the session), while one that is merely slow to answer is only reported. All
+servers are probed concurrently, and results are cached by a hash of the
+command, arguments, environment and directory.
+"""
+
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import signal
+import time
+
+from . import __version__
+
+
+MCP_PROTOCOL_VERSION = '2025-06-18'
+
+
+def _field(obj, name, default=None):
+    """Read a field from a schema model or the equivalent dict"""
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+
+def server_env(server):
+    """The environment an MCP server is started with"""
+    env = dict(os.environ)
+    for variable in server.get('env') or []:
+        env[_field(variable, 'name')] = _field(variable, 'value')
+    return env
+
+
+def server_key(server, cwd):
+    """Hash identifying a server configuration for the probe cache"""
+    data = json.dumps(
+        [server['command'], list(server.get('args') or []), sorted(server_env(server).items()), cwd],
+        separators=(',', ':'),
+    )
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class ProbeResult:
+    """Outcome of probing one MCP server"""
+
+    __slots__ = ('name', 'ok', 'error', 'timed_out', 'server_name', 'server_version',
+                 'protocol_version', 'elapsed', 'checked', 'cached')
+
+    def __init__(self, name, ok, error=None, server_name=None, server_version=None,
+                 protocol_version=None, elapsed=0.0, timed_out=False):
+        self.name = name
+        self.ok = ok
+        self.error = error
+        self.timed_out = timed_out
+        self.server_name = server_name
+        self.server_version = server_version
+        self.protocol_version = protocol_version
+        self.elapsed = elapsed
+        self.checked = time.time()
+        self.cached = False
+
+    def describe(self):
+        """One line for listings"""
+        if not self.ok:
+            return f"FAILED: {self.error}"
+        info = ' '.join(filter(None, [self.server_name, self.server_version])) or 'MCP server'
+        return f"ok ({info}, protocol {self.protocol_version}, {self.elapsed * 1000:.0f} ms)"
+
+
+async def _read_response(stdout, request_id):
+    """Read JSON-RPC messages until the response to request_id"""
+    while True:
+        line = await stdout.readline()
+        if not line:
+            return None
+        try:
+            message = json.loads(line)
+        except ValueError:
+            # Not a protocol message; stdio servers should not write these
+            continue
+        if isinstance(message, dict) and message.get('id') == request_id:
+            return message
+
+
+async def _drain(stream, tail, limit=2048):
+    """Keep the last limit bytes of a stream"""
+    while True:
+        chunk = await stream.read(4096)
+        if not chunk:
+            return
+        tail.extend(chunk)
+        del tail[:-limit]
+
+
+async def probe_server(server, cwd=None, timeout=10.0):
+    """Start an MCP server, send initialize and return a ProbeResult"""
+    name = server['name']
+    started = time.monotonic()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            server['command'], *(server.get('args') or []),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd,
+            env=server_env(server),
+            start_new_session=True,
+            limit=1024 * 1024,
+        )
+    except OSError as e:
+        return ProbeResult(name, False, f"cannot start {server['command']}: {e.strerror or e}")
+
+    stderr_tail = bytearray()
+    stderr_task = asyncio.ensure_future(_drain(process.stderr, stderr_tail))
+    try:
+        request = {
+            'jsonrpc': '2.0',
+            'id': 1,
+            'method': 'initialize',
+            'params': {
+                'protocolVersion': MCP_PROTOCOL_VERSION,
+                'capabilities': {},
+                'clientInfo': {'name': 'agent-client-kernel-preflight', 'version': __version__},
+            },
+        }
+        try:
+            process.stdin.write(json.dumps(request).encode('utf-8') + b'\n')
+            await process.stdin.drain()
+            response = await asyncio.wait_for(_read_response(process.stdout, 1), timeout)
+        except asyncio.TimeoutError:
+            return ProbeResult(name, False, f"no initialize response within {timeout:g}s",
+                               elapsed=timeout, timed_out=True)
+        except (BrokenPipeError, ConnectionResetError):
+            response = None
+        except ValueError:
+            return ProbeResult(name, False, "wrote an oversized line instead of an initialize response")
+
+        elapsed = time.monotonic() - started
+        if response is None:
+            # The server exited before answering; its stderr usually says why
+            try:
+                await asyncio.wait_for(process.wait(), 1.0)
+                await asyncio.wait_for(stderr_task, 1.0)
+            except asyncio.TimeoutError:
+                pass
+            detail = stderr_tail.decode('utf-8', errors='replace').strip().splitlines()
+            reason = f"exited with code {process.returncode}" if process.returncode is not None else "closed its output"
+            if detail:
+                reason += f": {detail[-1]}"
+            return ProbeResult(name, False, reason, elapsed=elapsed)
+        if 'error' in response:
+            error = response['error']
+            message = error.get('message') if isinstance(error, dict) else error
+            return ProbeResult(name, False, f"initialize failed: {message}", elapsed=elapsed)
+
+        result = response.get('result') or {}
+        info = result.get('serverInfo') or {}
+        return ProbeResult(
+            name, True,
+            server_name=info.get('name'),
+            server_version=info.get('version'),
+            protocol_version=result.get('protocolVersion'),
+            elapsed=elapsed,
+        )
+    finally:
+        stderr_task.cancel()
+        if process.returncode is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+            await process.wait()
+
+
+class McpProbe:
+    """Probes MCP servers concurrently, caching results by configuration
+
+    Passing results are reused for ``ttl`` seconds and failures for a tenth
+    of that, so a fixed server is noticed soon.
+    """
+
+    def __init__(self, timeout=10.0, ttl=300.0, max_entries=256):
+        self.timeout = timeout
+        self.ttl = ttl
+        self._max_entries = max_entries
+        self._results = collections.OrderedDict()
+
+    def cached(self, server, cwd):
+        """The cached result for a server configuration, or None"""
+        result = self._results.get(server_key(server, cwd))
+        if result is None:
+            return None
+        ttl = self.ttl if result.ok else self.ttl / 10
+        if time.time() - result.checked > ttl:
+            return None
+        return result
+
+    async def probe(self, server, cwd=None, refresh=False):
+        """Probe one server, or return its cached result"""
+        key = server_key(server, cwd)
+        if not refresh:
+            result = self.cached(server, cwd)
+            if result is not None:
+                result.cached = True
+                return result
+
+        result = await probe_server(server, cwd, self.timeout)
+        self._results[key] = result
+        self._results.move_to_end(key)
+        if len(self._results) > self._max_entries:
+            self._results.popitem(last=False)
+        return result
+
+    async def probe_all(self, servers, cwd=None, refresh=False):
+        """Probe servers concurrently; results are in the same order"""
+        return list(await asyncio.gather(*(self.probe(server, cwd, refresh) for server in servers)))
+
+    def clear(self):
+        self._results.clear()
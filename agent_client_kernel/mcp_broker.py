@@ -0,0 +1,992 @@
+"""
+MCP broker: one shared instance of each MCP server for all local kernels
+
+Without the broker every session of every kernel starts its own copy of
+each configured stdio MCP server. The broker is a small process that starts
+each distinct server (command, arguments, complete environment and
+working directory) once and serves it to agents over MCP's Streamable HTTP
+transport on 127.0.0.1:
+
+    POST   /servers         register a server for a kernel; starts it and
+                            returns its endpoint path
+    DELETE /clients/PID     the kernel with this pid is done with its servers
+    GET    /health          broker pid and running servers
+    POST   /mcp/KEY         JSON-RPC messages from one MCP session
+    GET    /mcp/KEY         SSE stream of server notifications for a session
+    DELETE /mcp/KEY         end an MCP session
+
+Every request must carry the broker's bearer token. Each MCP session gets
+its own ``Mcp-Session-Id``, and request ids and progress tokens are
+rewritten so that all sessions can share the server's single stdio
+connection. The broker initializes the server once and answers each
+session's ``initialize`` with that result. Requests from the server to the
+client (sampling, roots, elicitation) cannot be routed to one session and
+are answered with an error.
+
+Server state that MCP scopes to a client is kept per session where the
+broker can: resource subscriptions are tracked per session, the server is
+only subscribed while some session wants a resource, and
+``notifications/resources/updated`` only goes to the sessions subscribed to
+it. ``logging/setLevel`` would change the level for every session, so it is
+answered by the broker without reaching the server, and the server's log
+messages (``notifications/message``), which cannot be attributed to a
+session, go to the broker's log instead of to the sessions. Other
+notifications, such as list changes, describe the shared server and go to
+every session.
+
+The address and token are kept in a state file, readable only by the user,
+so other kernels connect to a running broker instead of starting another.
+A server is stopped once no live kernel is registered for it, and the
+broker exits when it has had no live kernel for the idle timeout.
+
+Run with ``python -m agent_client_kernel.mcp_broker STATE_PATH``; with
+``--detach`` the command returns once the broker, left running in the
+background, has written the state file.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from . import __version__
+from .mcp import MCP_PROTOCOL_VERSION, _drain, server_env
+
+
+_MAX_BODY = 16 * 1024 * 1024
+
+# Variables Jupyter sets differently for every kernel; they are not passed
+# to shared servers, or no two kernels could share one
+_KERNEL_ENV = ('JPY_PARENT_PID', 'JPY_SESSION_NAME', 'JPY_INTERRUPT_EVENT')
+
+_REASONS = {
+    200: 'OK',
+    202: 'Accepted',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    502: 'Bad Gateway',
+}
+
+
+def default_state_path():
+    """Location of the broker state file in the Jupyter runtime directory"""
+    try:
+        from jupyter_core.paths import jupyter_runtime_dir
+        base = Path(jupyter_runtime_dir())
+    except ImportError:
+        base = Path.home() / '.local' / 'share' / 'jupyter' / 'runtime'
+    return base / 'acp-mcp-broker.json'
+
+
+def server_key(config):
+    """Identity of a server configuration; equal configurations share a server"""
+    data = json.dumps(
+        [config['command'], config.get('args') or [], sorted((config.get('env') or {}).items()),
+         config.get('cwd')],
+        separators=(',', ':'),
+    )
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()[:32]
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Server side
+
+class _HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def _read_request(reader):
+    """Read one HTTP/1.1 request; None at the end of the connection"""
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, _ = line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise _HttpError(400, "malformed request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = bytearray()
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            body += await reader.readexactly(size)
+            await reader.readexactly(2)
+            if len(body) > _MAX_BODY:
+                raise _HttpError(413, "request body too large")
+        return method, target, headers, bytes(body)
+
+    length = int(headers.get('content-length') or 0)
+    if length > _MAX_BODY:
+        raise _HttpError(413, "request body too large")
+    body = await reader.readexactly(length) if length else b''
+    return method, target, headers, body
+
+
+def _write_response(writer, status, data=None, headers=None):
+    """Write a response with an optional JSON body"""
+    body = json.dumps(data).encode('utf-8') if data is not None else b''
+    lines = [f"HTTP/1.1 {status} {_REASONS.get(status, '')}", f"Content-Length: {len(body)}"]
+    if body:
+        lines.append("Content-Type: application/json")
+    for name, value in (headers or {}).items():
+        lines.append(f"{name}: {value}")
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+
+def _error_response(request_id, code, message):
+    return {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': code, 'message': message}}
+
+
+class _Session:
+    """One agent's MCP session on a shared server"""
+
+    def __init__(self, session_id, server):
+        self.id = session_id
+        self.server = server
+        self.requests = {}
+        self.streams = set()
+        self.subscriptions = set()  # Resource URIs the session subscribed to
+        self.last_used = time.monotonic()
+
+    def notify(self, message):
+        """Pass a server notification to the session's open SSE streams"""
+        for queue in self.streams:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                pass
+
+    def close(self):
+        for queue in self.streams:
+            try:
+                queue.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+
+
+class SharedServer:
+    """One running MCP server shared by every session that uses it"""
+
+    def __init__(self, key, config, init_timeout=30.0):
+        self.key = key
+        self.config = config
+        self.clients = set()
+        self.sessions = {}
+        self.init_result = None
+        self._init_timeout = init_timeout
+        self._process = None
+        self._alive = False
+        self._pending = {}
+        self._progress = {}
+        self._ids = itertools.count(1)
+        self._lock = asyncio.Lock()
+        self._stderr = bytearray()
+        self._tasks = []
+        self._log = logging.getLogger(__name__)
+
+    @property
+    def name(self):
+        return self.config.get('name') or self.config['command']
+
+    @property
+    def running(self):
+        return self._alive and self.init_result is not None
+
+    async def start(self):
+        """Start and initialize the server unless it is already running"""
+        async with self._lock:
+            if not self.running:
+                await self.stop()
+                await self._start()
+
+    async def _start(self):
+        config = self.config
+        env = dict(config.get('env') or {})
+        self._process = await asyncio.create_subprocess_exec(
+            config['command'], *(config.get('args') or []),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=config.get('cwd') or None,
+            env=env,
+            start_new_session=True,
+            limit=_MAX_BODY,
+        )
+        self._alive = True
+        self._stderr = bytearray()
+        stderr_task = asyncio.ensure_future(_drain(self._process.stderr, self._stderr))
+        self._tasks = [stderr_task, asyncio.ensure_future(self._read_messages(self._process, stderr_task))]
+        self._log.info("Started MCP server %s (PID %s)", self.name, self._process.pid)
+
+        request = {
+            'jsonrpc': '2.0',
+            'method': 'initialize',
+            'params': {
+                'protocolVersion': MCP_PROTOCOL_VERSION,
+                'capabilities': {},
+                'clientInfo': {'name': 'agent-client-kernel-mcp-broker', 'version': __version__},
+            },
+        }
+        try:
+            response = await asyncio.wait_for(self._call(request), self._init_timeout)
+        except asyncio.TimeoutError:
+            await self.stop()
+            raise RuntimeError(f"no initialize response within {self._init_timeout:g}s")
+        except ConnectionError as e:
+            await self.stop()
+            raise RuntimeError(str(e))
+        if 'error' in response:
+            error = response['error']
+            await self.stop()
+            raise RuntimeError(f"initialize failed: {error.get('message')}")
+        self.init_result = response.get('result') or {}
+        self._send({'jsonrpc': '2.0', 'method': 'notifications/initialized'})
+
+        # Restore the subscriptions sessions held before a restart
+        for uri in self._subscribed():
+            self._send_unanswered('resources/subscribe', {'uri': uri})
+
+    async def stop(self):
+        """Stop the server process; sessions are kept for a restart"""
+        self.init_result = None
+        process, self._process = self._process, None
+        if process is not None and process.returncode is None:
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+                await asyncio.wait_for(process.wait(), 2.0)
+            except (ProcessLookupError, PermissionError):
+                pass
+            except asyncio.TimeoutError:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except (ProcessLookupError, PermissionError):
+                    pass
+                await process.wait()
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._alive = False
+
+    def _send(self, message):
+        if not self._alive or self._process.stdin.is_closing():
+            raise ConnectionError("MCP server is not running")
+        self._process.stdin.write(json.dumps(message).encode('utf-8') + b'\n')
+
+    async def _call(self, message):
+        """Send a request with a fresh id and wait for its response"""
+        upstream_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[upstream_id] = future
+        try:
+            self._send(dict(message, id=upstream_id))
+            return await future
+        finally:
+            self._pending.pop(upstream_id, None)
+
+    def _send_unanswered(self, method, params):
+        """Send a request whose response nobody waits for"""
+        try:
+            self._send({'jsonrpc': '2.0', 'id': next(self._ids), 'method': method, 'params': params})
+        except ConnectionError:
+            pass
+
+    def _subscribed(self, exclude=None):
+        """Resource URIs some session other than exclude is subscribed to"""
+        uris = set()
+        for session in self.sessions.values():
+            if session is not exclude:
+                uris |= session.subscriptions
+        return uris
+
+    def remove_session(self, session):
+        """Forget a session, unsubscribing from resources only it wanted"""
+        self.sessions.pop(session.id, None)
+        if self._alive:
+            for uri in session.subscriptions - self._subscribed():
+                self._send_unanswered('resources/unsubscribe', {'uri': uri})
+        session.subscriptions.clear()
+
+    async def request(self, session, message):
+        """Handle a request from a session and return the response to it"""
+        method = message.get('method')
+        if method == 'logging/setLevel':
+            # The level would apply to every session on the server
+            return {'jsonrpc': '2.0', 'id': message['id'], 'result': {}}
+        if method in ('resources/subscribe', 'resources/unsubscribe'):
+            return await self._subscription(session, message)
+        return await self._forward(session, message)
+
+    async def _subscription(self, session, message):
+        """Track a session's resource subscription, telling the server if needed"""
+        params = message.get('params')
+        uri = params.get('uri') if isinstance(params, dict) else None
+        if not isinstance(uri, str):
+            return _error_response(message['id'], -32602, "Invalid params: expected a resource uri")
+
+        ok = {'jsonrpc': '2.0', 'id': message['id'], 'result': {}}
+        others = uri in self._subscribed(exclude=session)
+        if message['method'] == 'resources/subscribe':
+            if others or uri in session.subscriptions:
+                session.subscriptions.add(uri)
+                return ok
+            response = await self._forward(session, message)
+            if 'error' not in response:
+                session.subscriptions.add(uri)
+            return response
+
+        if uri not in session.subscriptions:
+            return ok
+        session.subscriptions.discard(uri)
+        if others:
+            return ok
+        return await self._forward(session, message)
+
+    async def _forward(self, session, message):
+        """Forward a request from a session and return the response to it"""
+        request_id = message['id']
+        forwarded = dict(message)
+        params = message.get('params')
+        token = None
+        meta = params.get('_meta') if isinstance(params, dict) else None
+        if isinstance(meta, dict) and 'progressToken' in meta:
+            # Progress tokens only need to be unique per client, so two
+            # sessions may use the same one
+            token = secrets.token_hex(8)
+            self._progress[token] = (session, meta['progressToken'])
+            forwarded['params'] = dict(params, _meta=dict(meta, progressToken=token))
+
+        upstream_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[upstream_id] = future
+        session.requests[request_id] = upstream_id
+        try:
+            forwarded['id'] = upstream_id
+            self._send(forwarded)
+            response = await future
+        except ConnectionError as e:
+            return _error_response(request_id, -32603, str(e))
+        finally:
+            self._pending.pop(upstream_id, None)
+            self._progress.pop(token, None)
+            session.requests.pop(request_id, None)
+        return dict(response, id=request_id)
+
+    def notify(self, session, message):
+        """Forward a notification from a session"""
+        method = message.get('method')
+        if method == 'notifications/initialized':
+            # The broker sent this once when it initialized the server
+            return
+        if method == 'notifications/cancelled':
+            params = message.get('params') or {}
+            upstream_id = session.requests.get(params.get('requestId'))
+            if upstream_id is None:
+                return
+            message = dict(message, params=dict(params, requestId=upstream_id))
+        try:
+            self._send(message)
+        except ConnectionError:
+            pass
+
+    async def _read_messages(self, process, stderr_task):
+        try:
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    # Give the process a moment to exit and say why on stderr
+                    try:
+                        await asyncio.wait_for(process.wait(), 1.0)
+                        await asyncio.wait_for(asyncio.shield(stderr_task), 1.0)
+                    except asyncio.TimeoutError:
+                        pass
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(message, dict):
+                    self._dispatch(message)
+        except (ValueError, ConnectionError) as e:
+            self._log.warning("Lost MCP server %s: %s", self.name, e)
+        finally:
+            self._alive = False
+            detail = self._stderr.decode('utf-8', errors='replace').strip().splitlines()
+            reason = f"MCP server {self.name} exited" + (f": {detail[-1]}" if detail else "")
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_result(_error_response(None, -32603, reason))
+            self._pending.clear()
+
+    def _dispatch(self, message):
+        method = message.get('method')
+        if method is None:
+            future = self._pending.get(message.get('id'))
+            if future is not None and not future.done():
+                future.set_result(message)
+        elif 'id' in message:
+            # A request to the client; there is no single session to ask
+            try:
+                self._send(_error_response(message['id'], -32601, "Not supported through the MCP broker"))
+            except ConnectionError:
+                pass
+        elif method == 'notifications/progress':
+            params = message.get('params') or {}
+            target = self._progress.get(params.get('progressToken'))
+            if target is not None:
+                session, token = target
+                session.notify(dict(message, params=dict(params, progressToken=token)))
+        elif method == 'notifications/resources/updated':
+            uri = (message.get('params') or {}).get('uri')
+            for session in list(self.sessions.values()):
+                if uri in session.subscriptions:
+                    session.notify(message)
+        elif method == 'notifications/message':
+            params = message.get('params') or {}
+            self._log.info("MCP server %s [%s]: %s", self.name, params.get('level'), params.get('data'))
+        else:
+            for session in list(self.sessions.values()):
+                session.notify(message)
+
+
+class Broker:
+    """Routes HTTP MCP sessions to shared servers"""
+
+    REAP_INTERVAL = 5.0
+    SESSION_EXPIRY = 24 * 3600.0
+
+    def __init__(self, token, idle_timeout=60.0):
+        self.token = token
+        self.idle_timeout = idle_timeout
+        self.servers = {}
+        self.sessions = {}
+        self._log = logging.getLogger(__name__)
+
+    async def run(self, stop):
+        """Reap dead kernels until stopped or idle for idle_timeout"""
+        idle_since = time.monotonic()
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), self.REAP_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            await self.reap()
+            if any(server.clients for server in self.servers.values()):
+                idle_since = time.monotonic()
+            elif time.monotonic() - idle_since > self.idle_timeout:
+                self._log.info("No kernels for %gs; exiting", self.idle_timeout)
+                break
+
+    async def reap(self):
+        """Stop servers no live kernel is registered for"""
+        now = time.monotonic()
+        for session_id, session in list(self.sessions.items()):
+            if not session.streams and now - session.last_used > self.SESSION_EXPIRY:
+                self._end_session(session_id)
+        for key, server in list(self.servers.items()):
+            server.clients = {pid for pid in server.clients if _pid_alive(pid)}
+            if not server.clients:
+                self._log.info("Stopping unused MCP server %s", server.name)
+                del self.servers[key]
+                await self._stop_server(server)
+
+    async def _stop_server(self, server):
+        for session_id in list(server.sessions):
+            self._end_session(session_id)
+        await server.stop()
+
+    async def close(self):
+        for server in list(self.servers.values()):
+            await self._stop_server(server)
+        self.servers.clear()
+
+    def _end_session(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            session.server.remove_session(session)
+            session.close()
+
+    async def serve_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except _HttpError as e:
+                    _write_response(writer, e.status, {'error': str(e)})
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, target, headers, body = request
+
+                expected = f"Bearer {self.token}"
+                if not hmac.compare_digest(headers.get('authorization', ''), expected):
+                    _write_response(writer, 401, {'error': "missing or wrong token"})
+                elif method == 'GET' and target.startswith('/mcp/'):
+                    # The event stream holds the connection until it ends
+                    await self._stream(writer, target[5:], headers)
+                    break
+                else:
+                    status, data, extra = await self._route(method, target, headers, body)
+                    _write_response(writer, status, data, extra)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, target, headers, body):
+        """Handle a request; returns the status, JSON body and extra headers"""
+        path = target.split('?', 1)[0]
+        if path == '/health' and method == 'GET':
+            return 200, self.status(), None
+        if path == '/servers' and method == 'POST':
+            try:
+                request = json.loads(body)
+                request['command']
+            except (ValueError, TypeError, KeyError):
+                return 400, {'error': "expected a JSON server configuration"}, None
+            return await self._register(request)
+        if path.startswith('/clients/') and method == 'DELETE':
+            try:
+                pid = int(path[len('/clients/'):])
+            except ValueError:
+                return 400, {'error': "expected a process id"}, None
+            for server in self.servers.values():
+                server.clients.discard(pid)
+            await self.reap()
+            return 200, {}, None
+        if path.startswith('/mcp/'):
+            server = self.servers.get(path[5:])
+            if server is None:
+                return 404, {'error': "unknown MCP server"}, None
+            if method == 'POST':
+                return await self._post(server, headers, body)
+            if method == 'DELETE':
+                session = self.sessions.get(headers.get('mcp-session-id'))
+                if session is None or session.server is not server:
+                    return 404, None, None
+                self._end_session(session.id)
+                return 200, None, None
+            return 405, None, {'Allow': 'GET, POST, DELETE'}
+        return 404, {'error': f"no route for {method} {path}"}, None
+
+    def status(self):
+        return {
+            'pid': os.getpid(),
+            'servers': [
+                {
+                    'key': server.key,
+                    'name': server.name,
+                    'command': server.config['command'],
+                    'running': server.running,
+                    'pid': server._process.pid if server._process is not None else None,
+                    'clients': sorted(server.clients),
+                    'sessions': len(server.sessions),
+                }
+                for server in self.servers.values()
+            ],
+        }
+
+    async def _register(self, request):
+        config = {
+            'name': request.get('name'),
+            'command': request['command'],
+            'args': list(request.get('args') or []),
+            'env': dict(request.get('env') or {}),
+            'cwd': request.get('cwd'),
+        }
+        key = server_key(config)
+        server = self.servers.get(key)
+        if server is None:
+            server = self.servers[key] = SharedServer(key, config)
+        if request.get('client'):
+            server.clients.add(int(request['client']))
+        try:
+            await server.start()
+        except (OSError, RuntimeError) as e:
+            return 502, {'error': f"cannot start MCP server {server.name}: {e}"}, None
+        return 200, {'key': key, 'path': f"/mcp/{key}"}, None
+
+    async def _post(self, server, headers, body):
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return 400, _error_response(None, -32700, "Parse error"), None
+
+        session = self.sessions.get(headers.get('mcp-session-id'))
+        if session is not None and session.server is not server:
+            session = None
+        messages = payload if isinstance(payload, list) else [payload]
+        if not messages or not all(isinstance(message, dict) for message in messages):
+            return 400, _error_response(None, -32600, "Invalid Request"), None
+
+        extra = None
+        if any(message.get('method') == 'initialize' for message in messages):
+            if session is None:
+                session = _Session(secrets.token_hex(16), server)
+                self.sessions[session.id] = session
+                server.sessions[session.id] = session
+            extra = {'Mcp-Session-Id': session.id}
+        elif session is None:
+            return (404 if 'mcp-session-id' in headers else 400), None, None
+        session.last_used = time.monotonic()
+
+        responses = await asyncio.gather(*(self._handle(server, session, message) for message in messages))
+        responses = [response for response in responses if response is not None]
+        if not responses:
+            return 202, None, extra
+        return 200, (responses if isinstance(payload, list) else responses[0]), extra
+
+    async def _handle(self, server, session, message):
+        """Handle one JSON-RPC message; the response, or None"""
+        method = message.get('method')
+        if method is None:
+            # A response to a server request, which the broker never forwards
+            return None
+        if 'id' not in message:
+            server.notify(session, message)
+            return None
+        if method == 'initialize':
+            try:
+                await server.start()
+            except (OSError, RuntimeError) as e:
+                return _error_response(message['id'], -32603, str(e))
+            return {'jsonrpc': '2.0', 'id': message['id'], 'result': server.init_result}
+        if not server.running:
+            try:
+                # The server died; restart it for this and later requests
+                await server.start()
+            except (OSError, RuntimeError) as e:
+                return _error_response(message['id'], -32603, str(e))
+        return await server.request(session, message)
+
+    async def _stream(self, writer, key, headers):
+        """Send server notifications for a session as server-sent events"""
+        server = self.servers.get(key)
+        session = self.sessions.get(headers.get('mcp-session-id'))
+        if server is None or session is None or session.server is not server:
+            _write_response(writer, 404)
+            await writer.drain()
+            return
+
+        queue = asyncio.Queue(maxsize=1000)
+        session.streams.add(queue)
+        try:
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n"
+            )
+            await writer.drain()
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), 15.0)
+                except asyncio.TimeoutError:
+                    writer.write(b": keepalive\n\n")
+                else:
+                    if message is None:
+                        break
+                    writer.write(b"data: " + json.dumps(message).encode('utf-8') + b"\n\n")
+                await writer.drain()
+        finally:
+            session.streams.discard(queue)
+
+
+def _write_state(path, state):
+    """Atomically write the state file, readable only by the user"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix='.' + path.name + '.', dir=path.parent)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.replace(temp_path, path)
+
+
+def _read_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+async def _serve(state_path, idle_timeout, ready_fd=None):
+    token = secrets.token_urlsafe(32)
+    broker = Broker(token, idle_timeout)
+    server = await asyncio.start_server(broker.serve_connection, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    _write_state(state_path, {'pid': os.getpid(), 'port': port, 'token': token})
+    logging.getLogger(__name__).info("MCP broker listening on 127.0.0.1:%s", port)
+    if ready_fd is not None:
+        os.write(ready_fd, b'ready')
+        os.close(ready_fd)
+    try:
+        async with server:
+            await broker.run(stop)
+    finally:
+        # Another broker may have replaced this one's state already
+        state = _read_state(state_path)
+        if state is not None and state.get('pid') == os.getpid():
+            try:
+                os.unlink(state_path)
+            except OSError:
+                pass
+        await broker.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('state', help='path of the state file to write')
+    parser.add_argument('--idle', type=float, default=60.0,
+                        help='seconds to keep running without a live kernel')
+    parser.add_argument('--detach', action='store_true',
+                        help='run in the background; exit 0 once it is ready')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    ready_fd = None
+    if args.detach:
+        # Fork so that the broker is not a child of whoever started it (and
+        # never becomes its zombie); this process waits until it is ready
+        read_fd, ready_fd = os.pipe()
+        if os.fork():
+            os.close(ready_fd)
+            sys.exit(0 if os.read(read_fd, 16) == b'ready' else 1)
+        os.close(read_fd)
+    asyncio.run(_serve(args.state, args.idle, ready_fd))
+
+
+# Kernel side
+
+async def _http(port, token, method, path, data=None, timeout=60.0):
+    """Make one request to the broker; returns the status and JSON body"""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    try:
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        writer.write((
+            f"{method} {path} HTTP/1.1\r\n"
+            f"Host: 127.0.0.1:{port}\r\n"
+            f"Authorization: Bearer {token}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n"
+        ).encode('latin-1') + body)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+
+    head, _, body = response.partition(b'\r\n\r\n')
+    try:
+        status = int(head.split(b' ', 2)[1])
+    except (IndexError, ValueError):
+        raise ConnectionError("malformed response from MCP broker")
+    return status, json.loads(body) if body else None
+
+
+class McpBroker:
+    """Kernel-side handle on the shared MCP broker
+
+    ``connect()`` uses the broker named in the state file if it answers and
+    otherwise starts one; a lock file keeps kernels that start at the same
+    time from starting two. ``register()`` hands the broker a server
+    configuration and returns the URL and headers for an ``HttpMcpServer``.
+    """
+
+    def __init__(self, state_path=None, idle_timeout=60.0, start_timeout=10.0):
+        self.state_path = Path(state_path) if state_path else default_state_path()
+        self.idle_timeout = idle_timeout
+        self._start_timeout = start_timeout
+        self._state = None
+        self._lock = None
+        self._registered = False
+        self._log = logging.getLogger(__name__)
+
+    @property
+    def pid(self):
+        return self._state['pid'] if self._state is not None else None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._state['port']}" if self._state is not None else None
+
+    async def _check(self):
+        """The state of the running broker, or None if there is none"""
+        state = _read_state(self.state_path)
+        if not state or not _pid_alive(state.get('pid', 0)):
+            return None
+        try:
+            status, _ = await _http(state['port'], state['token'], 'GET', '/health', timeout=5.0)
+        except (OSError, ConnectionError, ValueError, asyncio.TimeoutError):
+            return None
+        return state if status == 200 else None
+
+    async def connect(self):
+        """Find the running broker or start one"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._state is not None:
+                return
+            state = await self._check()
+            if state is None:
+                state = await self._start()
+            self._state = state
+            self._log.info("Using MCP broker (PID %s) at %s", self.pid, self.url)
+
+    async def _start(self):
+        import fcntl
+
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        lock_fd = os.open(str(self.state_path) + '.lock', os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            deadline = time.monotonic() + self._start_timeout
+            while True:
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        raise RuntimeError("timed out waiting for another kernel to start the MCP broker")
+                    await asyncio.sleep(0.05)
+
+            # Another kernel may have started it while we waited
+            state = await self._check()
+            if state is not None:
+                return state
+
+            env = dict(os.environ)
+            package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+            log_path = self.state_path.with_suffix('.log')
+            with open(log_path, 'ab') as log:
+                # A session of its own, so that the broker outlives this
+                # kernel and is not hit by signals sent to its process group.
+                # The process started here exits once the broker it forked
+                # is ready, and is reaped below.
+                proc = subprocess.Popen(
+                    [sys.executable, '-m', 'agent_client_kernel.mcp_broker', str(self.state_path),
+                     '--idle', str(self.idle_timeout), '--detach'],
+                    stdin=subprocess.DEVNULL,
+                    stdout=log,
+                    stderr=log,
+                    env=env,
+                    start_new_session=True,
+                )
+
+            while proc.poll() is None:
+                if time.monotonic() > deadline:
+                    proc.kill()
+                    proc.wait()
+                    raise RuntimeError("MCP broker did not start in time")
+                await asyncio.sleep(0.05)
+            if proc.returncode != 0:
+                raise RuntimeError(f"MCP broker exited with code {proc.returncode}; see {log_path}")
+
+            state = await self._check()
+            if state is None:
+                raise RuntimeError(f"MCP broker is not answering; see {log_path}")
+            self._log.info("Started MCP broker (PID %s)", state['pid'])
+            return state
+        finally:
+            os.close(lock_fd)
+
+    async def _request(self, method, path, data=None):
+        await self.connect()
+        try:
+            return await _http(self._state['port'], self._state['token'], method, path, data)
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            # The broker went away; find or start a new one and retry once
+            self._state = None
+            await self.connect()
+            return await _http(self._state['port'], self._state['token'], method, path, data)
+
+    async def register(self, server, cwd):
+        """Start server in the broker; returns the URL and headers to reach it
+
+        The server runs with this kernel's environment, as it would if the
+        agent started it, so kernels share it only if their environments
+        match.
+        """
+        env = server_env(server)
+        for name in _KERNEL_ENV:
+            env.pop(name, None)
+        status, data = await self._request('POST', '/servers', {
+            'name': server['name'],
+            'command': server['command'],
+            'args': list(server.get('args') or []),
+            'env': env,
+            'cwd': cwd,
+            'client': os.getpid(),
+        })
+        if status != 200:
+            raise RuntimeError((data or {}).get('error') or f"MCP broker returned {status}")
+        self._registered = True
+        headers = [('Authorization', f"Bearer {self._state['token']}")]
+        return self.url + data['path'], headers
+
+    async def status(self):
+        """The broker's status, or None if no broker is running"""
+        state = self._state or await self._check()
+        if state is None:
+            return None
+        status, data = await _http(state['port'], state['token'], 'GET', '/health', timeout=5.0)
+        return data if status == 200 else None
+
+    async def release(self):
+        """Tell the broker this kernel no longer needs its servers"""
+        if self._state is None or not self._registered:
+            return
+        try:
+            await _http(self._state['port'], self._state['token'], 'DELETE', f'/clients/{os.getpid()}', timeout=5.0)
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            pass
+        self._registered = False
+
+
+if __name__ == '__main__':
+    main()
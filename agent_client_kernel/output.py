@@ -0,0 +1,294 @@
+"""
+Output handling for agent responses
+"""
+
+import asyncio
+import collections
+import os
+import shutil
+import tempfile
+import time
+
+
+class OutputStreamer:
+    """Coalesce streamed agent text into a bounded number of notebook writes
+
+    Chunks are buffered and written out when either the pending text reaches
+    ``flush_size`` characters or ``flush_interval`` seconds have passed since
+    the last write, so a burst of tiny chunks becomes a handful of messages.
+    """
+
+    def __init__(self, write, flush_interval=0.1, flush_size=4096):
+        self._write = write
+        self._flush_interval = flush_interval
+        self._flush_size = flush_size
+        self._pending = []
+        self._pending_size = 0
+        self._last_flush = time.monotonic()
+        self._timer = None
+        self.writes = 0
+        self.chars_written = 0
+
+    def append(self, text):
+        """Queue a chunk of text, flushing if the time or size budget is spent"""
+        if not text:
+            return
+
+        self._pending.append(text)
+        self._pending_size += len(text)
+
+        elapsed = time.monotonic() - self._last_flush
+        if self._pending_size >= self._flush_size or elapsed >= self._flush_interval:
+            self.flush()
+        elif self._timer is None:
+            self._schedule_flush(self._flush_interval - elapsed)
+
+    def _schedule_flush(self, delay):
+        """Arrange for pending text to be written once the interval elapses"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No loop to drive a timer; the next append or close will flush
+            return
+        self._timer = loop.call_later(max(0.0, delay), self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self.flush()
+
+    def flush(self):
+        """Write out any pending text immediately"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if not self._pending:
+            return
+
+        text = ''.join(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        self._last_flush = time.monotonic()
+
+        self.writes += 1
+        self.chars_written += len(text)
+        self._write(text)
+
+    def close(self):
+        """Flush remaining text and stop the flush timer"""
+        self.flush()
+
+
+class OutputBuffer:
+    """Bounded-memory accumulator for an agent response
+
+    Text is kept in memory until it exceeds ``spill_bytes`` (UTF-8), after
+    which the whole response lives in an anonymous temporary file. A head of
+    ``head_chars`` and a tail of ``tail_chars`` characters are always kept in
+    memory, so a large response can be previewed without reading it back.
+    """
+
+    def __init__(self, spill_bytes=8 * 1024 * 1024, head_chars=20000, tail_chars=20000):
+        self.spill_bytes = spill_bytes
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self.nbytes = 0
+        self.nchars = 0
+        self._chunks = []
+        self._file = None
+        self._head = []
+        self._head_size = 0
+        self._tail = collections.deque()
+        self._tail_size = 0
+
+    def __bool__(self):
+        return self.nchars > 0
+
+    @property
+    def spilled(self):
+        """True once the response has been moved to a temporary file"""
+        return self._file is not None
+
+    @property
+    def truncated(self):
+        """True if a preview cannot show the whole response"""
+        return self.nchars > self.head_chars + self.tail_chars
+
+    def append(self, text):
+        """Add a chunk of text to the response"""
+        if not text:
+            return
+
+        data = text.encode('utf-8')
+        self.nbytes += len(data)
+        self.nchars += len(text)
+
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._chunks.append(text)
+            if self.nbytes > self.spill_bytes:
+                self._spill()
+
+        # Keep the head and tail in memory for previews
+        if self._head_size < self.head_chars:
+            piece = text[:self.head_chars - self._head_size]
+            self._head.append(piece)
+            self._head_size += len(piece)
+
+        self._tail.append(text)
+        self._tail_size += len(text)
+        while self._tail and self._tail_size - len(self._tail[0]) >= self.tail_chars:
+            self._tail_size -= len(self._tail.popleft())
+
+    def _spill(self):
+        """Move the in-memory chunks to a temporary file"""
+        self._file = tempfile.TemporaryFile(prefix='acp-output-')
+        for chunk in self._chunks:
+            self._file.write(chunk.encode('utf-8'))
+        self._chunks = []
+
+    def head_text(self):
+        """The first ``head_chars`` characters of the response"""
+        return ''.join(self._head)
+
+    def tail_text(self):
+        """The last ``tail_chars`` characters of the response"""
+        tail = ''.join(self._tail)
+        return tail[-self.tail_chars:] if self.tail_chars else ''
+
+    def omitted_notice(self, omitted):
+        """Marker shown in place of text left out of a preview"""
+        return (
+            f"\n\n... [{omitted} characters omitted from a {self.nbytes} byte response; "
+            f"use '%agent output save PATH' to get all of it] ...\n\n"
+        )
+
+    def preview(self):
+        """The whole response if it is small, otherwise its head and tail"""
+        if not self.truncated:
+            return self.getvalue()
+        omitted = self.nchars - self.head_chars - self.tail_chars
+        return self.head_text() + self.omitted_notice(omitted) + self.tail_text()
+
+    def getvalue(self):
+        """The complete response text (reads the spill file if needed)"""
+        if self._file is None:
+            return ''.join(self._chunks)
+        self._file.flush()
+        self._file.seek(0)
+        data = self._file.read()
+        self._file.seek(0, os.SEEK_END)
+        return data.decode('utf-8')
+
+    def chunks(self):
+        """The in-memory chunks, or None once the response has spilled"""
+        return None if self._file is not None else list(self._chunks)
+
+    def save(self, path):
+        """Write the complete response to path"""
+        with open(path, 'wb') as f:
+            if self._file is None:
+                f.write(''.join(self._chunks).encode('utf-8'))
+            else:
+                self._file.flush()
+                self._file.seek(0)
+                shutil.copyfileobj(self._file, f)
+                self._file.seek(0, os.SEEK_END)
+
+    def close(self):
+        """Release the spill file"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._chunks = []
+
+
+class TerminalMirror:
+    """Live view of an agent terminal in the running cell
+
+    The view is a single display - a header line and the last ``lines``
+    lines of output - that is replaced in place through its display id at
+    most once per ``interval`` seconds, so a long build shows progress
+    without growing the notebook.
+    """
+
+    def __init__(self, terminal, send, interval=1.0, lines=20):
+        self._terminal = terminal
+        self._send = send
+        self._interval = interval
+        self._lines = lines
+        self._display_id = 'acp-terminal-' + terminal.id
+        self._task = None
+        self._last = None
+        self._finished = None
+        self.updates = 0
+
+    def start(self):
+        """Show the view and keep it updated until the command exits"""
+        self._publish('display_data')
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        terminal = self._terminal
+        while terminal.exit_status() is None:
+            await asyncio.sleep(self._interval)
+            self._publish('update_display_data')
+
+        # Let the reader pick up the last of the output
+        if terminal.reader is not None:
+            await asyncio.wait({terminal.reader}, timeout=1.0)
+        self._task = None
+        self._publish('update_display_data')
+
+    def stop(self):
+        """Show the current state one last time and stop updating"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._publish('update_display_data')
+
+    def _publish(self, msg_type):
+        text = self.render()
+        if msg_type == 'update_display_data' and text == self._last:
+            return
+        self._last = text
+        self.updates += 1
+        self._send(msg_type, {
+            'data': {'text/plain': text},
+            'metadata': {},
+            'transient': {'display_id': self._display_id},
+        })
+
+    def render(self):
+        """Header plus the tail of the output"""
+        terminal = self._terminal
+        buffer = terminal.output_buffer
+        status = terminal.exit_status()
+
+        if status is None:
+            state = "running"
+            elapsed = time.monotonic() - terminal.started
+        else:
+            if self._finished is None:
+                self._finished = time.monotonic()
+            elapsed = self._finished - terminal.started
+            state = f"killed by {status[1]}" if status[1] else f"exit {status[0]}"
+        header = f"$ {terminal.command}  [{state}, {elapsed:.1f}s, {buffer.total_bytes} bytes]"
+
+        # Decode a bounded tail; unless it starts at the very beginning of
+        # the output its first line may be cut off, so drop that line
+        data = buffer.tail(self._lines * 256)
+        lines = data.decode('utf-8', errors='replace').split('\n')
+        if lines and not lines[-1]:
+            lines.pop()
+        truncated = buffer.total_bytes > len(data)
+        if truncated and lines:
+            lines = lines[1:]
+        earlier = truncated or len(lines) > self._lines
+
+        # Show only the latest state of lines redrawn with carriage returns
+        lines = [line.rstrip('\r').rsplit('\r', 1)[-1] for line in lines[-self._lines:]]
+        if earlier:
+            lines.insert(0, "...")
+        return '\n'.join([header, *lines])
@@ -0,0 +1,471 @@
+"""
+Rule-based permission policy for agent tool calls
+
+A policy is a JSON file with an ordered list of rules and a default action:
+
+    {
+        "default": "ask",
+        "rules": [
+            {"action": "allow", "kind": ["read", "search"]},
+            {"action": "allow", "kind": "edit", "path": "{cwd}/**"},
+            {"action": "deny", "kind": "fetch"},
+            {"action": "ask", "command": ["rm *", "* rm *"]}
+        ]
+    }
+
+Each rule may restrict the tool ``kind``, the ``path`` of the locations the
+tool call touches (globs; ``*`` stays within a directory, ``**`` crosses
+directories, ``{cwd}`` is the session directory and relative globs are
+relative to it), the shell ``command`` it runs and its ``title`` (globs in
+which ``*`` matches any text, slashes included, so ``rm *`` also matches
+``rm -rf /home/user``). Several values for a field mean any of them. An allow rule with paths
+matches only if every location matches; other rules match if any does. The
+first matching rule decides; if none does, the default applies. Actions are
+``allow``, ``deny`` and ``ask`` (decide interactively). Without a default,
+requests no rule matches are left to the kernel's permission mode.
+
+Interactive decisions are made on the kernel's main thread, which owns the
+Jupyter stdin channel, while requests arrive on the agent event loop; a
+``PermissionPrompt`` carries one request between the two.
+
+Every decision is recorded in a ``PermissionAuditLog``.
+"""
+
+import collections
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import time
+
+
+ACTIONS = ('allow', 'deny', 'ask')
+FIELDS = ('kind', 'path', 'command', 'title')
+
+
+def _field(obj, name, default=None):
+    """Read a field from a schema model or the equivalent dict"""
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+
+def glob_to_regex(pattern, path=True):
+    """Translate a glob into a regular expression
+
+    For a path glob ``*`` and ``?`` stay within a directory and ``**``
+    crosses directories; otherwise ``*`` matches any text, as in fnmatch.
+
+    >>> import re
+    >>> bool(re.match(glob_to_regex('/src/*.py') + r'\Z', '/src/a/b.py'))
+    False
+    >>> bool(re.match(glob_to_regex('rm *', path=False) + r'\Z', 'rm -rf /home/user'))
+    True
+    """
+    if not path:
+        pattern = pattern.replace('**', '*')
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+            # '**/' also matches no directories at all
+            if pattern.startswith('/', i):
+                parts[-1] = '(?:.*/)?'
+                i += 1
+            continue
+        if c == '*':
+            parts.append('[^/]*' if path else '.*')
+        elif c == '?':
+            parts.append('[^/]' if path else '.')
+        elif c == '[':
+            end = pattern.find(']', i + 1)
+            if end < 0:
+                parts.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                parts.append('[' + body.replace('\\', '\\\\') + ']')
+                i = end
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return ''.join(parts)
+
+
+def _glob_escape(text):
+    """Quote glob metacharacters so text matches only itself"""
+    return re.sub(r'([*?\[])', r'[\1]', text)
+
+
+def _command_text(raw_input):
+    """Best-effort shell command from a tool call's raw input"""
+    if raw_input is None:
+        return None
+    command = _field(raw_input, 'command') or _field(raw_input, 'cmd')
+    if isinstance(command, (list, tuple)):
+        # ['bash', '-lc', 'script'] runs the script; otherwise join the argv
+        if len(command) >= 3 and command[-2] in ('-c', '-lc'):
+            return str(command[-1])
+        return ' '.join(str(arg) for arg in command)
+    return command if isinstance(command, str) else None
+
+
+def describe_request(params, cwd):
+    """Normalize a permission request into (kind, paths, command, title)"""
+    tool_call = _field(params, 'toolCall')
+    kind = _field(tool_call, 'kind')
+    title = _field(tool_call, 'title')
+    paths = []
+    for location in _field(tool_call, 'locations') or ():
+        path = _field(location, 'path')
+        if path:
+            paths.append(os.path.normpath(os.path.join(cwd, path)))
+    command = _command_text(_field(tool_call, 'rawInput'))
+    return (str(kind) if kind else None, tuple(paths), command, title)
+
+
+class Rule:
+    """One policy rule with its match fields as given in the file"""
+
+    __slots__ = ('index', 'action', 'kind', 'path', 'command', 'title')
+
+    def __init__(self, index, spec):
+        if not isinstance(spec, dict):
+            raise ValueError(f"rule {index + 1}: expected an object, got {spec!r}")
+        unknown = set(spec) - set(FIELDS) - {'action'}
+        if unknown:
+            raise ValueError(f"rule {index + 1}: unknown field(s) {', '.join(sorted(unknown))}")
+        action = spec.get('action')
+        if action not in ACTIONS:
+            raise ValueError(f"rule {index + 1}: action must be one of {', '.join(ACTIONS)}")
+        self.index = index
+        self.action = action
+        for name in FIELDS:
+            value = spec.get(name)
+            if isinstance(value, str):
+                value = (value,)
+            elif value is not None:
+                if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+                    raise ValueError(f"rule {index + 1}: {name} must be a string or a list of strings")
+                value = tuple(value)
+            setattr(self, name, value)
+
+    def describe(self):
+        fields = [f"{name}={'|'.join(getattr(self, name))}" for name in FIELDS if getattr(self, name)]
+        return f"{self.action} {' '.join(fields) or '(everything)'}"
+
+
+class _CompiledRule:
+    """A rule with its globs compiled for one session directory"""
+
+    __slots__ = ('rule', 'path', 'command', 'title')
+
+    def __init__(self, rule, cwd):
+        self.rule = rule
+        self.path = self._compile(rule.path, cwd)
+        self.command = self._compile(rule.command)
+        self.title = self._compile(rule.title)
+
+    @staticmethod
+    def _compile(globs, cwd=None):
+        """Compile path globs (when cwd is given) or text globs"""
+        if not globs:
+            return None
+        patterns = []
+        for glob in globs:
+            if cwd is not None:
+                base = _glob_escape(cwd)
+                glob = glob.replace('{cwd}', base.rstrip('/'))
+                if not glob.startswith('/'):
+                    glob = os.path.join(base, glob)
+            patterns.append(glob_to_regex(glob, path=cwd is not None))
+        return re.compile('(?:' + '|'.join(patterns) + r')\Z', re.DOTALL)
+
+    def matches(self, paths, command, title):
+        if self.path is not None:
+            if not paths:
+                return False
+            test = all if self.rule.action == 'allow' else any
+            if not test(self.path.match(path) for path in paths):
+                return False
+        if self.command is not None and (command is None or not self.command.match(command)):
+            return False
+        if self.title is not None and (title is None or not self.title.match(title)):
+            return False
+        return True
+
+
+class _Matcher:
+    """Rules compiled for one session directory and indexed by tool kind"""
+
+    def __init__(self, rules, cwd):
+        compiled = [_CompiledRule(rule, cwd) for rule in rules]
+        kinds = {kind for rule in rules for kind in rule.kind or ()}
+        self._any_kind = [c for c in compiled if not c.rule.kind]
+        self._by_kind = {
+            kind: [c for c in compiled if not c.rule.kind or kind in c.rule.kind]
+            for kind in kinds
+        }
+
+    def first_match(self, kind, paths, command, title):
+        for compiled in self._by_kind.get(kind, self._any_kind):
+            if compiled.matches(paths, command, title):
+                return compiled.rule
+        return None
+
+
+class PermissionPolicy:
+    """Ordered permission rules with a memoized decision cache
+
+    Decisions are cached by the normalized request (session directory, tool
+    kind, paths, command and title), so repeated tool calls are answered
+    with a dictionary lookup.
+
+    >>> policy = PermissionPolicy([{"action": "ask", "command": ["rm *", "* rm *"]}])
+    >>> [policy.decide('execute', (), command, None, '/tmp')[0] for command in
+    ...  ['rm foo', 'rm -rf /home/user', 'cd x && rm -rf /tmp/a', 'rm -rf ~/']]
+    ['ask', 'ask', 'ask', 'ask']
+    >>> policy.decide('execute', (), 'ls /tmp', None, '/tmp')[0] is None
+    True
+    """
+
+    def __init__(self, rules=(), default=None, path=None, cache_size=4096):
+        if default is not None and default not in ACTIONS:
+            raise ValueError(f"default must be one of {', '.join(ACTIONS)}")
+        self.rules = [rule if isinstance(rule, Rule) else Rule(i, rule) for i, rule in enumerate(rules)]
+        self.default = default
+        self.path = path
+        self._cache_size = cache_size
+        self._matchers = {}
+        self._decisions = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def load(cls, path):
+        """Read a policy from a JSON file; raises ValueError if it is invalid"""
+        path = os.path.abspath(os.path.expanduser(path))
+        try:
+            with open(path, encoding='utf-8') as f:
+                spec = json.load(f)
+        except OSError as e:
+            raise ValueError(f"cannot read {path}: {e.strerror}") from e
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path}: {e}") from e
+        if isinstance(spec, list):
+            spec = {'rules': spec}
+        if not isinstance(spec, dict) or not isinstance(spec.get('rules', []), list):
+            raise ValueError(f"{path}: expected a list of rules or an object with 'rules'")
+        return cls(spec.get('rules', []), spec.get('default'), path)
+
+    def decide(self, kind, paths, command, title, cwd):
+        """(action, rule) for a normalized request
+
+        rule is None when no rule matched; action is then the default, which
+        may be None.
+        """
+        key = (cwd, kind, paths, command, title)
+        decision = self._decisions.get(key)
+        if decision is not None:
+            self.hits += 1
+            self._decisions.move_to_end(key)
+            return decision
+        self.misses += 1
+
+        matcher = self._matchers.get(cwd)
+        if matcher is None:
+            matcher = self._matchers[cwd] = _Matcher(self.rules, cwd)
+        rule = matcher.first_match(kind, paths, command, title)
+        decision = (rule.action, rule) if rule is not None else (self.default, None)
+
+        self._decisions[key] = decision
+        if len(self._decisions) > self._cache_size:
+            self._decisions.popitem(last=False)
+        return decision
+
+    def decide_request(self, params, cwd):
+        """(action, rule) for an ACP permission request"""
+        return self.decide(*describe_request(params, cwd), cwd)
+
+
+class PermissionPrompt:
+    """A permission request waiting for an answer from the user
+
+    Created on the agent event loop and answered from the kernel's main
+    thread; ``resolve`` is thread-safe and the first answer wins.
+    """
+
+    def __init__(self, params, loop):
+        self.params = params
+        self._loop = loop
+        self.future = loop.create_future()
+        self.source = 'prompt'  # How the answer came about, for the audit log
+
+    def resolve(self, option_id):
+        """Answer with an option id, or None if the request was cancelled"""
+        self._loop.call_soon_threadsafe(self._set_result, option_id)
+
+    def _set_result(self, option_id):
+        if not self.future.done():
+            self.future.set_result(option_id)
+
+    def describe(self):
+        """Lines describing the tool call and the numbered options"""
+        tool_call = _field(self.params, 'toolCall')
+        kind = _field(tool_call, 'kind') or 'other'
+        title = _field(tool_call, 'title') or _field(tool_call, 'toolCallId')
+        lines = [f"Permission requested: {title} ({kind})"]
+        command = _command_text(_field(tool_call, 'rawInput'))
+        if command:
+            lines.append(f"  $ {command}")
+        for location in _field(tool_call, 'locations') or ():
+            lines.append(f"  {_field(location, 'path')}")
+        options = _field(self.params, 'options') or ()
+        lines.append("  " + "  ".join(
+            f"{i}) {_field(option, 'name')}" for i, option in enumerate(options, 1)
+        ))
+        return lines
+
+    def choose(self, answer):
+        """The option id an answer selects: a number, a name or y/n; else None"""
+        options = _field(self.params, 'options') or ()
+        answer = answer.strip().lower()
+        if answer.isdigit() and 1 <= int(answer) <= len(options):
+            return _field(options[int(answer) - 1], 'optionId')
+        kinds = {'y': 'allow_once', 'yes': 'allow_once', 'n': 'reject_once', 'no': 'reject_once'}
+        for option in options:
+            name = str(_field(option, 'name') or '').lower()
+            if answer and (answer == name or kinds.get(answer) == _field(option, 'kind')):
+                return _field(option, 'optionId')
+        return None
+
+
+def remember_key(params):
+    """What an 'always' answer covers: the tool kind, and for commands the program"""
+    tool_call = _field(params, 'toolCall')
+    kind = _field(tool_call, 'kind')
+    command = _command_text(_field(tool_call, 'rawInput'))
+    program = command.split(None, 1)[0] if command and command.strip() else None
+    return (str(kind) if kind else None, program)
+
+
+class PermissionRecord:
+    """One permission decision in the audit log
+
+    ``decision`` is 'allowed', 'denied' or 'cancelled'; ``source`` says
+    what made it (the policy, the permission mode, the user, a timeout, ...);
+    ``latency`` is the seconds from request to response.
+    """
+
+    __slots__ = (
+        'time', 'session_id', 'turn', 'tool_call_id', 'kind', 'title',
+        'decision', 'source', 'option_id', 'rule', 'latency',
+    )
+
+    def __init__(self, time, session_id, turn, tool_call_id, kind, title,
+                 decision, source, option_id=None, rule=None, latency=0.0):
+        self.time = time
+        self.session_id = session_id
+        self.turn = turn
+        self.tool_call_id = tool_call_id
+        self.kind = kind
+        self.title = title
+        self.decision = decision
+        self.source = source
+        self.option_id = option_id
+        self.rule = rule
+        self.latency = latency
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def describe(self):
+        """One line for listings"""
+        mark = {'allowed': '✓', 'denied': '✗'}.get(self.decision, '-')
+        source = f"{self.source} rule {self.rule}" if self.rule else self.source
+        return (
+            f"{time.strftime('%H:%M:%S', time.localtime(self.time))} turn {self.turn} "
+            f"{mark} {self.decision:<9} {self.kind or 'other':<8} {self.title or ''} "
+            f"[{self.tool_call_id}] via {source}, {self.latency * 1000:.1f} ms"
+        )
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue records unformatted; the listener thread does the JSON encoding"""
+
+    def prepare(self, record):
+        return record
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(record.msg.as_dict(), ensure_ascii=False)
+
+
+class PermissionAuditLog:
+    """Fixed-size ring of permission decisions, optionally mirrored to a file
+
+    The newest ``max_records`` records are kept in memory. With a ``path``,
+    every record is also appended as a JSON line to a size-rotated file;
+    records are handed to a background thread, so the event loop never
+    waits on the disk.
+    """
+
+    def __init__(self, max_records=1000, path=None, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self._records = collections.deque(maxlen=max_records)
+        self.total = 0
+        self.path = None
+        self._logger = None
+        self._listener = None
+        if path:
+            self._open(os.path.abspath(os.path.expanduser(path)), max_bytes, backup_count)
+
+    def _open(self, path, max_bytes, backup_count):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True
+        )
+        handler.setFormatter(_JsonFormatter())
+        records = queue.SimpleQueue()
+        self._listener = logging.handlers.QueueListener(records, handler)
+        self._listener.start()
+
+        # A private logger, so records reach only the audit file
+        self._logger = logging.Logger(f"{__name__}.audit")
+        self._logger.addHandler(_DeferredQueueHandler(records))
+        self.path = path
+
+    def __len__(self):
+        return len(self._records)
+
+    def record(self, record):
+        """Add a decision to the log (and the file)"""
+        self._records.append(record)
+        self.total += 1
+        if self._logger is not None:
+            self._logger.info(record)
+
+    def records(self, decision=None, kind=None, turn=None, source=None):
+        """Records in order, optionally filtered"""
+        return [
+            record for record in self._records
+            if (decision is None or record.decision == decision)
+            and (kind is None or record.kind == kind)
+            and (turn is None or record.turn == turn)
+            and (source is None or record.source == source)
+        ]
+
+    def close(self):
+        """Write out queued records and close the file"""
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+        self._logger = None
@@ -0,0 +1,168 @@
+"""
+Disk-backed cache of agent responses for deterministic prompt replays
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+def default_response_cache_path():
+    """Location of the response cache in the Jupyter data directory"""
+    try:
+        from jupyter_core.paths import jupyter_data_dir
+        base = Path(jupyter_data_dir())
+    except ImportError:
+        base = Path.home() / '.local' / 'share' / 'jupyter'
+    return base / 'agentclient' / 'responses.sqlite'
+
+
+class ResponseCache:
+    """Content-addressed SQLite store of recorded agent response chunks
+
+    Entries are keyed on a hash of everything that determines the agent's
+    answer (see ``make_key``) and evicted least-recently-used first once the
+    stored chunks exceed ``max_bytes``. The ``lookup`` and ``record``
+    coroutines run the SQLite work on a worker thread so that the event loop
+    is not held up by disk I/O.
+    """
+
+    def __init__(self, path=None, max_bytes=256 * 1024 * 1024):
+        self._path = Path(path) if path else default_response_cache_path()
+        self._max_bytes = max_bytes
+        self._log = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._db = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='acp-cache')
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    @staticmethod
+    def make_key(prompt, command, args, mcp_servers, turn_index):
+        """Hash the inputs that determine a response into a cache key"""
+        material = json.dumps({
+            'prompt': prompt,
+            'command': command,
+            'args': list(args),
+            'mcp_servers': mcp_servers,
+            'turn': turn_index,
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _connect(self):
+        if self._db is None:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(self._path), check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " chunks TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created REAL NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+            )
+            self._db.commit()
+        return self._db
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def lookup(self, key):
+        """Return the recorded chunks for key, or None on a miss"""
+        return await self._run(self.get, key)
+
+    async def record(self, key, chunks):
+        """Record the chunks of a response, evicting old entries if needed"""
+        await self._run(self.put, key, list(chunks))
+
+    def get(self, key):
+        """Return the recorded chunks for key, or None on a miss"""
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT chunks FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            db.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, chunks):
+        """Record the chunks of a response, evicting old entries if needed"""
+        data = json.dumps(list(chunks))
+        size = len(data.encode('utf-8'))
+        if size > self._max_bytes:
+            self._log.info("Response of %d bytes is too large to cache", size)
+            return
+
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO responses (key, chunks, size, created, last_used)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, data, size, now, now),
+            )
+            self._evict(db)
+            db.commit()
+
+    def _evict(self, db):
+        """Drop least recently used entries until the cache fits its budget"""
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self._max_bytes:
+            return
+
+        evicted = 0
+        rows = db.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall()
+        for key, size in rows:
+            if total <= self._max_bytes:
+                break
+            db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        self._log.info("Evicted %d cached response(s)", evicted)
+
+    def stats(self):
+        """Return entry count, stored bytes and hit/miss counters"""
+        with self._lock:
+            db = self._connect()
+            entries, size = db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self._max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def clear(self):
+        """Remove every cached response"""
+        with self._lock:
+            db = self._connect()
+            db.execute("DELETE FROM responses")
+            db.commit()
+            db.execute("VACUUM")
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,86 @@
+"""
+Persistence of agent sessions across kernel restarts
+"""
+
+import json
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+
+
+def default_session_store_path():
+    """Location of the session store in the Jupyter data directory"""
+    try:
+        from jupyter_core.paths import jupyter_data_dir
+        base = Path(jupyter_data_dir())
+    except ImportError:
+        base = Path.home() / '.local' / 'share' / 'jupyter'
+    return base / 'agentclient' / 'sessions.json'
+
+
+class SessionStore:
+    """Small JSON file mapping a notebook/agent key to its last session
+
+    Each record holds the session id and working directory so that a
+    restarted kernel can resume the conversation with ACP ``loadSession``.
+    """
+
+    def __init__(self, path=None, max_entries=200):
+        self._path = Path(path) if path else default_session_store_path()
+        self._max_entries = max_entries
+        self._log = logging.getLogger(__name__)
+
+    @property
+    def path(self):
+        return self._path
+
+    def _read(self):
+        try:
+            with open(self._path, encoding='utf-8') as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            self._log.warning("Ignoring unreadable session store %s: %s", self._path, e)
+            return {}
+
+    def _write(self, data):
+        # Keep only the most recently updated entries
+        if len(data) > self._max_entries:
+            newest = sorted(data.items(), key=lambda item: item[1].get('updated', 0), reverse=True)
+            data = dict(newest[:self._max_entries])
+
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self._path.parent, prefix='.sessions-')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=1)
+            os.replace(tmp_path, self._path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def load(self, key):
+        """Return the stored record for key, or None"""
+        return self._read().get(key)
+
+    def save(self, key, session_id, cwd):
+        """Record the session for key"""
+        data = self._read()
+        data[key] = {'session_id': session_id, 'cwd': cwd, 'updated': time.time()}
+        try:
+            self._write(data)
+        except Exception as e:
+            self._log.warning("Failed to save session store %s: %s", self._path, e)
+
+    def forget(self, key):
+        """Drop the record for key"""
+        data = self._read()
+        if data.pop(key, None) is not None:
+            try:
+                self._write(data)
+            except Exception as e:
+                self._log.warning("Failed to save session store %s: %s", self._path, e)
@@ -0,0 +1,367 @@
+"""
+Spawn server: a small helper process that starts terminal commands
+
+Forking from the kernel process is comparatively expensive because the
+kernel holds a large heap (ZMQ, IPython, agent state). The spawn server is
+started once per kernel, with a small footprint, and starts commands on the
+kernel's behalf. Each command gets its own connection on a Unix socket:
+
+    kernel -> server   R  request (JSON: command, args, cwd, env changes, ...)
+    server -> kernel   S  started (JSON: pid)  or  E  error (JSON: errno, message)
+    server -> kernel   O  output bytes, repeated
+    server -> kernel   X  exit (JSON: returncode), as soon as the command exits
+    kernel -> server   K  signal (JSON: signal) for the command's process group
+
+Every frame is a one byte type and a four byte big-endian payload length
+followed by the payload. Output frames can follow the exit frame, since
+children left behind by the command may still hold the output open; the
+server closes the connection once the output reaches end of file. Closing
+the connection before then kills the command's process group. The server
+exits when its stdin (held by the kernel) is closed.
+
+Run with ``python -m agent_client_kernel.spawn_server SOCKET_PATH``.
+"""
+
+import argparse
+import asyncio
+import errno
+import json
+import logging
+import os
+import shutil
+import signal
+import struct
+import sys
+import tempfile
+
+from .terminals import CommandLimits, spawn_process
+
+
+_HEADER = struct.Struct('>cI')
+
+# How often the server checks whether a command whose output is still open
+# has exited
+_EXIT_POLL_INTERVAL = 0.05
+
+
+async def _read_frame(reader):
+    kind, length = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    payload = await reader.readexactly(length) if length else b''
+    return kind, payload
+
+
+def _write_frame(writer, kind, payload=b''):
+    writer.write(_HEADER.pack(kind, len(payload)))
+    if payload:
+        writer.write(payload)
+
+
+def _write_json(writer, kind, data):
+    _write_frame(writer, kind, json.dumps(data).encode('utf-8'))
+
+
+# Server side
+
+def _kill_group(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def _forward_signals(reader, process):
+    """Apply signal frames from the kernel; kill the command if it hangs up
+
+    Cancelled once the command has exited and the output has reached end of
+    file, after which the group may be gone and its id reused.
+    """
+    try:
+        while True:
+            kind, payload = await _read_frame(reader)
+            if kind == b'K':
+                _kill_group(process.pid, json.loads(payload)['signal'])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        _kill_group(process.pid, signal.SIGKILL)
+
+
+async def _report_exit(writer, process):
+    """Send the exit frame as soon as the command exits
+
+    ``process.wait()`` also waits for the output pipe to close, which
+    children that outlive the command can hold open, so the return code is
+    polled instead.
+    """
+    while process.returncode is None:
+        await asyncio.sleep(_EXIT_POLL_INTERVAL)
+    _write_json(writer, b'X', {'returncode': process.returncode})
+    await writer.drain()
+
+
+async def _serve_connection(reader, writer):
+    """Start one command and relay its output and exit status"""
+    process = transport = control = exit_report = None
+    try:
+        kind, payload = await _read_frame(reader)
+        if kind != b'R':
+            return
+        request = json.loads(payload)
+
+        env = dict(os.environ)
+        env.update(request.get('env_set') or {})
+        for name in request.get('env_unset') or []:
+            env.pop(name, None)
+
+        try:
+            process, stream, transport = await spawn_process(
+                request['command'],
+                request.get('args') or [],
+                request.get('cwd'),
+                env,
+                use_pty=request.get('use_pty', False),
+                limits=CommandLimits(request.get('nice', 0), request.get('rlimits') or []),
+            )
+        except OSError as e:
+            _write_json(writer, b'E', {
+                'errno': e.errno,
+                'message': e.strerror or str(e),
+                'filename': e.filename,
+            })
+            await writer.drain()
+            return
+
+        _write_json(writer, b'S', {'pid': process.pid})
+        control = asyncio.ensure_future(_forward_signals(reader, process))
+        exit_report = asyncio.ensure_future(_report_exit(writer, process))
+
+        while True:
+            try:
+                chunk = await stream.read(65536)
+            except OSError as e:
+                # A PTY master reports EIO once the last writer is gone
+                if e.errno != errno.EIO:
+                    raise
+                chunk = b''
+            if not chunk:
+                break
+            _write_frame(writer, b'O', chunk)
+            await writer.drain()
+
+        await exit_report
+        control.cancel()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        if control is not None:
+            control.cancel()
+        if exit_report is not None:
+            exit_report.cancel()
+        if process is not None and process.returncode is None:
+            _kill_group(process.pid, signal.SIGKILL)
+            await process.wait()
+        if transport is not None:
+            transport.close()
+        writer.close()
+
+
+async def _serve(path):
+    server = await asyncio.start_unix_server(_serve_connection, path)
+    os.chmod(path, 0o600)
+
+    # Tell the kernel we are listening, then run until it closes our stdin
+    sys.stdout.write('ready\n')
+    sys.stdout.flush()
+    loop = asyncio.get_running_loop()
+    stdin = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stdin), sys.stdin)
+    async with server:
+        await stdin.read()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('socket', help='path of the Unix socket to listen on')
+    args = parser.parse_args(argv)
+    asyncio.run(_serve(args.socket))
+
+
+# Kernel side
+
+class RemoteProcess:
+    """A command started by the spawn server
+
+    Provides the parts of ``asyncio.subprocess.Process`` that the terminal
+    manager uses: ``pid``, ``returncode``, ``stdout``, ``wait()`` and
+    signalling.
+    """
+
+    def __init__(self, pid, reader, writer):
+        self.pid = pid
+        self.returncode = None
+        self.stdin = None
+        self.stdout = asyncio.StreamReader()
+        self._writer = writer
+        self._exited = asyncio.Event()
+        self._pump = asyncio.ensure_future(self._read_frames(reader))
+
+    async def _read_frames(self, reader):
+        try:
+            # The connection closes once the output reaches end of file
+            while True:
+                kind, payload = await _read_frame(reader)
+                if kind == b'O':
+                    self.stdout.feed_data(payload)
+                elif kind == b'X':
+                    self.returncode = json.loads(payload)['returncode']
+                    self._exited.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # Without an exit frame the spawn server went away and took the
+            # command with it
+            if self.returncode is None:
+                self.returncode = -signal.SIGKILL
+        finally:
+            self.stdout.feed_eof()
+            self._exited.set()
+            self._writer.close()
+
+    async def wait(self):
+        await self._exited.wait()
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None and not self._writer.is_closing():
+            _write_json(self._writer, b'K', {'signal': int(sig)})
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class SpawnServer:
+    """Kernel-side handle on a spawn server process
+
+    The server is started on first use. If it cannot be started, or dies,
+    ``available`` becomes False and callers fall back to spawning commands
+    themselves.
+    """
+
+    def __init__(self, start_timeout=10.0):
+        self._start_timeout = start_timeout
+        self._log = logging.getLogger(__name__)
+        self._proc = None
+        self._dir = None
+        self._path = None
+        self._base_env = None
+        self._start_lock = None
+        self._failed = False
+
+    @property
+    def available(self):
+        if self._failed:
+            return False
+        return self._proc is None or self._proc.returncode is None
+
+    @property
+    def pid(self):
+        return self._proc.pid if self._proc is not None else None
+
+    async def start(self):
+        """Start the server process if it is not running"""
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self._proc is not None and self._proc.returncode is None:
+                return
+            try:
+                await self._start()
+            except Exception as e:
+                self._failed = True
+                await self.close()
+                raise RuntimeError(f"Failed to start spawn server: {e}") from e
+
+    async def _start(self):
+        self._dir = tempfile.mkdtemp(prefix='acp-spawn-')
+        self._path = os.path.join(self._dir, 'spawn.sock')
+
+        # The server inherits the kernel's environment; requests carry only
+        # what has changed since
+        self._base_env = dict(os.environ)
+        env = dict(os.environ)
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+
+        self._proc = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'agent_client_kernel.spawn_server', self._path,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            env=env,
+        )
+        line = await asyncio.wait_for(self._proc.stdout.readline(), self._start_timeout)
+        if line.strip() != b'ready':
+            raise RuntimeError("spawn server did not report ready")
+        self._log.info("Spawn server started (PID %s)", self._proc.pid)
+
+    def _env_changes(self, env):
+        """What differs between env and the server's inherited environment"""
+        base = self._base_env
+        env_set = {name: value for name, value in env.items() if base.get(name) != value}
+        env_unset = [name for name in base if name not in env]
+        return env_set, env_unset
+
+    async def spawn(self, command, args, cwd, env, use_pty=False, nice=0, rlimits=()):
+        """Start a command through the server and return a RemoteProcess
+
+        Raises ConnectionError or RuntimeError if the server is unusable and
+        OSError if the command itself could not be started.
+        """
+        await self.start()
+        try:
+            reader, writer = await asyncio.open_unix_connection(self._path)
+        except OSError as e:
+            raise ConnectionError(f"cannot connect to spawn server: {e}") from e
+
+        env_set, env_unset = self._env_changes(env)
+        _write_json(writer, b'R', {
+            'command': command,
+            'args': list(args),
+            'cwd': cwd,
+            'env_set': env_set,
+            'env_unset': env_unset,
+            'use_pty': use_pty,
+            'nice': nice,
+            'rlimits': [list(limit) for limit in rlimits],
+        })
+        try:
+            await writer.drain()
+            kind, payload = await _read_frame(reader)
+        except BaseException:
+            writer.close()
+            raise
+
+        if kind == b'E':
+            writer.close()
+            error = json.loads(payload)
+            raise OSError(error.get('errno'), error.get('message'), error.get('filename'))
+        if kind != b'S':
+            writer.close()
+            raise RuntimeError(f"unexpected spawn server reply {kind!r}")
+        return RemoteProcess(json.loads(payload)['pid'], reader, writer)
+
+    async def close(self, timeout=2.0):
+        """Stop the server process and remove its socket"""
+        proc, self._proc = self._proc, None
+        if proc is not None and proc.returncode is None:
+            proc.stdin.close()
+            try:
+                await asyncio.wait_for(proc.wait(), timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,815 @@
+"""
+Terminal support for agent-requested commands
+"""
+
+import asyncio
+import codecs
+import collections
+import errno
+import logging
+import os
+import re
+import shutil
+import signal
+import struct
+import time
+import uuid
+from asyncio import subprocess as aio_subprocess
+
+try:
+    import fcntl
+    import pty
+    import resource
+    import termios
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = pty = resource = termios = None
+
+
+_SIZE_SUFFIXES = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_rlimits(spec):
+    """Parse 'NAME=VALUE,...' (e.g. 'cpu=600,as=4G') into (resource, value) pairs
+
+    Names are the RLIMIT_* constants without the prefix; values accept K, M
+    and G suffixes.
+    """
+    limits = []
+    if not spec or not spec.strip():
+        return limits
+    if resource is None:
+        raise ValueError("Resource limits are not supported on this platform")
+
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, value = item.partition('=')
+        if not sep:
+            raise ValueError(f"Invalid resource limit {item!r}, expected NAME=VALUE")
+        constant = getattr(resource, 'RLIMIT_' + name.strip().upper(), None)
+        if constant is None:
+            raise ValueError(f"Unknown resource limit: {name.strip()}")
+        value = value.strip().lower()
+        multiplier = _SIZE_SUFFIXES.get(value[-1:], 1)
+        if multiplier != 1:
+            value = value[:-1]
+        limits.append((constant, int(value) * multiplier))
+    return limits
+
+
+class CommandLimits:
+    """Niceness and resource limits for terminal commands
+
+    A ``preexec_fn`` is unsafe in the multithreaded kernel, so commands are
+    started through the ``nice`` and ``prlimit`` programs, which set the
+    limits and exec the command. Where those are not installed the limits
+    are set on the new process right after it starts instead, leaving a
+    short window in which they do not yet apply.
+    """
+
+    def __init__(self, nice=0, rlimits=()):
+        self.nice = nice
+        self.rlimits = []
+        for constant, value in rlimits:
+            # An unprivileged process cannot raise its hard limit
+            _soft, hard = resource.getrlimit(constant)
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard)
+            self.rlimits.append((constant, value))
+        self._prefix = self._wrapper() if self else []
+
+    def __bool__(self):
+        return bool(self.nice or self.rlimits)
+
+    def _wrapper(self):
+        """Command prefix applying the limits, or None if a program is missing"""
+        prefix = []
+        if self.nice:
+            nice = shutil.which('nice')
+            if nice is None:
+                return None
+            prefix += [nice, '-n', str(self.nice)]
+        if self.rlimits:
+            prlimit = shutil.which('prlimit')
+            if prlimit is None:
+                return None
+            names = {
+                getattr(resource, name): name[len('RLIMIT_'):].lower()
+                for name in dir(resource) if name.startswith('RLIMIT_')
+            }
+            prefix.append(prlimit)
+            prefix += [f"--{names[constant]}={value}:{value}" for constant, value in self.rlimits]
+            prefix.append('--')
+        return prefix
+
+    def wrap(self, command, args, env):
+        """The command and arguments that run command under the limits"""
+        if not self._prefix:
+            return command, args
+        # Resolve the program here so that a missing one is still an
+        # OSError rather than a failure reported by the wrapper
+        program = command
+        if os.sep not in command:
+            program = shutil.which(command, path=(env if env is not None else os.environ).get('PATH'))
+            if program is None:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), command)
+        return self._prefix[0], [*self._prefix[1:], program, *args]
+
+    def apply(self, pid):
+        """Set the limits on a started process if they could not be wrapped"""
+        if self._prefix is not None:
+            return
+        try:
+            if self.nice:
+                priority = os.getpriority(os.PRIO_PROCESS, 0) + self.nice
+                os.setpriority(os.PRIO_PROCESS, pid, min(priority, 19))
+            for constant, value in self.rlimits:
+                resource.prlimit(pid, constant, (value, value))
+        except ProcessLookupError:
+            pass
+
+
+def _open_pty(columns=200, rows=50):
+    """Open a pseudo-terminal that outputs like a pipe
+
+    Output post-processing (LF to CRLF) is turned off so the agent sees the
+    same line endings as without a PTY, and the window is made wide enough
+    that tools do not wrap their output.
+    """
+    master, slave = pty.openpty()
+    try:
+        attrs = termios.tcgetattr(slave)
+        attrs[1] &= ~termios.OPOST
+        attrs[3] &= ~termios.ECHO
+        termios.tcsetattr(slave, termios.TCSANOW, attrs)
+        fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack('HHHH', rows, columns, 0, 0))
+    except BaseException:
+        os.close(master)
+        os.close(slave)
+        raise
+    return master, slave
+
+
+async def _open_pty_reader(master):
+    """Wrap a PTY master in a StreamReader"""
+    loop = asyncio.get_running_loop()
+    stream = asyncio.StreamReader()
+    transport, _protocol = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(stream),
+        os.fdopen(master, 'rb', buffering=0),
+    )
+    return stream, transport
+
+
+async def spawn_process(command, args, cwd, env, use_pty=False, limits=None):
+    """Start a command in a new session (and so its own process group)
+
+    ``limits`` is an optional ``CommandLimits``. Returns ``(process, stream, transport)``: ``stream`` carries the merged
+    stdout and stderr, and ``transport`` is the PTY master's transport, or
+    None when the command runs on pipes.
+    """
+    if limits:
+        command, args = limits.wrap(command, args, env)
+
+    if not use_pty:
+        process = await asyncio.create_subprocess_exec(
+            command,
+            *args,
+            stdin=aio_subprocess.PIPE,
+            stdout=aio_subprocess.PIPE,
+            stderr=aio_subprocess.STDOUT,  # Merge stderr into stdout
+            cwd=cwd,
+            env=env,
+            start_new_session=True,
+        )
+        if limits:
+            limits.apply(process.pid)
+        return process, process.stdout, None
+
+    master, slave = _open_pty()
+    try:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                command,
+                *args,
+                stdin=slave,
+                stdout=slave,
+                stderr=slave,
+                cwd=cwd,
+                env=env,
+                start_new_session=True,
+            )
+        finally:
+            os.close(slave)
+        if limits:
+            limits.apply(process.pid)
+        stream, transport = await _open_pty_reader(master)
+    except BaseException:
+        os.close(master)
+        raise
+    return process, stream, transport
+
+
+class AnsiStripper:
+    """Remove ANSI escape sequences from a byte stream
+
+    Sequences split across chunks are held back until they are complete.
+    """
+
+    _SEQUENCE = re.compile(
+        rb'\x1b\[[0-?]*[ -/]*[@-~]'              # CSI: colors, cursor movement
+        rb'|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)'   # OSC: titles, hyperlinks
+        rb'|\x1b[@-Z\\^_]'                      # two-byte sequences
+    )
+    # A sequence cut off by the end of a chunk
+    _INCOMPLETE = re.compile(rb'\x1b(?:\[[0-?]*[ -/]*|\][^\x07\x1b]*\x1b?)?\Z')
+    _MAX_PENDING = 256
+
+    def __init__(self):
+        self._pending = b''
+
+    def feed(self, data):
+        """Strip a chunk, returning the bytes that are safe to emit"""
+        data = self._pending + data
+        self._pending = b''
+
+        # Hold back a trailing escape sequence that may not be complete yet
+        incomplete = self._INCOMPLETE.search(data, max(0, len(data) - self._MAX_PENDING))
+        if incomplete is not None:
+            self._pending = data[incomplete.start():]
+            data = data[:incomplete.start()]
+
+        return self._SEQUENCE.sub(b'', data)
+
+    def flush(self):
+        """Return whatever is still held back"""
+        data, self._pending = self._pending, b''
+        return self._SEQUENCE.sub(b'', data)
+
+
+class TerminalScheduler:
+    """Caps concurrently running terminals per session and per kernel
+
+    Requests over either cap wait in a single FIFO queue. When a slot frees
+    up the oldest waiter whose session is under its own cap is started, so a
+    session at its limit does not hold up the others. A limit of 0 means
+    unlimited.
+    """
+
+    def __init__(self, max_total=0, max_per_session=0):
+        self.max_total = max_total
+        self.max_per_session = max_per_session
+        self._running = collections.Counter()
+        self._total = 0
+        self._waiters = collections.deque()
+        self.started = 0
+        self.queued = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _has_slot(self, session_id):
+        if self.max_total and self._total >= self.max_total:
+            return False
+        if self.max_per_session and self._running[session_id] >= self.max_per_session:
+            return False
+        return True
+
+    def _grant(self, session_id, waited):
+        self._running[session_id] += 1
+        self._total += 1
+        self.started += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    async def acquire(self, session_id, owner=None):
+        """Wait for a slot for session_id; returns the time spent queued"""
+        # Waiters from other sessions only remain queued while their own
+        # session is at its cap, so a free slot can go straight to this one
+        # unless it would jump ahead of its own session's queue
+        queued = any(w[0] == session_id and not w[2].done() for w in self._waiters)
+        if not queued and self._has_slot(session_id):
+            self._grant(session_id, 0.0)
+            return 0.0
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (session_id, owner, future, time.monotonic())
+        self._waiters.append(waiter)
+        self.queued += 1
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif future.done() and not future.cancelled() and future.exception() is None:
+                # Granted just as we were cancelled
+                self.release(session_id)
+            raise
+
+    def release(self, session_id):
+        """Return a slot and start queued requests that now fit"""
+        self._running[session_id] -= 1
+        if self._running[session_id] <= 0:
+            del self._running[session_id]
+        self._total -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        now = time.monotonic()
+        for waiter in list(self._waiters):
+            if self.max_total and self._total >= self.max_total:
+                break
+            session_id, _owner, future, enqueued = waiter
+            if future.done():
+                self._waiters.remove(waiter)
+                continue
+            if self._has_slot(session_id):
+                self._waiters.remove(waiter)
+                waited = now - enqueued
+                self._grant(session_id, waited)
+                future.set_result(waited)
+
+    def cancel(self, owner):
+        """Fail the queued requests made by owner"""
+        for waiter in list(self._waiters):
+            if waiter[1] is owner:
+                self._waiters.remove(waiter)
+                if not waiter[2].done():
+                    waiter[2].set_exception(RuntimeError("Terminal request cancelled"))
+
+    def stats(self):
+        """Snapshot of running and queued terminals and wait times"""
+        now = time.monotonic()
+        return {
+            'running': self._total,
+            'running_by_session': dict(self._running),
+            'queue_depth': len(self._waiters),
+            'queued_by_session': dict(collections.Counter(w[0] for w in self._waiters)),
+            'oldest_wait': max((now - w[3] for w in self._waiters), default=0.0),
+            'started': self.started,
+            'queued': self.queued,
+            'average_wait': self.total_wait / self.started if self.started else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+class TerminalBuffer:
+    """Fixed-capacity byte ring buffer holding the tail of a terminal's output
+
+    Writes never block or fail: once ``capacity`` bytes are held, the oldest
+    bytes are overwritten, so the pipe can be drained for the whole life of
+    the process while memory stays bounded.
+    """
+
+    def __init__(self, capacity):
+        self._capacity = max(0, capacity)
+        self._buf = bytearray(self._capacity)
+        self._start = 0
+        self._size = 0
+        self.total_bytes = 0
+        self.dropped_bytes = 0
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def start_offset(self):
+        """Absolute offset (in bytes written so far) of the oldest retained byte"""
+        return self.total_bytes - self._size
+
+    @property
+    def truncated(self):
+        """True if bytes have been dropped from the beginning of the output"""
+        return self.dropped_bytes > 0
+
+    def write(self, data):
+        """Append data, dropping the oldest bytes if the buffer is full"""
+        n = len(data)
+        self.total_bytes += n
+        capacity = self._capacity
+        if n == 0:
+            return
+        if capacity == 0:
+            self.dropped_bytes += n
+            return
+
+        if n >= capacity:
+            # Only the last capacity bytes survive
+            self.dropped_bytes += self._size + n - capacity
+            self._buf[:] = data[n - capacity:]
+            self._start = 0
+            self._size = capacity
+            return
+
+        end = (self._start + self._size) % capacity
+        first = min(n, capacity - end)
+        self._buf[end:end + first] = data[:first]
+        if first < n:
+            self._buf[:n - first] = data[first:]
+
+        self._size += n
+        if self._size > capacity:
+            self.dropped_bytes += self._size - capacity
+            self._start = (self._start + self._size - capacity) % capacity
+            self._size = capacity
+
+    def getvalue(self):
+        """The retained output as bytes, oldest first"""
+        end = self._start + self._size
+        if end <= self._capacity:
+            return bytes(self._buf[self._start:end])
+        return bytes(self._buf[self._start:]) + bytes(self._buf[:end - self._capacity])
+
+    def clear(self):
+        """Discard the retained output (the byte count is kept)"""
+        self._start = 0
+        self._size = 0
+
+    def tail(self, count):
+        """The last count retained bytes"""
+        views = self.views(self.total_bytes - count)
+        try:
+            return b''.join(views)
+        finally:
+            for view in views:
+                view.release()
+
+    def views(self, offset, end=None):
+        """Memoryviews over the retained bytes between two absolute offsets
+
+        At most two views are returned (the ring may wrap). They share memory
+        with the buffer, so they must be released before the next write.
+        """
+        start_offset = self.start_offset
+        offset = max(offset, start_offset)
+        end = self.total_bytes if end is None else min(end, self.total_bytes)
+        if end <= offset:
+            return []
+
+        begin = (self._start + offset - start_offset) % self._capacity
+        stop = begin + end - offset
+        view = memoryview(self._buf)
+        if stop <= self._capacity:
+            return [view[begin:stop]]
+        return [view[begin:], view[:stop - self._capacity]]
+
+
+class TerminalText:
+    """Incrementally decoded UTF-8 text of a TerminalBuffer
+
+    Reading does not consume the output. Each call decodes only the bytes
+    written since the previous one, carrying multibyte characters that
+    straddle reads over in an incremental decoder. Decoded text is kept in
+    pieces tagged with their byte range, so when the ring buffer drops old
+    bytes only the piece that straddles the new start is decoded again.
+    """
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._offset = buffer.start_offset
+        self._decoded_end = self._offset
+        self._pieces = collections.deque()
+        self._text = ''
+
+    def _skip_continuation(self, offset):
+        """Advance past UTF-8 continuation bytes left by a dropped character"""
+        for view in self._buffer.views(offset, offset + 3):
+            with view:
+                for byte in view:
+                    if byte & 0xC0 != 0x80:
+                        return offset
+                    offset += 1
+        return offset
+
+    def _decode_range(self, start, end):
+        """Decode a complete byte range with a fresh decoder"""
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        parts = []
+        for view in self._buffer.views(start, end):
+            with view:
+                parts.append(decoder.decode(view))
+        parts.append(decoder.decode(b'', final=True))
+        return ''.join(parts)
+
+    def _trim(self, start):
+        """Drop text whose bytes are no longer in the buffer; True if any was"""
+        if start > self._decoded_end:
+            # Even the bytes pending in the decoder are gone
+            self._pieces.clear()
+            self._decoder.reset()
+            self._offset = self._decoded_end = self._skip_continuation(start)
+            return True
+
+        trimmed = False
+        while self._pieces and self._pieces[0][1] <= start:
+            self._pieces.popleft()
+            trimmed = True
+        if self._pieces and self._pieces[0][0] < start:
+            piece_start = self._skip_continuation(start)
+            piece_end = self._pieces[0][1]
+            self._pieces[0] = (piece_start, piece_end, self._decode_range(piece_start, piece_end))
+            trimmed = True
+        return trimmed
+
+    def text(self, final=False):
+        """The retained output as text
+
+        Pass final=True once no more output can arrive, so that a trailing
+        incomplete character is decoded (as U+FFFD) instead of held back.
+        """
+        buffer = self._buffer
+        if self._trim(buffer.start_offset):
+            self._text = ''.join(piece[2] for piece in self._pieces)
+
+        if buffer.total_bytes > self._offset or (final and self._decoded_end < self._offset):
+            parts = []
+            for view in buffer.views(self._offset):
+                with view:
+                    parts.append(self._decoder.decode(view))
+            if final:
+                parts.append(self._decoder.decode(b'', final=True))
+            self._offset = buffer.total_bytes
+
+            # Bytes of an incomplete character stay in the decoder and belong
+            # to the next piece
+            end = self._offset - len(self._decoder.getstate()[0])
+            new_text = ''.join(parts)
+            self._pieces.append((self._decoded_end, end, new_text))
+            self._decoded_end = end
+            self._text += new_text
+
+        return self._text
+
+
+class Terminal:
+    """A command started for the agent, running in its own process group"""
+
+    def __init__(self, terminal_id, process, output_byte_limit, command='', session_id=None):
+        self.id = terminal_id
+        self.process = process
+        self.command = command
+        self.session_id = session_id
+        self.started = time.monotonic()
+        self.output_buffer = TerminalBuffer(output_byte_limit)
+        self.output_text = TerminalText(self.output_buffer)
+        self.reader = None
+        self.killed = False
+        self.stream = process.stdout
+        self.transport = None
+        self.ansi_stripper = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def output(self):
+        """The retained output as text"""
+        finished = self.process.returncode is not None and self.reader is not None and self.reader.done()
+        return self.output_text.text(final=finished)
+
+    def exit_status(self):
+        """(exit code, signal name) once the process has exited, else None
+
+        A process killed by a signal has no exit code; asyncio reports it as
+        the negated signal number, which is mapped back to the signal name.
+        """
+        returncode = self.process.returncode
+        if returncode is None:
+            return None
+        if returncode < 0:
+            try:
+                return None, signal.Signals(-returncode).name
+            except ValueError:
+                return None, str(-returncode)
+        return returncode, None
+
+    async def read_output(self):
+        """Drain the process output into the ring buffer until EOF"""
+        stripper = self.ansi_stripper
+        try:
+            while True:
+                try:
+                    chunk = await self.stream.read(65536)
+                except OSError as e:
+                    # A PTY master reports EIO once the last writer is gone
+                    if e.errno != errno.EIO:
+                        raise
+                    chunk = b''
+                if not chunk:
+                    break
+                self.output_buffer.write(stripper.feed(chunk) if stripper else chunk)
+            if stripper:
+                self.output_buffer.write(stripper.flush())
+        finally:
+            self.close_stream()
+
+    def close_stream(self):
+        """Close the PTY master, if the terminal has one"""
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+
+class TerminalManager:
+    """Starts agent terminals and makes sure they are cleaned up
+
+    Each terminal runs in a new session, and so in its own process group, so
+    that killing it also reaches the children it started (test runners,
+    build tools, servers). Killing signals the group with SIGTERM, waits up
+    to ``kill_timeout`` seconds for the command to exit, then sends SIGKILL
+    to whatever is left of the group and reaps the command.
+
+    With a ``scheduler`` each command waits for a slot before it is started
+    and gives the slot back when it exits. ``nice`` and ``rlimits`` (pairs
+    from ``parse_rlimits``) are applied as described for ``CommandLimits``.
+
+    With ``use_pty`` commands run on a pseudo-terminal, so tools that fully
+    buffer their output when writing to a pipe flush it line by line.
+    ``strip_ansi`` removes escape sequences (colors, cursor movement) from
+    the output before it is stored.
+
+    With a ``spawner`` (a ``spawn_server.SpawnServer``) commands are started
+    by the spawn server process instead of being forked from the kernel.
+    """
+
+    def __init__(self, kill_timeout=2.0, scheduler=None, nice=0, rlimits=(),
+                 use_pty=False, strip_ansi=False, spawner=None):
+        self._kill_timeout = kill_timeout
+        self._scheduler = scheduler
+        self._use_pty = use_pty and pty is not None
+        self._strip_ansi = strip_ansi
+        self._spawner = spawner
+        self._nice = nice
+        self._rlimits = list(rlimits)
+        self._limits = CommandLimits(nice, self._rlimits)
+        self._log = logging.getLogger(__name__)
+        self._terminals = {}
+
+    def __len__(self):
+        return len(self._terminals)
+
+    def __iter__(self):
+        return iter(list(self._terminals.values()))
+
+    def get(self, terminal_id):
+        """Return the terminal with the given id, or None"""
+        return self._terminals.get(terminal_id)
+
+    async def create(self, command, args, cwd, env, output_byte_limit, session_id=None):
+        """Start a command and begin collecting its output
+
+        Waits for a scheduler slot first if the concurrency limits are reached.
+        """
+        if self._scheduler is not None:
+            waited = await self._scheduler.acquire(session_id, owner=self)
+            if waited:
+                self._log.info("Terminal for %s waited %.2fs for a slot", command, waited)
+
+        try:
+            process, stream, transport = await self._spawn(command, args, cwd, env)
+        except BaseException:
+            if self._scheduler is not None:
+                self._scheduler.release(session_id)
+            raise
+
+        terminal = Terminal(
+            str(uuid.uuid4()),
+            process,
+            output_byte_limit,
+            command=' '.join([command, *args]),
+            session_id=session_id,
+        )
+        terminal.stream = stream
+        terminal.transport = transport
+        if self._strip_ansi:
+            terminal.ansi_stripper = AnsiStripper()
+        terminal.reader = asyncio.create_task(self._read_output(terminal))
+        self._terminals[terminal.id] = terminal
+        return terminal
+
+    async def _spawn(self, command, args, cwd, env):
+        """Start a command through the spawn server if available, else locally"""
+        spawner = self._spawner
+        if spawner is not None and spawner.available:
+            try:
+                process = await spawner.spawn(
+                    command, args, cwd, env,
+                    use_pty=self._use_pty,
+                    nice=self._nice,
+                    rlimits=self._rlimits,
+                )
+                return process, process.stdout, None
+            except (ConnectionError, RuntimeError, asyncio.IncompleteReadError) as e:
+                # The server is unusable; errors starting the command itself
+                # are raised as plain OSError and propagate
+                self._log.warning("Spawn server failed (%s), starting the command locally", e)
+        return await spawn_process(command, args, cwd, env, self._use_pty, self._limits)
+
+    async def _read_output(self, terminal):
+        """Collect output, then hold the scheduler slot until the command exits"""
+        try:
+            await terminal.read_output()
+        except Exception as e:
+            self._log.error("Error reading terminal output for %s: %s", terminal.id, e)
+        finally:
+            if self._scheduler is not None:
+                try:
+                    await terminal.process.wait()
+                finally:
+                    self._scheduler.release(terminal.session_id)
+
+    async def wait(self, terminal):
+        """Wait for the command to exit and its output to be drained"""
+        await terminal.process.wait()
+        await asyncio.wait({terminal.reader}, timeout=1.0)
+
+    @staticmethod
+    def _group_alive(terminal):
+        """Whether the terminal's process group may still have members
+
+        The group id is the command's pid, which is not reused while the
+        command is unreaped or any member of its group is left. Members hold
+        the output open, so once the command is reaped and the output has
+        reached EOF the id may belong to an unrelated process.
+        """
+        if terminal.process.returncode is None:
+            return True
+        return terminal.reader is not None and not terminal.reader.done()
+
+    def _signal_group(self, terminal, sig):
+        """Send a signal to the terminal's process group while it exists"""
+        if not self._group_alive(terminal):
+            return
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(terminal.pid, sig)
+            elif terminal.process.returncode is None:
+                terminal.process.send_signal(sig)
+        except (ProcessLookupError, PermissionError):
+            # The group is already gone
+            pass
+
+    async def kill(self, terminal, timeout=None):
+        """Kill the command and everything in its process group"""
+        if terminal.killed:
+            return
+        terminal.killed = True
+        if timeout is None:
+            timeout = self._kill_timeout
+
+        process = terminal.process
+        self._signal_group(terminal, signal.SIGTERM)
+        if process.returncode is None:
+            try:
+                await asyncio.wait_for(process.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                self._log.info("Terminal %s ignored SIGTERM, sending SIGKILL", terminal.id)
+
+        # Children that outlived the command, or a command that ignored SIGTERM
+        self._signal_group(terminal, getattr(signal, 'SIGKILL', signal.SIGTERM))
+        await process.wait()
+
+    async def release(self, terminal_id, timeout=None):
+        """Kill a terminal if it is still running and forget it"""
+        terminal = self._terminals.pop(terminal_id, None)
+        if terminal is None:
+            return False
+
+        await self.kill(terminal, timeout)
+
+        process = terminal.process
+        if process.stdin and not process.stdin.is_closing():
+            process.stdin.close()
+        terminal.close_stream()
+
+        # The reader sees EOF once the whole group is gone
+        if terminal.reader is not None and not terminal.reader.done():
+            await asyncio.wait({terminal.reader}, timeout=1.0)
+            terminal.reader.cancel()
+        return True
+
+    def cancel_pending(self):
+        """Fail the requests still waiting for a scheduler slot"""
+        if self._scheduler is not None:
+            self._scheduler.cancel(self)
+
+    async def close(self, timeout=None):
+        """Release every terminal"""
+        self.cancel_pending()
+        terminal_ids = list(self._terminals)
+        if not terminal_ids:
+            return
+
+        self._log.info("Cleaning up %d terminal(s)", len(terminal_ids))
+        results = await asyncio.gather(
+            *(self.release(terminal_id, timeout) for terminal_id in terminal_ids),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                self._log.error("Error releasing terminal: %s", result)
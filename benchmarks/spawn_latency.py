@@ -0,0 +1,78 @@
+"""
+Compare terminal spawn latency: forking from the kernel vs. the spawn server
+
+The kernel process is simulated by allocating (and touching) a heap of
+--ballast-mb megabytes in this process before spawning, since the cost of
+forking grows with the size of the parent's address space.
+
+    python benchmarks/spawn_latency.py --count 200 --ballast-mb 1024
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from agent_client_kernel.spawn_server import SpawnServer  # noqa: E402
+from agent_client_kernel.terminals import TerminalManager  # noqa: E402
+
+
+async def measure(manager, command, count):
+    """Time create-to-exit for count runs of command"""
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        terminal = await manager.create(command[0], command[1:], None, dict(os.environ), 4096)
+        await manager.wait(terminal)
+        timings.append(time.perf_counter() - start)
+        await manager.release(terminal.id)
+    return timings
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(
+        f"{label:<14} mean {statistics.mean(timings) * 1000:7.2f} ms"
+        f"  p50 {statistics.median(timings) * 1000:7.2f} ms"
+        f"  p95 {p95 * 1000:7.2f} ms"
+    )
+
+
+async def main(args):
+    command = args.command or ['true']
+
+    spawner = SpawnServer()
+    await spawner.start()
+    try:
+        local = TerminalManager()
+        remote = TerminalManager(spawner=spawner)
+
+        # Warm up both paths
+        await measure(local, command, 5)
+        await measure(remote, command, 5)
+
+        print(f"{args.count} spawns of {' '.join(command)!r}, {args.ballast_mb} MB ballast")
+        report("kernel fork", await measure(local, command, args.count))
+        report("spawn server", await measure(remote, command, args.count))
+    finally:
+        await spawner.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Terminal spawn latency benchmark")
+    parser.add_argument('--count', type=int, default=200, help='spawns per path')
+    parser.add_argument('--ballast-mb', type=int, default=512, help='heap to allocate in this process')
+    parser.add_argument('command', nargs='*', help='command to run (default: true)')
+    args = parser.parse_args()
+
+    # Touch every page so the ballast is really mapped
+    ballast = bytearray(args.ballast_mb * 1024 * 1024)
+    for offset in range(0, len(ballast), 4096):
+        ballast[offset] = 1
+
+    asyncio.run(main(args))